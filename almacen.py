@@ -0,0 +1,189 @@
+"""Interfaz de almacenamiento de server.py y sus implementaciones.
+
+Las rutas de server.py validan la solicitud y arman la respuesta; todo lo que toca la base de datos pasa
+por un `Almacen`. Hay dos: PostgreSQL (almacen_postgres.py, el de producción) y SQLite en modo WAL
+(almacen_sqlite.py, embebido, para levantar varios servidores en una sola máquina sin infraestructura).
+"""
+from decimal import Decimal
+import hashlib
+import time
+
+TIPO_COPY = "application/x-postgres-copy"  # Snapshot en el formato binario de COPY de PostgreSQL
+
+# Columnas de las filas de productos, en el orden en que las retornan los almacenes
+COLUMNAS_PRODUCTO = ("id", "nombre", "descripcion", "cantidad", "precio", "ultima_modificacion", "hlc", "nodo")
+# Columnas de las entradas del log de cambios
+COLUMNAS_CAMBIO = ("seq", "producto_id", "eliminado", "nombre", "descripcion", "cantidad", "precio",
+                   "ultima_modificacion", "delta", "hlc", "nodo")
+
+# 🕰️ Reloj lógico híbrido (HLC): milisegundos del reloj físico en los bits altos y un contador en los bajos.
+# Cada versión de una fila lleva el sello (hlc, nodo) de la escritura que la produjo; los sellos se comparan
+# como tuplas, así que dos servidores con los relojes desfasados igual coinciden en cuál versión es la nueva.
+HLC_BITS_CONTADOR = 16
+
+class AlmacenNoDisponibleError(Exception):
+    """El almacén no pudo atender la operación a tiempo (p. ej. pool agotado); vale la pena reintentar."""
+
+class StockInsuficienteError(Exception):
+    """Algún ajuste de una reserva dejaría la cantidad por debajo de su mínimo; la reserva se revierte completa."""
+
+    def __init__(self, fallidos):
+        super().__init__("Stock insuficiente")
+        self.fallidos = fallidos
+
+class Almacen:
+    """Operaciones de datos que usan las rutas de server.py.
+
+    Las filas de productos son tuplas con COLUMNAS_PRODUCTO (precio Decimal, fecha datetime) y las del log,
+    tuplas con COLUMNAS_CAMBIO. Cada escritura registra sus cambios en el log y en la tabla de sincronización
+    dentro de la misma transacción, y las secuencias del log se confirman en orden.
+
+    Un sello es un par (hlc, nodo). Las escrituras locales reciben un sello nuevo del reloj del servidor; las
+    operaciones replicadas traen el de su origen, se aplican solo si no son más viejas que la fila actual y
+    adelantan el reloj del servidor hasta ese sello.
+    """
+    nombre = None
+    servidor = None  # Nodo de los sellos de las escrituras locales
+    formatos_snapshot = ()  # Content-Types de snapshot que sabe exportar y cargar, el nativo primero
+
+    def avanzar_reloj(self, reloj, recibidos=(), local=True):
+        """Reloj del servidor tras una escritura: el sello más nuevo entre `reloj` y los `recibidos` (None es una
+        operación local) y, si hubo escrituras locales, un sello propio posterior a todos ellos."""
+        reloj = max([tuple(reloj)] + [tuple(sello) for sello in recibidos if sello is not None])
+        if local:
+            reloj = (hlc_siguiente(reloj[0]), self.servidor)
+        return reloj
+
+    def iniciar(self):
+        """Prepara el almacén al arrancar el servidor; retorna un mensaje para el log."""
+        raise NotImplementedError
+
+    def estadisticas(self):
+        """Estado interno (conexiones, etc.) para GET /pool."""
+        raise NotImplementedError
+
+    def version(self):
+        """Última secuencia del log de cambios."""
+        raise NotImplementedError
+
+    def guardar_producto(self, datos, producto_id=None):
+        """Crea un producto (o lo reemplaza si se da la ID) y retorna su ID."""
+        raise NotImplementedError
+
+    def actualizar_producto(self, producto_id, datos):
+        """Sobrescribe los campos de un producto; retorna False si no existe."""
+        raise NotImplementedError
+
+    def eliminar_producto(self, producto_id):
+        """Elimina un producto; retorna False si no existe."""
+        raise NotImplementedError
+
+    def aplicar_lote(self, upserts, nuevos, eliminaciones, ajustes):
+        """Aplica en una transacción UPSERTs [(id, nombre, descripcion, cantidad, precio, sello)], inserciones sin ID
+        [(nombre, descripcion, cantidad, precio)], eliminaciones [(id, sello)] y ajustes de stock [(id, delta, sello)].
+
+        Un sello None es una escritura local. Los UPSERTs y eliminaciones con un sello anterior al de la fila se
+        omiten, y también los ajustes con un sello igual o anterior: el replicador puede reenviar un ajuste que el
+        destino ya sumó, y volver a sumarlo no es idempotente como repetir un UPSERT. Una ID puede tener varios
+        ajustes, cada uno con su sello; se aplican en orden y cada uno queda en el log con su sello.
+        Retorna ({id: True si se insertó}, IDs nuevas en orden, IDs eliminadas, estado de cada ajuste en el orden
+        recibido ("ajustado", "omitido" o "no_encontrado"), IDs omitidas de UPSERTs y eliminaciones).
+        """
+        raise NotImplementedError
+
+    def reservar_ids(self, cantidad):
+        """Consume `cantidad` IDs de la secuencia de productos sin crear filas."""
+        raise NotImplementedError
+
+    def listar_productos(self, filtros, orden, descendente, limite):
+        """Retorna las filas que cumplen `filtros` (ver server.filtros_productos), ordenadas y con límite opcional."""
+        raise NotImplementedError
+
+    def transmitir_productos(self, filtros, orden, descendente, limite, tanda):
+        """Como listar_productos, pero itera tandas de `tanda` filas sin cargar el resultado en memoria."""
+        raise NotImplementedError
+
+    def obtener_productos(self, ids):
+        """Retorna las filas de los productos con esas IDs, en una sola consulta. Las IDs que no existen se omiten."""
+        raise NotImplementedError
+
+    def ajustar_stock(self, producto_id, delta, minimo):
+        """Suma `delta` a la cantidad si no queda por debajo de `minimo` (None: sin piso).
+
+        Retorna (aplicado, cantidad): la cantidad nueva, o la actual si no alcanzó; (False, None) si no existe.
+        """
+        raise NotImplementedError
+
+    def reservar_stock(self, deltas, minimos):
+        """Aplica {id: delta} de forma atómica respetando {id: mínimo}; retorna [(id, cantidad nueva)].
+
+        Lanza StockInsuficienteError con los fallidos si alguno no cumple o no existe.
+        """
+        raise NotImplementedError
+
+    def ultimo_cambio(self):
+        """Retorna (servidor, fecha, hlc, nodo) de la fila de sincronización de este servidor, o None, y la última
+        secuencia. (hlc, nodo) es el sello más nuevo que escribió o recibió."""
+        raise NotImplementedError
+
+    def cambios(self, desde, limite):
+        """Retorna (última secuencia, entradas del log con secuencia mayor a `desde`, hasta `limite`)."""
+        raise NotImplementedError
+
+    def suscribir(self):
+        """Retorna una suscripción a las escrituras confirmadas: `.seq` inicial, `.esperar(timeout)` con la lista
+        de secuencias nuevas (vacía si pasó el tiempo) y `.cerrar()`."""
+        raise NotImplementedError
+
+    def merkle(self, desde, hasta, ancho):
+        """Retorna {parte: (hash, filas)} de las hojas [desde, hasta] agrupadas de a `ancho` hojas."""
+        raise NotImplementedError
+
+    def exportar_snapshot(self, tipo):
+        """Generador de un snapshot consistente en el formato `tipo`: primero la secuencia del log a la que
+        corresponde y después los fragmentos de bytes."""
+        raise NotImplementedError
+
+    def cargar_snapshot(self, flujo, tipo):
+        """Reemplaza los productos por un snapshot leído de `flujo`; retorna (filas cargadas, productos eliminados)."""
+        raise NotImplementedError
+
+def escapar_like(texto):
+    """Escapa los comodines de LIKE (con '\\' como carácter de escape) para buscar el texto literal."""
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def texto_precio(precio):
+    """Texto de un precio NUMERIC(10,2) tal como lo escribe PostgreSQL."""
+    return f"{Decimal(precio):.2f}"
+
+def citar(texto):
+    """Equivalente a quote_nullable() de PostgreSQL para un texto."""
+    if texto is None:
+        return "NULL"
+    citado = "'" + texto.replace("'", "''") + "'"
+    return "E" + citado.replace("\\", "\\\\") if "\\" in texto else citado
+
+def hash_producto(producto_id, nombre, descripcion, cantidad, precio):
+    """Hash de 64 bits con signo de un producto, igual al de la función hash_producto de create_db.py.
+
+    Así los árboles de Merkle de un almacén SQLite y uno PostgreSQL se pueden comparar entre sí.
+    """
+    texto = "|".join(str(valor) for valor in (producto_id, citar(nombre), citar(descripcion), cantidad,
+                                              texto_precio(precio) if precio is not None else None)
+                     if valor is not None)
+    valor = int(hashlib.md5(texto.encode()).hexdigest()[:16], 16)
+    return valor - 2**64 if valor >= 2**63 else valor
+
+def hlc_siguiente(ultimo):
+    """HLC para una escritura local: el reloj físico, o uno más que el último si el reloj físico quedó atrás."""
+    return max(int(time.time() * 1000) << HLC_BITS_CONTADOR, ultimo + 1)
+
+def crear_almacen(tipo, **opciones):
+    """Crea el almacén `tipo` ("postgres" o "sqlite") con sus opciones de configuración."""
+    if tipo == "postgres":
+        from almacen_postgres import AlmacenPostgres
+        return AlmacenPostgres(**opciones)
+    if tipo == "sqlite":
+        from almacen_sqlite import AlmacenSqlite
+        return AlmacenSqlite(**opciones)
+    raise ValueError(f"Almacén desconocido: {tipo} (se acepta postgres o sqlite)")
@@ -0,0 +1,716 @@
+"""Almacén sobre PostgreSQL: pool de conexiones propio, log de cambios con LISTEN/NOTIFY y árbol de Merkle por trigger.
+
+El esquema lo crea create_db.py.
+"""
+from contextlib import contextmanager
+import collections
+import queue
+import select
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+import formato
+import metricas
+import trazas
+from almacen import (Almacen, AlmacenNoDisponibleError, StockInsuficienteError, COLUMNAS_CAMBIO, COLUMNAS_PRODUCTO,
+                     TIPO_COPY, escapar_like)
+
+CANAL_CAMBIOS = "cambios"  # Canal de LISTEN/NOTIFY por el que se avisa cada escritura confirmada
+BULK_PAGINA = 1000  # Filas por sentencia INSERT multi-fila
+SNAPSHOT_TROZO = 64 * 1024  # Bytes por fragmento al transmitir un snapshot
+SELECT_PRODUCTOS = f"SELECT {', '.join(COLUMNAS_PRODUCTO)} FROM productos"
+
+# Condición SQL de cada filtro de GET /productos (ver server.filtros_productos), pensadas para los índices de create_db.py
+CONDICIONES = {
+    "prefijo": "nombre LIKE %s",
+    "buscar": "nombre ILIKE %s",
+    "after": "id > %s",
+    "before": "id < %s",
+    "precio_min": "precio >= %s",
+    "precio_max": "precio <= %s",
+    "cantidad_min": "cantidad >= %s",
+    "cantidad_max": "cantidad <= %s",
+    "modificado_desde": "ultima_modificacion >= %s",
+}
+
+# Métricas de la base de datos
+metrica_consulta = metricas.Histograma("bd_consulta_segundos", "Duración de cada sentencia SQL", ("sentencia",))
+metrica_adquirir = metricas.Histograma("bd_adquirir_conexion_segundos", "Espera para obtener una conexión del pool")
+metrica_timeouts = metricas.Contador("bd_pool_timeouts_total", "Solicitudes que no obtuvieron conexión a tiempo")
+
+class CursorMedido(psycopg2.extensions.cursor):
+    """Cursor que mide la duración de cada sentencia SQL, etiquetada por su primera palabra (SELECT, INSERT...).
+
+    Dentro de una solicitud trazada cada sentencia es además un tramo "sql <SENTENCIA>".
+    """
+
+    def execute(self, query, vars=None):
+        inicio_sql = query.lstrip()[:6]
+        if isinstance(inicio_sql, bytes):
+            inicio_sql = inicio_sql.decode("ascii", "replace")
+        inicio_sql = inicio_sql.upper()
+        inicio = time.perf_counter()
+        try:
+            with trazas.tramo(f"sql {inicio_sql}"):
+                return super().execute(query, vars)
+        finally:
+            metrica_consulta.observar(time.perf_counter() - inicio, sentencia=inicio_sql)
+
+class PoolAgotadoError(AlmacenNoDisponibleError):
+    """Se agotó el tiempo de espera para obtener una conexión del pool."""
+
+class PoolConexiones:
+    """Pool de conexiones a PostgreSQL con tamaño mínimo/máximo, verificación de salud y tiempo de espera."""
+
+    def __init__(self, conectar, minimo, maximo, timeout, intervalo_salud):
+        self.conectar = conectar
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.intervalo_salud = intervalo_salud
+        self._libres = collections.deque()  # Pares (conexión, instante de su último uso)
+        self._cond = threading.Condition()
+        self._abiertas = 0
+        self._en_uso = 0
+        self._esperando = 0
+        self._adquisiciones = 0
+        self._timeouts = 0
+        self._descartadas = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+    def llenar(self):
+        """Abre las conexiones mínimas del pool. Retorna cuántas se pudieron abrir."""
+        nuevas = []
+        with self._cond:
+            faltantes = max(0, self.minimo - self._abiertas)
+            self._abiertas += faltantes
+        for _ in range(faltantes):
+            conn = self.conectar()
+            if conn is not None:
+                nuevas.append(conn)
+        with self._cond:
+            self._abiertas -= faltantes - len(nuevas)
+            ahora = time.monotonic()
+            self._libres.extend((conn, ahora) for conn in nuevas)
+            self._cond.notify_all()
+        return len(nuevas)
+
+    def _conexion_sana(self, conn, ultimo_uso):
+        """Verifica una conexión antes de entregarla si lleva mucho tiempo inactiva."""
+        if conn.closed:
+            return False
+        if time.monotonic() - ultimo_uso < self.intervalo_salud:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _cerrar(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def adquirir(self):
+        """Obtiene una conexión del pool, abriendo una nueva si no hay libres y no se alcanzó el máximo."""
+        with trazas.tramo("conectar_bd"):
+            return self._adquirir()
+
+    def _adquirir(self):
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                self._esperando += 1
+                try:
+                    while not self._libres and self._abiertas >= self.maximo:
+                        restante = limite - time.monotonic()
+                        if restante <= 0:
+                            self._timeouts += 1
+                            metrica_timeouts.inc()
+                            raise PoolAgotadoError(
+                                f"No hay conexiones disponibles tras {self.timeout}s (máximo {self.maximo})")
+                        self._cond.wait(restante)
+                finally:
+                    self._esperando -= 1
+
+                if self._libres:
+                    conn, ultimo_uso = self._libres.pop()
+                else:
+                    self._abiertas += 1
+
+            if conn is None:
+                conn = self.conectar()
+                if conn is None:
+                    with self._cond:
+                        self._abiertas -= 1
+                        self._cond.notify()
+                    raise psycopg2.OperationalError("No se pudo abrir una nueva conexión a la base de datos")
+            elif not self._conexion_sana(conn, ultimo_uso):
+                print("⚠️ Conexión inactiva descartada del pool por fallar la verificación de salud.")
+                self._cerrar(conn)
+                with self._cond:
+                    self._abiertas -= 1
+                    self._descartadas += 1
+                    self._cond.notify()
+                continue
+
+            espera = time.monotonic() - inicio
+            metrica_adquirir.observar(espera)
+            with self._cond:
+                self._en_uso += 1
+                self._adquisiciones += 1
+                self._espera_total += espera
+                self._espera_max = max(self._espera_max, espera)
+            return conn
+
+    def liberar(self, conn, descartar=False):
+        """Devuelve una conexión al pool, o la cierra si está rota o se pidió descartarla."""
+        if descartar or conn.closed:
+            self._cerrar(conn)
+            with self._cond:
+                self._en_uso -= 1
+                self._abiertas -= 1
+                self._descartadas += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._en_uso -= 1
+            self._libres.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def estadisticas(self):
+        """Retorna el estado actual del pool para poder dimensionarlo."""
+        with self._cond:
+            return {
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "timeout": self.timeout,
+                "abiertas": self._abiertas,
+                "en_uso": self._en_uso,
+                "libres": len(self._libres),
+                "esperando": self._esperando,
+                "adquisiciones": self._adquisiciones,
+                "timeouts": self._timeouts,
+                "descartadas": self._descartadas,
+                "espera_promedio_ms": round(1000 * self._espera_total / self._adquisiciones, 3) if self._adquisiciones else 0.0,
+                "espera_max_ms": round(1000 * self._espera_max, 3),
+            }
+
+class FlujoCopia:
+    """Archivo de escritura para COPY ... TO STDOUT que pasa los datos a otro hilo por una cola acotada.
+
+    Si el hilo lector se va (el cliente cortó la descarga), la siguiente escritura falla y aborta el COPY.
+    """
+
+    def __init__(self):
+        self.cola = queue.Queue(maxsize=8)
+        self.cancelado = False
+        self._partes = []
+        self._tamano = 0
+
+    def poner(self, elemento):
+        while True:
+            if self.cancelado:
+                raise IOError("Transmisión del snapshot cancelada")
+            try:
+                self.cola.put(elemento, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def write(self, datos):
+        self._partes.append(datos)
+        self._tamano += len(datos)
+        if self._tamano >= SNAPSHOT_TROZO:
+            self.vaciar()
+
+    def vaciar(self):
+        if self._partes:
+            self.poner(b"".join(self._partes))
+            self._partes = []
+            self._tamano = 0
+
+class SuscripcionPostgres:
+    """Conexión propia (fuera del pool) que escucha el canal de LISTEN/NOTIFY."""
+
+    def __init__(self, conn, seq):
+        self.conn = conn
+        self.seq = seq
+
+    def esperar(self, timeout):
+        if select.select([self.conn], [], [], timeout) == ([], [], []):
+            return []
+        self.conn.poll()
+        secuencias = [int(aviso.payload) for aviso in self.conn.notifies]
+        self.conn.notifies.clear()
+        return secuencias
+
+    def cerrar(self):
+        self.conn.close()
+
+class AlmacenPostgres(Almacen):
+    """Almacén de producción sobre PostgreSQL."""
+    nombre = "postgres"
+    formatos_snapshot = (TIPO_COPY, formato.TIPO_COLUMNAS)
+
+    def __init__(self, host, dbname, user, password, servidor, merkle_rango, pool_min=2, pool_max=10,
+                 pool_timeout=5, pool_salud=30, tanda=500):
+        self.parametros = {"host": host, "dbname": dbname, "user": user, "password": password}
+        self.servidor = servidor
+        self.merkle_rango = merkle_rango
+        self.tanda = tanda
+        self.pool = PoolConexiones(self.conectar, pool_min, pool_max, pool_timeout, pool_salud)
+        metricas.Medidor("bd_pool_conexiones", "Conexiones del pool por estado", ("estado",), funcion=self._conexiones_pool)
+
+    def _conexiones_pool(self):
+        estadisticas = self.pool.estadisticas()
+        return {(estado,): estadisticas[estado] for estado in ("abiertas", "en_uso", "libres", "esperando")}
+
+    def conectar(self):
+        """Intenta conectar a la base de datos y muestra si la conexión fue exitosa o fallida."""
+        try:
+            with trazas.tramo("conectar_bd.nueva"):
+                conn = psycopg2.connect(**self.parametros)
+            print(f"✅ Conexión exitosa a la base de datos {self.parametros['dbname']} en {self.parametros['host']}")
+            return conn
+        except Exception as e:
+            print(f"❌ Error al conectar a la base de datos: {e}")
+            return None
+
+    def iniciar(self):
+        abiertas = self.pool.llenar()  # Verificar conexión al iniciar y precargar el pool
+        return f"🔌 Pool de conexiones listo: {abiertas}/{self.pool.minimo} conexiones iniciales (máximo {self.pool.maximo})"
+
+    def estadisticas(self):
+        return self.pool.estadisticas()
+
+    @contextmanager
+    def transaccion(self, nombre_cursor=None):
+        """Entrega un cursor sobre una conexión del pool; confirma al salir o revierte si hubo un error.
+
+        Con `nombre_cursor` el cursor es del lado del servidor y trae las filas por partes al iterarlo.
+        """
+        conn = self.pool.adquirir()
+        descartar = False
+        try:
+            with conn.cursor(name=nombre_cursor, cursor_factory=CursorMedido) as cur:
+                yield cur
+            with trazas.tramo("sql COMMIT"):
+                conn.commit()
+        except BaseException as e:  # Incluye GeneratorExit cuando se corta una respuesta transmitida
+            descartar = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    descartar = True
+            raise
+        finally:
+            self.pool.liberar(conn, descartar=descartar)
+
+    def leer_reloj(self, cur):
+        """Retorna el sello (hlc, nodo) de la fila de sincronización de este servidor y la bloquea hasta el commit.
+
+        Se llama al empezar cada escritura: el bloqueo serializa a las escrituras de este servidor, así que los
+        sellos locales son crecientes y las secuencias del log se confirman en orden, y quien lee con una marca
+        de agua nunca se salta un cambio.
+        """
+        cur.execute("""
+            INSERT INTO sincronizacion (servidor, ultimo_cambio, hlc, nodo) VALUES (%s, NOW(), 0, '')
+            ON CONFLICT (servidor) DO UPDATE SET servidor = EXCLUDED.servidor
+            RETURNING hlc, nodo
+        """, (self.servidor,))
+        return tuple(cur.fetchone())
+
+    def registrar_cambios(self, cur, reloj, actualizados=(), eliminados=(), ajustes=()):
+        """Guarda el reloj de este servidor en la tabla de sincronización y agrega los cambios al log.
+
+        `eliminados` son tripletas (ID, hlc, nodo) con el sello de cada lápida; los productos actualizados y
+        ajustados se copian al log con el sello de su fila. `ajustes` son pares (ID, delta) de ajustes de stock:
+        además de la fila se guarda el delta, para que las réplicas apliquen el ajuste en vez de sobrescribir la
+        cantidad. Se ejecuta dentro de la transacción de la escritura que leyó el reloj con leer_reloj().
+        """
+        with trazas.tramo("registrar_cambios"):
+            cur.execute("UPDATE sincronizacion SET ultimo_cambio = NOW(), hlc = %s, nodo = %s WHERE servidor = %s",
+                        (*reloj, self.servidor))
+            if eliminados:
+                # 🪦 Lápidas: solo se guarda la ID del producto eliminado y el sello de la eliminación
+                execute_values(cur, "INSERT INTO cambios (producto_id, eliminado, hlc, nodo) VALUES %s",
+                               list(eliminados), template="(%s, TRUE, %s, %s)", page_size=BULK_PAGINA)
+            if actualizados:
+                cur.execute("""
+                    INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                         hlc, nodo)
+                    SELECT id, FALSE, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo
+                    FROM productos WHERE id = ANY(%s) ORDER BY id
+                """, (list(actualizados),))
+            if ajustes:
+                self.registrar_ajustes(cur, ajustes)
+            # 📣 Postgres entrega el aviso al confirmar la transacción, con la última secuencia escrita
+            cur.execute("SELECT pg_notify(%s, currval(pg_get_serial_sequence('cambios', 'seq'))::text)", (CANAL_CAMBIOS,))
+
+    def registrar_ajustes(self, cur, ajustes):
+        """Copia al log los ajustes [(ID, delta)] con la fila como quedó, incluido su sello."""
+        execute_values(cur, """
+            INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                 delta, hlc, nodo)
+            SELECT p.id, FALSE, p.nombre, p.descripcion, p.cantidad, p.precio, p.ultima_modificacion, a.delta,
+                   p.hlc, p.nodo
+            FROM (VALUES %s) AS a(id, delta) JOIN productos p ON p.id = a.id ORDER BY p.id
+        """, list(ajustes), page_size=BULK_PAGINA)
+
+    def version_tabla(self, cur):
+        """Versión de la tabla productos en este servidor: la última secuencia del log de cambios."""
+        cur.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios")
+        return cur.fetchone()[0]
+
+    def version(self):
+        with self.transaccion() as cur:
+            return self.version_tabla(cur)
+
+    def guardar_producto(self, datos, producto_id=None):
+        with self.transaccion() as cur:
+            reloj = self.avanzar_reloj(self.leer_reloj(cur))
+            if producto_id is not None:
+                cur.execute("""
+                    INSERT INTO productos (id, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES (%s, %s, %s, %s, %s, NOW(), %s, %s)
+                    ON CONFLICT (id) DO UPDATE
+                    SET nombre=EXCLUDED.nombre, descripcion=EXCLUDED.descripcion,
+                        cantidad=EXCLUDED.cantidad, precio=EXCLUDED.precio,
+                        ultima_modificacion=NOW(), hlc=EXCLUDED.hlc, nodo=EXCLUDED.nodo
+                """, (producto_id, datos["nombre"], datos["descripcion"], datos["cantidad"], datos["precio"], *reloj))
+            else:
+                cur.execute("""
+                    INSERT INTO productos (nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES (%s, %s, %s, %s, NOW(), %s, %s) RETURNING id
+                """, (datos["nombre"], datos["descripcion"], datos["cantidad"], datos["precio"], *reloj))
+                producto_id = cur.fetchone()[0]  # Obtener la ID generada automáticamente
+
+            self.registrar_cambios(cur, reloj, actualizados=[producto_id])  # Registrar el cambio en la misma transacción
+        return producto_id
+
+    def actualizar_producto(self, producto_id, datos):
+        with self.transaccion() as cur:
+            reloj = self.avanzar_reloj(self.leer_reloj(cur))
+            cur.execute("""
+                UPDATE productos
+                SET nombre=%s, descripcion=%s, cantidad=%s, precio=%s, ultima_modificacion=NOW(), hlc=%s, nodo=%s
+                WHERE id=%s
+            """, (datos.get("nombre"), datos.get("descripcion"), datos.get("cantidad"), datos.get("precio"), *reloj,
+                  producto_id))
+            if cur.rowcount == 0:
+                return False
+            self.registrar_cambios(cur, reloj, actualizados=[producto_id])
+        return True
+
+    def eliminar_producto(self, producto_id):
+        with self.transaccion() as cur:
+            reloj = self.avanzar_reloj(self.leer_reloj(cur))
+            cur.execute("DELETE FROM productos WHERE id=%s", (producto_id,))
+            if cur.rowcount == 0:
+                return False
+            self.registrar_cambios(cur, reloj, eliminados=[(producto_id, *reloj)])  # Registrar la lápida en la misma transacción
+        return True
+
+    def aplicar_lote(self, upserts, nuevos, eliminaciones, ajustes):
+        insertados = {}
+        ids_nuevos = []
+        eliminados = []
+        estados_ajustes = []
+        omitidos = []
+        with self.transaccion() as cur:
+            recibidos = [fila[5] for fila in upserts] + [sello for _, sello in eliminaciones] + [a[2] for a in ajustes]
+            reloj = self.avanzar_reloj(self.leer_reloj(cur), recibidos, bool(nuevos) or None in recibidos)
+            if upserts:
+                # Un UPSERT replicado no pisa una versión más nueva de la fila
+                filas = execute_values(cur, """
+                    INSERT INTO productos (id, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES %s
+                    ON CONFLICT (id) DO UPDATE
+                    SET nombre=EXCLUDED.nombre, descripcion=EXCLUDED.descripcion,
+                        cantidad=EXCLUDED.cantidad, precio=EXCLUDED.precio,
+                        ultima_modificacion=NOW(), hlc=EXCLUDED.hlc, nodo=EXCLUDED.nodo
+                    WHERE (EXCLUDED.hlc, EXCLUDED.nodo) >= (productos.hlc, productos.nodo)
+                    RETURNING id, (xmax = 0)
+                """, [(*fila[:5], *(fila[5] or reloj)) for fila in upserts],
+                    template="(%s, %s, %s, %s, %s, NOW(), %s, %s)", page_size=BULK_PAGINA, fetch=True)
+                insertados = dict(filas)
+                omitidos = [fila[0] for fila in upserts if fila[0] not in insertados]
+
+            if nuevos:
+                # INSERT ... VALUES ... RETURNING devuelve las IDs en el orden de las filas
+                filas = execute_values(cur, """
+                    INSERT INTO productos (nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES %s RETURNING id
+                """, [(*fila, *reloj) for fila in nuevos], template="(%s, %s, %s, %s, NOW(), %s, %s)",
+                    page_size=BULK_PAGINA, fetch=True)
+                ids_nuevos = [fila[0] for fila in filas]
+
+            if eliminaciones:
+                filas = execute_values(cur, """
+                    DELETE FROM productos p USING (VALUES %s) AS e(id, hlc, nodo)
+                    WHERE p.id = e.id AND (e.hlc, e.nodo) >= (p.hlc, p.nodo)
+                    RETURNING p.id, e.hlc, e.nodo
+                """, [(pid, *(sello or reloj)) for pid, sello in eliminaciones],
+                    template="(%s, %s::bigint, %s::varchar)", page_size=BULK_PAGINA, fetch=True)
+                eliminados = [tuple(fila) for fila in filas]
+                if len(eliminados) < len(eliminaciones):
+                    quedan = {pid for pid, _ in eliminaciones} - {fila[0] for fila in eliminados}
+                    cur.execute("SELECT id FROM productos WHERE id = ANY(%s)", (list(quedan),))
+                    omitidos += [fila[0] for fila in cur.fetchall()]
+
+            if ajustes:
+                # Ronda k: el k-ésimo ajuste de cada ID, porque un UPDATE ... FROM toca cada fila una sola vez
+                rondas = collections.defaultdict(list)
+                vistos = collections.Counter()
+                for posicion, (pid, delta, sello) in enumerate(ajustes):
+                    rondas[vistos[pid]].append((posicion, pid, delta, *(sello or reloj)))
+                    vistos[pid] += 1
+                estados_ajustes = [None] * len(ajustes)
+                for ronda in rondas.values():
+                    # Un ajuste replicado que la fila ya tiene (mismo sello o anterior) no se vuelve a sumar
+                    filas = execute_values(cur, """
+                        UPDATE productos p SET cantidad = p.cantidad + a.delta, ultima_modificacion = NOW(),
+                            hlc = a.hlc, nodo = a.nodo
+                        FROM (VALUES %s) AS a(posicion, id, delta, hlc, nodo)
+                        WHERE p.id = a.id AND (a.hlc, a.nodo) > (p.hlc, p.nodo)
+                        RETURNING a.posicion, p.id, a.delta
+                    """, ronda, template="(%s, %s, %s, %s::bigint, %s::varchar)", page_size=BULK_PAGINA, fetch=True)
+                    if filas:
+                        # Cada ajuste va al log con la fila y el sello que dejó, antes de la ronda siguiente
+                        self.registrar_ajustes(cur, [(pid, delta) for _, pid, delta in filas])
+                    for posicion, _, _ in filas:
+                        estados_ajustes[posicion] = "ajustado"
+                quedan = {ajustes[k][0] for k, estado in enumerate(estados_ajustes) if estado is None}
+                if quedan:
+                    cur.execute("SELECT id FROM productos WHERE id = ANY(%s)", (list(quedan),))
+                    existentes = {fila[0] for fila in cur.fetchall()}
+                    estados_ajustes = [estado or ("omitido" if ajustes[k][0] in existentes else "no_encontrado")
+                                       for k, estado in enumerate(estados_ajustes)]
+
+            if insertados or ids_nuevos or eliminados or "ajustado" in estados_ajustes:
+                self.registrar_cambios(cur, reloj, actualizados=list(insertados) + ids_nuevos, eliminados=eliminados)
+        return insertados, ids_nuevos, [fila[0] for fila in eliminados], estados_ajustes, omitidos
+
+    def reservar_ids(self, cantidad):
+        with self.transaccion() as cur:
+            cur.execute("SELECT nextval(pg_get_serial_sequence('productos', 'id')) FROM generate_series(1, %s)",
+                        (cantidad,))
+            return [fila[0] for fila in cur.fetchall()]
+
+    def _consulta_productos(self, filtros, orden, descendente, limite):
+        condiciones = []
+        params = []
+        for filtro, valor in filtros.items():
+            if filtro == "prefijo":
+                valor = escapar_like(valor) + "%"
+            elif filtro == "buscar":
+                valor = "%" + escapar_like(valor) + "%"
+            condiciones.append(CONDICIONES[filtro])
+            params.append(valor)
+        sql = SELECT_PRODUCTOS
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        direccion = " DESC" if descendente else ""
+        sql += f" ORDER BY {orden}{direccion}" + (f", id{direccion}" if orden != "id" else "")
+        if limite is not None:
+            sql += " LIMIT %s"
+            params.append(limite)
+        return sql, params
+
+    def listar_productos(self, filtros, orden, descendente, limite):
+        with self.transaccion() as cur:
+            cur.execute(*self._consulta_productos(filtros, orden, descendente, limite))
+            return cur.fetchall()
+
+    def transmitir_productos(self, filtros, orden, descendente, limite, tanda):
+        with self.transaccion(nombre_cursor="transmision") as cur:
+            cur.execute(*self._consulta_productos(filtros, orden, descendente, limite))
+            while True:
+                filas = cur.fetchmany(tanda)
+                if not filas:
+                    return
+                yield filas
+
+    def obtener_productos(self, ids):
+        with self.transaccion() as cur:
+            cur.execute(f"{SELECT_PRODUCTOS} WHERE id = ANY(%s)", (list(ids),))
+            return cur.fetchall()
+
+    def ajustar_stock(self, producto_id, delta, minimo):
+        with self.transaccion() as cur:
+            reloj = self.avanzar_reloj(self.leer_reloj(cur))
+            cur.execute("""
+                UPDATE productos SET cantidad = cantidad + %s, ultima_modificacion = NOW(), hlc = %s, nodo = %s
+                WHERE id = %s AND (%s::int IS NULL OR cantidad + %s >= %s)
+                RETURNING cantidad
+            """, (delta, *reloj, producto_id, minimo, delta, minimo))
+            fila = cur.fetchone()
+            if fila is None:
+                cur.execute("SELECT cantidad FROM productos WHERE id = %s", (producto_id,))
+                actual = cur.fetchone()
+                return False, actual[0] if actual else None
+
+            self.registrar_cambios(cur, reloj, ajustes=[(producto_id, delta)])  # Registrar el ajuste en la misma transacción
+        return True, fila[0]
+
+    def reservar_stock(self, deltas, minimos):
+        with self.transaccion() as cur:
+            reloj = self.avanzar_reloj(self.leer_reloj(cur))
+            # Las filas se bloquean en orden de ID para que dos reservas concurrentes no queden en deadlock
+            cur.execute("SELECT id FROM productos WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (list(deltas),))
+            filas = execute_values(cur, """
+                UPDATE productos p SET cantidad = p.cantidad + a.delta, ultima_modificacion = NOW(),
+                    hlc = a.hlc, nodo = a.nodo
+                FROM (VALUES %s) AS a(id, delta, minimo, hlc, nodo)
+                WHERE p.id = a.id AND (a.minimo IS NULL OR p.cantidad + a.delta >= a.minimo)
+                RETURNING p.id, p.cantidad
+            """, [(pid, delta, minimos.get(pid), *reloj) for pid, delta in deltas.items()],
+                template="(%s, %s, %s::int, %s::bigint, %s::varchar)", page_size=BULK_PAGINA, fetch=True)
+            if len(filas) < len(deltas):
+                aplicados = {pid for pid, _ in filas}
+                cur.execute("SELECT id, cantidad FROM productos WHERE id = ANY(%s)",
+                            ([pid for pid in deltas if pid not in aplicados],))
+                actuales = dict(cur.fetchall())
+                raise StockInsuficienteError([
+                    {"id": pid, "cantidad": actuales.get(pid), "delta": deltas[pid], "minimo": minimos.get(pid)}
+                    for pid in deltas if pid not in aplicados])
+
+            self.registrar_cambios(cur, reloj, ajustes=list(deltas.items()))
+        return sorted(filas)
+
+    def ultimo_cambio(self):
+        with self.transaccion() as cur:
+            cur.execute("SELECT servidor, ultimo_cambio, hlc, nodo FROM sincronizacion WHERE servidor = %s", (self.servidor,))
+            resultado = cur.fetchone()
+            return resultado, self.version_tabla(cur)
+
+    def cambios(self, desde, limite):
+        with self.transaccion() as cur:
+            ultimo_seq = self.version_tabla(cur)
+            cur.execute(f"SELECT {', '.join(COLUMNAS_CAMBIO)} FROM cambios WHERE seq > %s ORDER BY seq LIMIT %s",
+                        (desde, limite))
+            return ultimo_seq, cur.fetchall()
+
+    def suscribir(self):
+        conn = self.conectar()
+        if conn is None:
+            raise AlmacenNoDisponibleError("No se pudo conectar a la base de datos")
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CANAL_CAMBIOS}")
+                return SuscripcionPostgres(conn, self.version_tabla(cur))
+        except Exception:
+            conn.close()
+            raise
+
+    def merkle(self, desde, hasta, ancho):
+        with self.transaccion() as cur:
+            cur.execute("""
+                SELECT (hoja - %s) / %s AS parte, COALESCE(bit_xor(hash), 0), COALESCE(SUM(filas), 0)
+                FROM merkle WHERE hoja BETWEEN %s AND %s GROUP BY parte
+            """, (desde, ancho, desde, hasta))
+            return {parte: (hash_, int(filas)) for parte, hash_, filas in cur.fetchall()}
+
+    def exportar_snapshot(self, tipo):
+        """La copia y la secuencia del log se leen en la misma transacción REPEATABLE READ."""
+        if tipo == formato.TIPO_COLUMNAS:
+            with self.transaccion() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+                yield self.version_tabla(cur)
+                with cur.connection.cursor(name="snapshot") as lector:
+                    lector.execute(f"{SELECT_PRODUCTOS} ORDER BY id")
+                    while True:
+                        tanda = lector.fetchmany(self.tanda)
+                        if not tanda:
+                            return
+                        yield formato.codificar(tanda, formato.ESQUEMA_PRODUCTO)
+
+        flujo = FlujoCopia()
+
+        def copiar(cur):
+            try:
+                cur.copy_expert(f"COPY ({SELECT_PRODUCTOS} ORDER BY id) TO STDOUT WITH (FORMAT binary)", flujo)
+                flujo.vaciar()
+                flujo.poner(None)
+            except Exception as e:
+                if not flujo.cancelado:
+                    flujo.poner(e)
+
+        with self.transaccion() as cur:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            yield self.version_tabla(cur)
+            # COPY escribe de forma bloqueante: corre en otro hilo y los datos llegan por la cola
+            hilo = threading.Thread(target=copiar, args=(cur,), daemon=True)
+            hilo.start()
+            try:
+                while True:
+                    trozo = flujo.cola.get()
+                    if trozo is None:
+                        return
+                    if isinstance(trozo, Exception):
+                        raise trozo
+                    yield trozo
+            finally:
+                flujo.cancelado = True
+                hilo.join()
+
+    def cargar_snapshot(self, flujo, tipo):
+        """Carga las filas (con COPY si el snapshot viene en ese formato), reconstruye el árbol de Merkle en una
+        pasada y deja en el log una lápida por cada producto que desapareció y una entrada por cada producto cargado."""
+        with self.transaccion() as cur:
+            reloj = self.leer_reloj(cur)
+            cur.execute("LOCK TABLE productos IN ACCESS EXCLUSIVE MODE")
+            cur.execute("CREATE TEMP TABLE ids_previos ON COMMIT DROP AS SELECT id FROM productos")
+            # El trigger del árbol se apaga durante la carga: reconstruirlo al final es mucho más barato
+            cur.execute("ALTER TABLE productos DISABLE TRIGGER productos_merkle")
+            cur.execute("TRUNCATE productos")
+            if tipo == formato.TIPO_COLUMNAS:
+                for bloque in formato.leer_bloques(flujo):
+                    execute_values(cur, f"INSERT INTO productos ({', '.join(COLUMNAS_PRODUCTO)}) VALUES %s",
+                                   formato.decodificar(bloque, formato.ESQUEMA_PRODUCTO), page_size=BULK_PAGINA)
+            else:
+                cur.copy_expert(f"COPY productos ({', '.join(COLUMNAS_PRODUCTO)}) FROM STDIN WITH (FORMAT binary)", flujo)
+            cur.execute("ALTER TABLE productos ENABLE TRIGGER productos_merkle")
+            cur.execute("DELETE FROM merkle")
+            cur.execute(f"""
+                INSERT INTO merkle (hoja, hash, filas)
+                SELECT id / {self.merkle_rango}, bit_xor(hash_producto(p)), COUNT(*) FROM productos p GROUP BY 1
+            """)
+            # La secuencia de IDs no debe quedar por debajo de las IDs cargadas
+            cur.execute("""
+                SELECT setval(pg_get_serial_sequence('productos', 'id'),
+                              GREATEST(COALESCE(MAX(id), 1), nextval(pg_get_serial_sequence('productos', 'id'))))
+                FROM productos
+            """)
+
+            # El reloj adopta el sello más nuevo del snapshot, que también llevan las lápidas
+            cur.execute("SELECT hlc, nodo FROM productos ORDER BY hlc DESC, nodo DESC LIMIT 1")
+            reloj = self.avanzar_reloj(reloj, [cur.fetchone()], local=False)
+            cur.execute("""
+                INSERT INTO cambios (producto_id, eliminado, hlc, nodo)
+                SELECT id, TRUE, %s, %s FROM ids_previos
+                WHERE NOT EXISTS (SELECT 1 FROM productos p WHERE p.id = ids_previos.id)
+            """, reloj)
+            lapidas = cur.rowcount
+            cur.execute("""
+                INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                     hlc, nodo)
+                SELECT id, FALSE, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo
+                FROM productos ORDER BY id
+            """)
+            filas = cur.rowcount
+            if lapidas or filas:
+                self.registrar_cambios(cur, reloj)
+        return filas, lapidas
@@ -0,0 +1,554 @@
+"""Almacén embebido sobre SQLite en modo WAL, para clústeres locales y benchmarks sin PostgreSQL.
+
+Cada servidor usa su propio archivo. WAL permite lecturas concurrentes con una escritura; las escrituras
+toman el lock de escritura al empezar (BEGIN IMMEDIATE), así que las secuencias del log se confirman en
+orden igual que en PostgreSQL. Los precios se guardan en centavos y las fechas como texto ISO 8601, que
+ordena igual que la fecha. El árbol de Merkle se calcula al consultarlo con el mismo hash que PostgreSQL,
+así que las réplicas de ambos almacenes se pueden comparar entre sí.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+import json
+import sqlite3
+import threading
+import time
+import formato
+import trazas
+from almacen import (Almacen, AlmacenNoDisponibleError, StockInsuficienteError, COLUMNAS_CAMBIO, COLUMNAS_PRODUCTO,
+                     escapar_like, hash_producto)
+
+SELECT_PRODUCTOS = f"SELECT {', '.join(COLUMNAS_PRODUCTO)} FROM productos"
+EN_IDS = "IN (SELECT value FROM json_each(?))"  # Lista de IDs como un solo parámetro JSON
+
+# Condición SQL de cada filtro de GET /productos (ver server.filtros_productos)
+CONDICIONES = {
+    "prefijo": "nombre GLOB ?",
+    "buscar": "nombre LIKE ? ESCAPE '\\'",  # LIKE de SQLite no distingue mayúsculas (solo en ASCII)
+    "after": "id > ?",
+    "before": "id < ?",
+    "precio_min": "precio >= ?",
+    "precio_max": "precio <= ?",
+    "cantidad_min": "cantidad >= ?",
+    "cantidad_max": "cantidad <= ?",
+    "modificado_desde": "ultima_modificacion >= ?",
+}
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS productos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nombre TEXT NOT NULL,
+    descripcion TEXT,
+    cantidad INTEGER NOT NULL DEFAULT 0,
+    precio INTEGER NOT NULL DEFAULT 0,
+    ultima_modificacion TEXT,
+    hlc INTEGER NOT NULL DEFAULT 0,
+    nodo TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS productos_nombre ON productos (nombre);
+CREATE INDEX IF NOT EXISTS productos_precio ON productos (precio);
+CREATE INDEX IF NOT EXISTS productos_cantidad ON productos (cantidad);
+CREATE INDEX IF NOT EXISTS productos_ultima_modificacion ON productos (ultima_modificacion);
+CREATE TABLE IF NOT EXISTS sincronizacion (
+    servidor TEXT PRIMARY KEY,
+    ultimo_cambio TEXT NOT NULL,
+    hlc INTEGER NOT NULL DEFAULT 0,
+    nodo TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS cambios (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    producto_id INTEGER NOT NULL,
+    eliminado INTEGER NOT NULL DEFAULT 0,
+    nombre TEXT,
+    descripcion TEXT,
+    cantidad INTEGER,
+    precio INTEGER,
+    ultima_modificacion TEXT,
+    delta INTEGER,
+    hlc INTEGER NOT NULL DEFAULT 0,
+    nodo TEXT NOT NULL DEFAULT ''
+);
+"""
+# Columnas agregadas después de la primera versión del esquema, para las bases ya creadas
+COLUMNAS_NUEVAS = [(tabla, columna, definicion) for tabla in ("productos", "sincronizacion", "cambios")
+                   for columna, definicion in (("hlc", "INTEGER NOT NULL DEFAULT 0"), ("nodo", "TEXT NOT NULL DEFAULT ''"))]
+
+def centavos(precio):
+    """Precio como entero de centavos, redondeado como NUMERIC(10,2)."""
+    if precio is None:
+        return None
+    return int(Decimal(str(precio)).quantize(Decimal("0.01"), ROUND_HALF_UP).scaleb(2))
+
+def texto_fecha(fecha):
+    return fecha.isoformat(sep=" ", timespec="microseconds")
+
+def producto(fila):
+    """Fila de productos con el precio en Decimal y la fecha en datetime, como la entrega PostgreSQL."""
+    producto_id, nombre, descripcion, cantidad, precio, fecha, hlc, nodo = fila
+    return (producto_id, nombre, descripcion, cantidad, Decimal(precio).scaleb(-2),
+            datetime.fromisoformat(fecha) if fecha else None, hlc, nodo)
+
+def cambio(fila):
+    seq, producto_id, eliminado, nombre, descripcion, cantidad, precio, fecha, delta, hlc, nodo = fila
+    return (seq, producto_id, bool(eliminado), nombre, descripcion, cantidad,
+            Decimal(precio).scaleb(-2) if precio is not None else None,
+            datetime.fromisoformat(fecha) if fecha else None, delta, hlc, nodo)
+
+def escapar_glob(texto):
+    """Escapa los comodines de GLOB para buscar el texto literal."""
+    return texto.replace("[", "[[]").replace("*", "[*]").replace("?", "[?]")
+
+class ConexionMedida(sqlite3.Connection):
+    """Conexión cuyas sentencias son tramos "sql <SENTENCIA>" dentro de una solicitud trazada."""
+
+    def execute(self, sql, *args):
+        with trazas.tramo(f"sql {sql.lstrip()[:6].upper()}"):
+            return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        with trazas.tramo(f"sql {sql.lstrip()[:6].upper()}"):
+            return super().executemany(sql, *args)
+
+class XorHashes:
+    """Agregado de SQLite equivalente a bit_xor() de PostgreSQL."""
+
+    def __init__(self):
+        self.valor = 0
+
+    def step(self, valor):
+        self.valor ^= valor
+
+    def finalize(self):
+        return self.valor
+
+def hash_fila(producto_id, nombre, descripcion, cantidad, precio):
+    return hash_producto(producto_id, nombre, descripcion, cantidad, Decimal(precio).scaleb(-2))
+
+class SuscripcionSqlite:
+    """Espera a que avance la secuencia del log. Las escrituras de este proceso despiertan al instante; las de
+    otros procesos sobre el mismo archivo se notan a más tardar en `sondeo` segundos."""
+
+    def __init__(self, almacen, seq):
+        self.almacen = almacen
+        self.seq = seq
+
+    def esperar(self, timeout):
+        limite = time.monotonic() + timeout
+        while True:
+            actual = self.almacen.version()
+            if actual > self.seq:
+                self.seq = actual
+                return [actual]
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return []
+            with self.almacen.aviso:
+                self.almacen.aviso.wait(min(restante, self.almacen.sondeo))
+
+    def cerrar(self):
+        pass
+
+class AlmacenSqlite(Almacen):
+    """Almacén embebido en un archivo SQLite."""
+    nombre = "sqlite"
+    formatos_snapshot = (formato.TIPO_COLUMNAS,)
+
+    def __init__(self, ruta, servidor, merkle_rango, timeout=5, sondeo=0.5, tanda=500):
+        self.ruta = ruta
+        self.servidor = servidor
+        self.merkle_rango = merkle_rango
+        self.timeout = timeout
+        self.sondeo = sondeo
+        self.tanda = tanda
+        self.aviso = threading.Condition()  # Se notifica tras cada escritura confirmada en este proceso
+        self._lock = threading.Lock()
+        self._libres = []
+        self._abiertas = 0
+        self._en_uso = 0
+
+    def conectar(self):
+        conn = sqlite3.connect(self.ruta, timeout=self.timeout, isolation_level=None, check_same_thread=False,
+                               factory=ConexionMedida)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # En WAL, un corte de luz puede perder las últimas escrituras pero no corromper
+        conn.create_function("hash_producto", 5, hash_fila, deterministic=True)
+        conn.create_aggregate("bit_xor", 1, XorHashes)
+        return conn
+
+    def iniciar(self):
+        conn = self.conectar()
+        try:
+            conn.executescript(ESQUEMA)
+            # Varios procesos del mismo servidor pueden iniciar a la vez: la migración toma el lock de escritura
+            conn.execute("BEGIN IMMEDIATE")
+            for tabla, columna, definicion in COLUMNAS_NUEVAS:
+                if columna not in {fila[1] for fila in conn.execute(f"PRAGMA table_info({tabla})")}:
+                    conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return f"💾 Almacén SQLite (WAL) listo en {self.ruta}"
+
+    def estadisticas(self):
+        with self._lock:
+            return {"ruta": self.ruta, "abiertas": self._abiertas, "en_uso": self._en_uso, "libres": len(self._libres)}
+
+    @contextmanager
+    def transaccion(self, escritura=False):
+        """Entrega una conexión en una transacción; confirma al salir o revierte si hubo un error.
+
+        Con `escritura` toma el lock de escritura al empezar en vez de al primer cambio, para no fallar a la mitad.
+        """
+        with self._lock:
+            conn = self._libres.pop() if self._libres else None
+            if conn is None:
+                self._abiertas += 1
+            self._en_uso += 1
+        try:
+            with trazas.tramo("conectar_bd"):
+                if conn is None:
+                    conn = self.conectar()
+                conn.execute("BEGIN IMMEDIATE" if escritura else "BEGIN")
+        except sqlite3.OperationalError as e:
+            self._liberar(conn, descartar=True)
+            raise AlmacenNoDisponibleError(f"Base de datos SQLite ocupada: {e}") from e
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:  # Incluye GeneratorExit cuando se corta una respuesta transmitida
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            self._liberar(conn)
+        if escritura:
+            with self.aviso:
+                self.aviso.notify_all()
+
+    def _liberar(self, conn, descartar=False):
+        with self._lock:
+            self._en_uso -= 1
+            if descartar or conn is None:
+                self._abiertas -= 1
+            else:
+                self._libres.append(conn)
+        if descartar and conn is not None:
+            conn.close()
+
+    def leer_reloj(self, conn):
+        """Sello (hlc, nodo) de la fila de sincronización de este servidor. Las escrituras ya tienen el lock de
+        escritura (BEGIN IMMEDIATE), así que nadie más lo avanza hasta el commit."""
+        fila = conn.execute("SELECT hlc, nodo FROM sincronizacion WHERE servidor = ?", (self.servidor,)).fetchone()
+        return tuple(fila) if fila else (0, "")
+
+    def registrar_cambios(self, conn, ahora, reloj, actualizados=(), eliminados=(), ajustes=()):
+        """Guarda el reloj en la tabla de sincronización y los cambios en el log, dentro de la transacción de la
+        escritura. `eliminados` son tripletas (ID, hlc, nodo); las demás entradas llevan el sello de su fila."""
+        with trazas.tramo("registrar_cambios"):
+            conn.execute("""
+                INSERT INTO sincronizacion (servidor, ultimo_cambio, hlc, nodo) VALUES (?, ?, ?, ?)
+                ON CONFLICT (servidor) DO UPDATE
+                SET ultimo_cambio = excluded.ultimo_cambio, hlc = excluded.hlc, nodo = excluded.nodo
+            """, (self.servidor, ahora, *reloj))
+            if eliminados:
+                conn.executemany("INSERT INTO cambios (producto_id, eliminado, hlc, nodo) VALUES (?, 1, ?, ?)",
+                                 list(eliminados))
+            if actualizados:
+                conn.execute(f"""
+                    INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                         hlc, nodo)
+                    SELECT id, 0, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo
+                    FROM productos WHERE id {EN_IDS} ORDER BY id
+                """, (json.dumps(list(actualizados)),))
+            if ajustes:
+                self.registrar_ajustes(conn, sorted(ajustes))
+
+    def registrar_ajustes(self, conn, ajustes):
+        """Copia al log los ajustes [(ID, delta)] con la fila como quedó, incluido su sello."""
+        conn.executemany("""
+            INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                 delta, hlc, nodo)
+            SELECT id, 0, nombre, descripcion, cantidad, precio, ultima_modificacion, ?, hlc, nodo
+            FROM productos WHERE id = ?
+        """, [(delta, producto_id) for producto_id, delta in ajustes])
+
+    def version(self):
+        with self.transaccion() as conn:
+            return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+
+    def guardar_producto(self, datos, producto_id=None):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.avanzar_reloj(self.leer_reloj(conn))
+            valores = (datos["nombre"], datos["descripcion"], datos["cantidad"], centavos(datos["precio"]), ahora, *reloj)
+            if producto_id is not None:
+                conn.execute("""
+                    INSERT INTO productos (id, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE
+                    SET nombre=excluded.nombre, descripcion=excluded.descripcion, cantidad=excluded.cantidad,
+                        precio=excluded.precio, ultima_modificacion=excluded.ultima_modificacion,
+                        hlc=excluded.hlc, nodo=excluded.nodo
+                """, (producto_id, *valores))
+            else:
+                producto_id = conn.execute("""
+                    INSERT INTO productos (nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, valores).lastrowid
+            self.registrar_cambios(conn, ahora, reloj, actualizados=[producto_id])
+        return producto_id
+
+    def actualizar_producto(self, producto_id, datos):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.avanzar_reloj(self.leer_reloj(conn))
+            cur = conn.execute("""
+                UPDATE productos SET nombre=?, descripcion=?, cantidad=?, precio=?, ultima_modificacion=?, hlc=?, nodo=?
+                WHERE id=?
+            """, (datos.get("nombre"), datos.get("descripcion"), datos.get("cantidad"), centavos(datos.get("precio")),
+                  ahora, *reloj, producto_id))
+            if cur.rowcount == 0:
+                return False
+            self.registrar_cambios(conn, ahora, reloj, actualizados=[producto_id])
+        return True
+
+    def eliminar_producto(self, producto_id):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.avanzar_reloj(self.leer_reloj(conn))
+            if conn.execute("DELETE FROM productos WHERE id=?", (producto_id,)).rowcount == 0:
+                return False
+            self.registrar_cambios(conn, ahora, reloj, eliminados=[(producto_id, *reloj)])
+        return True
+
+    def aplicar_lote(self, upserts, nuevos, eliminaciones, ajustes):
+        ahora = texto_fecha(datetime.now())
+        insertados = {}
+        ids_nuevos = []
+        eliminados = []
+        estados_ajustes = []
+        omitidos = []
+        with self.transaccion(escritura=True) as conn:
+            recibidos = [fila[5] for fila in upserts] + [sello for _, sello in eliminaciones] + [a[2] for a in ajustes]
+            reloj = self.avanzar_reloj(self.leer_reloj(conn), recibidos, bool(nuevos) or None in recibidos)
+            ids = [fila[0] for fila in upserts] + [pid for pid, _ in eliminaciones] + [a[0] for a in ajustes]
+            # Sello actual de las filas que ya existen: lo replicado más viejo que la fila se omite
+            sellos = {pid: (hlc, nodo) for pid, hlc, nodo in conn.execute(
+                f"SELECT id, hlc, nodo FROM productos WHERE id {EN_IDS}", (json.dumps(ids),))} if ids else {}
+
+            filas = []
+            for pid, nombre, descripcion, cantidad, precio, sello in upserts:
+                sello = tuple(sello) if sello else reloj
+                if pid in sellos and sello < sellos[pid]:
+                    omitidos.append(pid)
+                    continue
+                filas.append((pid, nombre, descripcion, cantidad, centavos(precio), ahora, *sello))
+                insertados[pid] = pid not in sellos
+            conn.executemany("""
+                INSERT INTO productos (id, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE
+                SET nombre=excluded.nombre, descripcion=excluded.descripcion, cantidad=excluded.cantidad,
+                    precio=excluded.precio, ultima_modificacion=excluded.ultima_modificacion,
+                    hlc=excluded.hlc, nodo=excluded.nodo
+            """, filas)
+
+            for nombre, descripcion, cantidad, precio in nuevos:
+                ids_nuevos.append(conn.execute("""
+                    INSERT INTO productos (nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (nombre, descripcion, cantidad, centavos(precio), ahora, *reloj)).lastrowid)
+
+            for pid, sello in eliminaciones:
+                sello = tuple(sello) if sello else reloj
+                if pid not in sellos:
+                    continue
+                if sello < sellos[pid]:
+                    omitidos.append(pid)
+                    continue
+                conn.execute("DELETE FROM productos WHERE id = ?", (pid,))
+                eliminados.append((pid, *sello))
+
+            for pid, delta, sello in ajustes:
+                sello = tuple(sello) if sello else reloj
+                if pid not in sellos:
+                    estados_ajustes.append("no_encontrado")
+                    continue
+                # Un ajuste replicado que la fila ya tiene (mismo sello o anterior) no se vuelve a sumar
+                if sello <= sellos[pid]:
+                    estados_ajustes.append("omitido")
+                    continue
+                conn.execute("""
+                    UPDATE productos SET cantidad = cantidad + ?, ultima_modificacion = ?, hlc = ?, nodo = ?
+                    WHERE id = ?
+                """, (delta, ahora, *sello, pid))
+                # Cada ajuste va al log con la fila y el sello que dejó, antes de aplicar el siguiente de la misma ID
+                self.registrar_ajustes(conn, [(pid, delta)])
+                sellos[pid] = sello
+                estados_ajustes.append("ajustado")
+
+            if insertados or ids_nuevos or eliminados or "ajustado" in estados_ajustes:
+                self.registrar_cambios(conn, ahora, reloj, actualizados=list(insertados) + ids_nuevos,
+                                       eliminados=eliminados)
+        return insertados, ids_nuevos, [fila[0] for fila in eliminados], estados_ajustes, omitidos
+
+    def reservar_ids(self, cantidad):
+        with self.transaccion(escritura=True) as conn:
+            # AUTOINCREMENT nunca reutiliza una ID por debajo de la guardada en sqlite_sequence
+            base = conn.execute("""
+                SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'productos'), 0),
+                           COALESCE((SELECT MAX(id) FROM productos), 0))
+            """).fetchone()[0]
+            if conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'productos'", (base + cantidad,)).rowcount == 0:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('productos', ?)", (base + cantidad,))
+        return list(range(base + 1, base + cantidad + 1))
+
+    def _consulta_productos(self, filtros, orden, descendente, limite):
+        condiciones = []
+        params = []
+        for filtro, valor in filtros.items():
+            if filtro == "prefijo":
+                valor = escapar_glob(valor) + "*"
+            elif filtro == "buscar":
+                valor = "%" + escapar_like(valor) + "%"
+            elif filtro in ("precio_min", "precio_max"):
+                valor = centavos(valor)
+            elif filtro == "modificado_desde":
+                valor = texto_fecha(valor)
+            condiciones.append(CONDICIONES[filtro])
+            params.append(valor)
+        sql = SELECT_PRODUCTOS
+        if condiciones:
+            sql += " WHERE " + " AND ".join(condiciones)
+        direccion = " DESC" if descendente else ""
+        sql += f" ORDER BY {orden}{direccion}" + (f", id{direccion}" if orden != "id" else "")
+        if limite is not None:
+            sql += " LIMIT ?"
+            params.append(limite)
+        return sql, params
+
+    def listar_productos(self, filtros, orden, descendente, limite):
+        with self.transaccion() as conn:
+            return [producto(fila) for fila in conn.execute(*self._consulta_productos(filtros, orden, descendente, limite))]
+
+    def transmitir_productos(self, filtros, orden, descendente, limite, tanda):
+        with self.transaccion() as conn:
+            cur = conn.execute(*self._consulta_productos(filtros, orden, descendente, limite))
+            while True:
+                filas = cur.fetchmany(tanda)
+                if not filas:
+                    return
+                yield [producto(fila) for fila in filas]
+
+    def obtener_productos(self, ids):
+        with self.transaccion() as conn:
+            return [producto(fila) for fila in conn.execute(f"{SELECT_PRODUCTOS} WHERE id {EN_IDS}", (json.dumps(list(ids)),))]
+
+    def ajustar_stock(self, producto_id, delta, minimo):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.avanzar_reloj(self.leer_reloj(conn))
+            fila = conn.execute("""
+                UPDATE productos SET cantidad = cantidad + ?, ultima_modificacion = ?, hlc = ?, nodo = ?
+                WHERE id = ? AND (? IS NULL OR cantidad + ? >= ?)
+                RETURNING cantidad
+            """, (delta, ahora, *reloj, producto_id, minimo, delta, minimo)).fetchone()
+            if fila is None:
+                actual = conn.execute("SELECT cantidad FROM productos WHERE id = ?", (producto_id,)).fetchone()
+                return False, actual[0] if actual else None
+            self.registrar_cambios(conn, ahora, reloj, ajustes=[(producto_id, delta)])
+        return True, fila[0]
+
+    def reservar_stock(self, deltas, minimos):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.avanzar_reloj(self.leer_reloj(conn))
+            filas = []
+            for pid, delta in sorted(deltas.items()):
+                fila = conn.execute("""
+                    UPDATE productos SET cantidad = cantidad + ?, ultima_modificacion = ?, hlc = ?, nodo = ?
+                    WHERE id = ? AND (? IS NULL OR cantidad + ? >= ?)
+                    RETURNING id, cantidad
+                """, (delta, ahora, *reloj, pid, minimos.get(pid), delta, minimos.get(pid))).fetchone()
+                if fila is not None:
+                    filas.append(fila)
+            if len(filas) < len(deltas):
+                aplicados = {pid for pid, _ in filas}
+                pendientes = [pid for pid in deltas if pid not in aplicados]
+                actuales = dict(conn.execute(f"SELECT id, cantidad FROM productos WHERE id {EN_IDS}",
+                                             (json.dumps(pendientes),)).fetchall())
+                # Las cantidades de los ajustes ya aplicados se revierten con la transacción
+                raise StockInsuficienteError([
+                    {"id": pid, "cantidad": actuales.get(pid), "delta": deltas[pid], "minimo": minimos.get(pid)}
+                    for pid in pendientes])
+            self.registrar_cambios(conn, ahora, reloj, ajustes=list(deltas.items()))
+        return filas
+
+    def ultimo_cambio(self):
+        with self.transaccion() as conn:
+            resultado = conn.execute("SELECT servidor, ultimo_cambio, hlc, nodo FROM sincronizacion WHERE servidor = ?",
+                                     (self.servidor,)).fetchone()
+            ultimo_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+        if resultado:
+            resultado = (resultado[0], datetime.fromisoformat(resultado[1]), resultado[2], resultado[3])
+        return resultado, ultimo_seq
+
+    def cambios(self, desde, limite):
+        with self.transaccion() as conn:
+            ultimo_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+            filas = conn.execute(f"SELECT {', '.join(COLUMNAS_CAMBIO)} FROM cambios WHERE seq > ? ORDER BY seq LIMIT ?",
+                                 (desde, limite)).fetchall()
+        return ultimo_seq, [cambio(fila) for fila in filas]
+
+    def suscribir(self):
+        return SuscripcionSqlite(self, self.version())
+
+    def merkle(self, desde, hasta, ancho):
+        with self.transaccion() as conn:
+            filas = conn.execute("""
+                SELECT (id / ? - ?) / ? AS parte, bit_xor(hash_producto(id, nombre, descripcion, cantidad, precio)), COUNT(*)
+                FROM productos WHERE id BETWEEN ? AND ? GROUP BY parte
+            """, (self.merkle_rango, desde, ancho, desde * self.merkle_rango,
+                  (hasta + 1) * self.merkle_rango - 1)).fetchall()
+        return {parte: (hash_, filas_) for parte, hash_, filas_ in filas}
+
+    def exportar_snapshot(self, tipo):
+        """En WAL, la transacción de lectura ve la base tal como estaba en su primera consulta."""
+        with self.transaccion() as conn:
+            yield conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0]
+            cur = conn.execute(f"{SELECT_PRODUCTOS} ORDER BY id")
+            while True:
+                filas = cur.fetchmany(self.tanda)
+                if not filas:
+                    return
+                yield formato.codificar([producto(fila) for fila in filas], formato.ESQUEMA_PRODUCTO)
+
+    def cargar_snapshot(self, flujo, tipo):
+        ahora = texto_fecha(datetime.now())
+        with self.transaccion(escritura=True) as conn:
+            reloj = self.leer_reloj(conn)
+            conn.execute("DROP TABLE IF EXISTS temp.ids_previos")
+            conn.execute("CREATE TEMP TABLE ids_previos AS SELECT id FROM productos")
+            conn.execute("DELETE FROM productos")
+            for bloque in formato.leer_bloques(flujo):
+                conn.executemany(f"INSERT INTO productos ({', '.join(COLUMNAS_PRODUCTO)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(pid, nombre, descripcion, cantidad, centavos(precio), texto_fecha(fecha) if fecha else ahora,
+                                   hlc or 0, nodo or "")
+                                  for pid, nombre, descripcion, cantidad, precio, fecha, hlc, nodo
+                                  in formato.decodificar(bloque, formato.ESQUEMA_PRODUCTO)])
+            # El reloj adopta el sello más nuevo del snapshot, que también llevan las lápidas
+            reloj = self.avanzar_reloj(reloj, [conn.execute(
+                "SELECT hlc, nodo FROM productos ORDER BY hlc DESC, nodo DESC LIMIT 1").fetchone()], local=False)
+            lapidas = conn.execute("""
+                INSERT INTO cambios (producto_id, eliminado, hlc, nodo)
+                SELECT id, 1, ?, ? FROM ids_previos WHERE id NOT IN (SELECT id FROM productos)
+            """, reloj).rowcount
+            filas = conn.execute("""
+                INSERT INTO cambios (producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion,
+                                     hlc, nodo)
+                SELECT id, 0, nombre, descripcion, cantidad, precio, ultima_modificacion, hlc, nodo FROM productos ORDER BY id
+            """).rowcount
+            conn.execute("DROP TABLE temp.ids_previos")
+            if lapidas or filas:
+                self.registrar_cambios(conn, ahora, reloj)
+        return filas, lapidas
@@ -0,0 +1,124 @@
+"""Caché en memoria de filas de productos por ID para las lecturas puntuales de server.py.
+
+Es una LRU acotada en la que cada fila además vence a los CACHE_PRODUCTOS_TTL segundos. server.py invalida
+las IDs que toca cada escritura, local o replicada, y antes de las lecturas las que aparecen en el log de
+cambios desde la última versión vista: así se ven también las escrituras de otro proceso del mismo servidor
+(otro worker con produccion.py), con un retraso de a lo sumo CACHE_PRODUCTOS_VERIFICACION milisegundos, que
+es cada cuánto se consulta la versión. El vencimiento acota lo que tarda en verse SQL directo en la base.
+"""
+import collections
+import threading
+import time
+
+class CacheProductos:
+    """Caché LRU con vencimiento de filas de productos por ID.
+
+    Cada invalidación avanza una generación. Quien lee del almacén toma la generación antes de la consulta y
+    la pasa a guardar(): si hubo una escritura en medio, la fila leída puede ser vieja y no se guarda.
+    Solo se guardan productos existentes, así que crear uno no deja una ausencia guardada.
+    """
+
+    def __init__(self, maximo, ttl, verificacion=0):
+        self.maximo = maximo
+        self.ttl = ttl
+        self.verificacion = verificacion  # Segundos mínimos entre consultas de la versión del log
+        self._proxima_verificacion = 0.0
+        self._lock = threading.Lock()
+        self._entradas = collections.OrderedDict()  # {id: (vencimiento, fila)}
+        self._generacion = 0
+        self._version = None  # Última secuencia del log de cambios ya aplicada a la caché
+        self._aciertos = 0
+        self._fallos = 0
+        self._vencidas = 0
+        self._desalojos = 0
+        self._invalidaciones = 0
+
+    def generacion(self):
+        with self._lock:
+            return self._generacion
+
+    def ponerse_al_dia(self, obtener_version, ids_cambiadas):
+        """Invalida las filas que cambiaron en el log de cambios desde la última versión vista hasta la actual.
+
+        `obtener_version()` retorna la última secuencia del log; se llama a lo sumo una vez cada `verificacion`
+        segundos, y entre medio no se hace nada. `ids_cambiadas(desde, hasta)` retorna las IDs de ese tramo
+        del log, o None para vaciar la caché.
+        """
+        if self.maximo <= 0:
+            return
+        ahora = time.monotonic()
+        with self._lock:
+            if ahora < self._proxima_verificacion:
+                return
+            self._proxima_verificacion = ahora + self.verificacion
+            vista = self._version
+        version = obtener_version()
+        if vista == version:
+            return
+        # Sin versión previa, o si el log retrocedió (otra base), no se sabe qué cambió
+        self.invalidar(ids_cambiadas(vista, version) if vista is not None and vista < version else None)
+        with self._lock:
+            if self._version == vista:
+                self._version = version
+
+    def obtener(self, ids):
+        """Retorna {id: fila} de las IDs que están en la caché y no vencieron."""
+        if self.maximo <= 0:
+            return {}
+        encontradas = {}
+        ahora = time.monotonic()
+        with self._lock:
+            for producto_id in ids:
+                entrada = self._entradas.get(producto_id)
+                if entrada is not None and entrada[0] <= ahora:
+                    del self._entradas[producto_id]
+                    self._vencidas += 1
+                    entrada = None
+                if entrada is None:
+                    self._fallos += 1
+                    continue
+                self._entradas.move_to_end(producto_id)
+                self._aciertos += 1
+                encontradas[producto_id] = entrada[1]
+        return encontradas
+
+    def guardar(self, filas, generacion):
+        """Guarda filas leídas del almacén, salvo que alguna escritura haya invalidado la caché desde `generacion`."""
+        if self.maximo <= 0:
+            return
+        vencimiento = time.monotonic() + self.ttl
+        with self._lock:
+            if generacion != self._generacion:
+                return
+            for fila in filas:
+                self._entradas[fila[0]] = (vencimiento, fila)
+                self._entradas.move_to_end(fila[0])
+            while len(self._entradas) > self.maximo:
+                self._entradas.popitem(last=False)
+                self._desalojos += 1
+
+    def invalidar(self, ids=None):
+        """Descarta las filas de esas IDs, o todas si no se indican."""
+        with self._lock:
+            self._generacion += 1
+            self._invalidaciones += 1
+            if ids is None:
+                self._entradas.clear()
+            else:
+                for producto_id in ids:
+                    self._entradas.pop(producto_id, None)
+
+    def estadisticas(self):
+        with self._lock:
+            consultas = self._aciertos + self._fallos
+            return {
+                "entradas": len(self._entradas),
+                "maximo": self.maximo,
+                "ttl_s": self.ttl,
+                "aciertos": self._aciertos,
+                "fallos": self._fallos,
+                "tasa_aciertos": round(self._aciertos / consultas, 4) if consultas else None,
+                "vencidas": self._vencidas,
+                "desalojos": self._desalojos,
+                "invalidaciones": self._invalidaciones,
+            }
@@ -1,14 +1,33 @@
 import argparse
+import json
+import random
+import subprocess
+import sys
+import threading
 import requests
 import time
 
 BASE_URL = "http://localhost:4000/productos"  # Ahora apunta al módulo de replicación
 
+# Última lista de productos recibida y su ETag, para no volver a descargarla si no cambió
+ultima_lista = {"etag": None, "productos": None}
+
+def obtener_lista(timeout=None):
+    """ GET condicional de la lista de productos: si el servidor responde 304 se reutiliza la última recibida. """
+    headers = {"If-None-Match": ultima_lista["etag"]} if ultima_lista["etag"] else {}
+    response = requests.get(BASE_URL, headers=headers, timeout=timeout)
+    if response.status_code == 304:
+        return response, ultima_lista["productos"]
+    productos = response.json()
+    if response.status_code == 200 and "ETag" in response.headers:
+        ultima_lista.update(etag=response.headers["ETag"], productos=productos)
+    return response, productos
+
 def verificar_conexion():
     """ Verifica si el módulo de replicación está disponible antes de iniciar. """
     try:
-        response = requests.get(BASE_URL, timeout=5)
-        if response.status_code == 200:
+        response, _ = obtener_lista(timeout=5)
+        if response.status_code in (200, 304):
             print("✅ Conexión con el servidor establecida.\n")
             return True
     except requests.RequestException:
@@ -33,7 +52,14 @@ def manejar_excepcion(func):
 
 @manejar_excepcion
 def obtener_productos():
-    response = requests.get(BASE_URL)
+    _, productos = obtener_lista()
+    print(productos)
+
+@manejar_excepcion
+def buscar_productos(args):
+    """ Lista solo los productos que cumplen los filtros; el filtrado se hace en la base de datos. """
+    params = {clave: valor for clave, valor in vars(args).items() if valor}
+    response = requests.get(BASE_URL, params=params)
     print(response.json())
 
 @manejar_excepcion
@@ -77,9 +103,10 @@ def menu():
         print("2️⃣ Crear un producto")
         print("3️⃣ Actualizar un producto")
         print("4️⃣ Eliminar un producto")
-        print("5️⃣ Salir")
+        print("5️⃣ Buscar productos")
+        print("6️⃣ Salir")
 
-        opcion = input("Selecciona una opción (1-5): ").strip()
+        opcion = input("Selecciona una opción (1-6): ").strip()
 
         if not verificar_conexion():
             print("❌ Se perdió la conexión con el servidor. Cerrando el cliente.")
@@ -137,12 +164,340 @@ def menu():
             eliminar_producto(args)
 
         elif opcion == "5":
+            print("\n🔎 Buscando productos... (Deja vacío un filtro para no usarlo, 'salir' para cancelar)\n")
+            buscar = input_con_salida("Texto en el nombre: ")
+            if buscar is None: continue
+
+            precio_min = input_con_salida("Precio mínimo: ")
+            if precio_min is None: continue
+
+            precio_max = input_con_salida("Precio máximo: ")
+            if precio_max is None: continue
+
+            orden = input_con_salida("Ordenar por (id, nombre, precio, cantidad; '-' delante para descendente): ")
+            if orden is None: continue
+
+            limit = input_con_salida("Máximo de resultados: ")
+            if limit is None: continue
+
+            args = argparse.Namespace(
+                buscar=buscar,
+                precio_min=precio_min,
+                precio_max=precio_max,
+                orden=orden,
+                limit=limit
+            )
+            buscar_productos(args)
+
+        elif opcion == "6":
             print("👋 Saliendo...")
             break
         else:
             print("❌ Opción inválida, intenta de nuevo.")
 
+# 📊 Modo benchmark, sin menú: python cliente.py benchmark --concurrencia 16 --duracion 30 --json resultado.json
+
+OPERACIONES = ("lectura", "creacion", "actualizacion", "eliminacion")
+MEZCLA_DEFECTO = "lectura=80,creacion=5,actualizacion=10,eliminacion=5"
+PAGINA_LECTURA = 50  # Productos por lectura paginada
+PERCENTILES = (50, 95, 99)
+
+def percentil(valores, p):
+    """Percentil por rango más cercano de una lista ya ordenada."""
+    if not valores:
+        return None
+    return valores[min(len(valores) - 1, max(0, -(-p * len(valores) // 100) - 1))]
+
+def leer_mezcla(texto):
+    """Convierte 'lectura=80,creacion=5,...' en {operación: peso}."""
+    mezcla = {}
+    for parte in texto.split(","):
+        operacion, _, peso = parte.partition("=")
+        operacion = operacion.strip()
+        if operacion not in OPERACIONES:
+            raise argparse.ArgumentTypeError(f"Operación desconocida: {operacion} (se acepta {', '.join(OPERACIONES)})")
+        try:
+            mezcla[operacion] = float(peso)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Peso inválido para {operacion}: {peso}")
+    if sum(mezcla.values()) <= 0:
+        raise argparse.ArgumentTypeError("La mezcla necesita al menos un peso positivo")
+    return mezcla
+
+class Resultados:
+    """Latencias y resultados por operación, más una línea de tiempo por segundo para ver el efecto de una caída."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {operacion: [] for operacion in OPERACIONES}
+        self.errores = {operacion: {} for operacion in OPERACIONES}  # {operación: {motivo: cantidad}}
+        self.linea_tiempo = {}  # {segundo: [exitosas, errores]}
+
+    def registrar(self, operacion, segundo, latencia, error=None):
+        with self._lock:
+            if error is None:
+                self.latencias[operacion].append(latencia)
+            else:
+                self.errores[operacion][error] = self.errores[operacion].get(error, 0) + 1
+            contadores = self.linea_tiempo.setdefault(segundo, [0, 0])
+            contadores[error is not None] += 1
+
+    def resumen(self, duracion):
+        operaciones = {}
+        for operacion in OPERACIONES:
+            latencias = sorted(self.latencias[operacion])
+            errores = sum(self.errores[operacion].values())
+            total = len(latencias) + errores
+            if not total:
+                continue
+            operaciones[operacion] = {
+                "total": total,
+                "exitosas": len(latencias),
+                "errores": errores,
+                "tasa_error": round(errores / total, 4),
+                "motivos_error": dict(self.errores[operacion]),
+                "por_segundo": round(total / duracion, 2),
+                **{f"p{p}_ms": round(1000 * percentil(latencias, p), 3) if latencias else None for p in PERCENTILES},
+            }
+        total = sum(info["total"] for info in operaciones.values())
+        errores = sum(info["errores"] for info in operaciones.values())
+        return {
+            "total": total,
+            "errores": errores,
+            "tasa_error": round(errores / total, 4) if total else 0.0,
+            "por_segundo": round(total / duracion, 2),
+            "operaciones": operaciones,
+            "linea_tiempo": [{"segundo": segundo, "exitosas": ok, "errores": mal}
+                             for segundo, (ok, mal) in sorted(self.linea_tiempo.items())],
+        }
+
+class IdsConocidos:
+    """IDs de productos existentes que los hilos comparten para actualizar y eliminar."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []
+
+    def agregar(self, producto_id):
+        with self._lock:
+            self._ids.append(producto_id)
+
+    def elegir(self, rng, quitar=False):
+        with self._lock:
+            if not self._ids:
+                return None
+            i = rng.randrange(len(self._ids))
+            if not quitar:
+                return self._ids[i]
+            # Se reemplaza por el último para quitar en O(1)
+            self._ids[i], self._ids[-1] = self._ids[-1], self._ids[i]
+            return self._ids.pop()
+
+    def maximo(self):
+        with self._lock:
+            return max(self._ids, default=0)
+
+def producto_aleatorio(rng):
+    return {"nombre": f"bench-{rng.randrange(10**9)}", "descripcion": "Producto de benchmark",
+            "cantidad": rng.randrange(1000), "precio": round(rng.uniform(1, 1000), 2)}
+
+def ejecutar_operacion(sesion, url, operacion, ids, rng, timeout):
+    """Ejecuta una operación y retorna None si salió bien o el motivo del error."""
+    if operacion == "lectura":
+        after = rng.randrange(max(1, ids.maximo()))
+        response = sesion.get(f"{url}/productos", params={"limit": PAGINA_LECTURA, "after": after}, timeout=timeout)
+    elif operacion == "creacion":
+        response = sesion.post(f"{url}/productos", json=producto_aleatorio(rng), timeout=timeout)
+        if response.status_code in (201, 202) and response.headers.get("Content-Type", "").startswith("application/json"):
+            producto_id = response.json().get("id")
+            if producto_id is not None:
+                ids.agregar(producto_id)
+    else:
+        producto_id = ids.elegir(rng, quitar=operacion == "eliminacion")
+        if producto_id is None:
+            return "sin_ids"
+        if operacion == "actualizacion":
+            response = sesion.put(f"{url}/productos/{producto_id}", json=producto_aleatorio(rng), timeout=timeout)
+        else:
+            response = sesion.delete(f"{url}/productos/{producto_id}", timeout=timeout)
+    if response.status_code >= 400:
+        return f"http_{response.status_code}"
+    return None
+
+def trabajador(url, mezcla, ids, resultados, inicio, fin, semilla, timeout):
+    rng = random.Random(semilla)
+    operaciones, pesos = zip(*mezcla.items())
+    sesion = requests.Session()  # Conexiones keep-alive propias del hilo
+    while time.monotonic() < fin:
+        operacion = rng.choices(operaciones, pesos)[0]
+        t0 = time.monotonic()
+        try:
+            error = ejecutar_operacion(sesion, url, operacion, ids, rng, timeout)
+        except requests.Timeout:
+            error = "timeout"
+        except requests.RequestException:
+            error = "conexion"
+        t1 = time.monotonic()
+        if error != "sin_ids":
+            resultados.registrar(operacion, int(t0 - inicio), t1 - t0, error)
+
+def cargar_datos(url, cantidad, concurrencia, ids, timeout):
+    """Crea el conjunto inicial de productos a través del proxy, en paralelo."""
+    siguiente = iter(range(cantidad))
+    lock = threading.Lock()
+    fallidos = [0]
+
+    def crear():
+        rng = random.Random()
+        sesion = requests.Session()
+        while True:
+            with lock:
+                if next(siguiente, None) is None:
+                    return
+            try:
+                response = sesion.post(f"{url}/productos", json=producto_aleatorio(rng), timeout=timeout)
+                producto_id = response.json().get("id") if response.status_code in (201, 202) else None
+            except (requests.RequestException, ValueError):
+                producto_id = None
+            if producto_id is None:
+                with lock:
+                    fallidos[0] += 1
+            else:
+                ids.agregar(producto_id)
+
+    hilos = [threading.Thread(target=crear) for _ in range(concurrencia)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    return fallidos[0]
+
+def estado_replicas(url, timeout):
+    """Estado de los servidores según el proxy (/servidores), o None si no responde."""
+    try:
+        response = requests.get(f"{url}/servidores", timeout=timeout)
+        return response.json() if response.status_code == 200 else None
+    except (requests.RequestException, ValueError):
+        return None
+
+def esperar_convergencia(url, maximo, timeout):
+    """Espera a que todas las réplicas sanas tengan retraso 0. Retorna los segundos que tardó, o None."""
+    inicio = time.monotonic()
+    while time.monotonic() - inicio < maximo:
+        estado = estado_replicas(url, timeout)
+        if estado:
+            sanas = [info for info in estado.get("servidores", {}).values() if info.get("sano")]
+            if sanas and all(info.get("retraso") == 0 for info in sanas):
+                return round(time.monotonic() - inicio, 3)
+        time.sleep(0.2)
+    return None
+
+def simular_caida(comando, en, inicio, info):
+    """Ejecuta el comando que tira un backend (p. ej. 'kill $(cat cluster_local/local2.pid)') a los `en` segundos."""
+    time.sleep(max(0, inicio + en - time.monotonic()))
+    info["instante_s"] = round(time.monotonic() - inicio, 3)
+    proceso = subprocess.run(comando, shell=True, capture_output=True, text=True)
+    info["codigo_salida"] = proceso.returncode
+    print(f"💥 Caída simulada a los {info['instante_s']}s: {comando} (código {proceso.returncode})")
+
+def analizar_caida(info, linea_tiempo):
+    """Completa el escenario de caída con los errores posteriores y cuánto tardó en dejar de fallar."""
+    segundo_caida = int(info["instante_s"])
+    posteriores = [punto for punto in linea_tiempo if punto["segundo"] >= segundo_caida]
+    con_errores = [punto["segundo"] for punto in posteriores if punto["errores"]]
+    info["errores_tras_caida"] = sum(punto["errores"] for punto in posteriores)
+    # Segundos desde la caída hasta el último segundo con errores (0 si el proxy la absorbió sin fallar)
+    info["recuperacion_s"] = con_errores[-1] + 1 - info["instante_s"] if con_errores else 0.0
+    info["recuperacion_s"] = round(info["recuperacion_s"], 3)
+
+def imprimir_resumen(resultado):
+    print(f"\n📊 {resultado['total']} operaciones en {resultado['duracion_s']}s: {resultado['por_segundo']} op/s, "
+          f"{100 * resultado['tasa_error']:.2f}% con error")
+    print(f"{'operación':<14}{'total':>8}{'op/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'error %':>9}")
+    for operacion, info in resultado["operaciones"].items():
+        latencias = "".join(f"{info[f'p{p}_ms']:>10}" if info[f"p{p}_ms"] is not None else f"{'-':>10}"
+                            for p in PERCENTILES)
+        print(f"{operacion:<14}{info['total']:>8}{info['por_segundo']:>10}{latencias}{100 * info['tasa_error']:>8.2f}%")
+        if info["motivos_error"]:
+            print(f"{'':<14}errores: {', '.join(f'{motivo}={n}' for motivo, n in info['motivos_error'].items())}")
+    caida = resultado.get("caida")
+    if caida:
+        print(f"💥 Caída a los {caida['instante_s']}s: {caida['errores_tras_caida']} errores después, "
+              f"recuperación en {caida['recuperacion_s']}s")
+    if "convergencia_s" in resultado:
+        convergencia = resultado["convergencia_s"]
+        print(f"🔄 Réplicas al día {convergencia}s después de terminar la carga" if convergencia is not None
+              else "⚠️ Las réplicas no quedaron al día dentro del tiempo máximo")
+
+def benchmark(argv):
+    parser = argparse.ArgumentParser(prog="cliente.py benchmark",
+                                     description="Genera carga contra el proxy y mide rendimiento y latencias.")
+    parser.add_argument("--url", default=BASE_URL.rsplit("/productos", 1)[0], help="URL del proxy (por defecto %(default)s)")
+    parser.add_argument("--concurrencia", type=int, default=8, help="Hilos que envían solicitudes en paralelo")
+    parser.add_argument("--duracion", type=float, default=30, help="Segundos de carga")
+    parser.add_argument("--mezcla", type=leer_mezcla, default=MEZCLA_DEFECTO,
+                        help=f"Pesos por operación (por defecto {MEZCLA_DEFECTO})")
+    parser.add_argument("--productos", type=int, default=1000, help="Productos a crear antes de medir (0: no cargar)")
+    parser.add_argument("--timeout", type=float, default=10, help="Tiempo de espera de cada solicitud")
+    parser.add_argument("--semilla", type=int, help="Semilla para repetir la misma secuencia de operaciones")
+    parser.add_argument("--json", help="Archivo donde guardar el resultado completo en JSON")
+    parser.add_argument("--caida", help="Comando que tira un backend a mitad de la prueba")
+    parser.add_argument("--caida-en", type=float, help="Segundo en que se ejecuta --caida (por defecto, la mitad)")
+    parser.add_argument("--convergencia-max", type=float, default=60,
+                        help="Segundos máximos esperando a que las réplicas queden al día (0: no esperar)")
+    args = parser.parse_args(argv)
+    if isinstance(args.mezcla, str):
+        args.mezcla = leer_mezcla(args.mezcla)
+
+    ids = IdsConocidos()
+    if args.productos:
+        print(f"📦 Creando {args.productos} productos...")
+        t0 = time.monotonic()
+        fallidos = cargar_datos(args.url, args.productos, args.concurrencia, ids, args.timeout)
+        print(f"📦 Carga inicial en {time.monotonic() - t0:.1f}s ({fallidos} fallidos)")
+        if args.convergencia_max:
+            esperar_convergencia(args.url, args.convergencia_max, args.timeout)
+
+    print(f"🚀 {args.concurrencia} hilos durante {args.duracion}s, mezcla "
+          f"{', '.join(f'{op}={peso:g}' for op, peso in args.mezcla.items())}")
+    resultados = Resultados()
+    semilla = args.semilla if args.semilla is not None else random.randrange(2**32)
+    inicio = time.monotonic()
+    fin = inicio + args.duracion
+    hilos = [threading.Thread(target=trabajador, args=(args.url, args.mezcla, ids, resultados, inicio, fin,
+                                                        semilla + i, args.timeout))
+             for i in range(args.concurrencia)]
+    caida = {}
+    if args.caida:
+        hilos.append(threading.Thread(target=simular_caida, args=(
+            args.caida, args.caida_en if args.caida_en is not None else args.duracion / 2, inicio, caida)))
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    duracion = time.monotonic() - inicio
+
+    resultado = {"configuracion": {"url": args.url, "concurrencia": args.concurrencia, "duracion": args.duracion,
+                                   "mezcla": args.mezcla, "productos": args.productos, "semilla": semilla,
+                                   "caida": args.caida},
+                 "duracion_s": round(duracion, 3), **resultados.resumen(duracion)}
+    if caida:
+        analizar_caida(caida, resultado["linea_tiempo"])
+        resultado["caida"] = caida
+    if args.convergencia_max:
+        resultado["convergencia_s"] = esperar_convergencia(args.url, args.convergencia_max, args.timeout)
+    resultado["servidores"] = estado_replicas(args.url, args.timeout)
+
+    imprimir_resumen(resultado)
+    if args.json:
+        with open(args.json, "w") as archivo:
+            json.dump(resultado, archivo, indent=2)
+        print(f"💾 Resultado guardado en {args.json}")
+    return 1 if resultado["total"] == 0 else 0
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        sys.exit(benchmark(sys.argv[2:]))
     print("🔄 Verificando conexión con el servidor...")
     if verificar_conexion():
         menu()
@@ -33,6 +33,88 @@ CREATE TABLE IF NOT EXISTS sincronizacion (
 );
 """)
 
+# 🔎 Índices para los filtros de GET /productos: trigramas para buscar una subcadena del nombre, patrón para
+# el prefijo y B-tree para los rangos y el orden por precio, cantidad y fecha de modificación
+cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+cur.execute("CREATE INDEX IF NOT EXISTS productos_nombre_trgm ON productos USING GIN (nombre gin_trgm_ops);")
+cur.execute("CREATE INDEX IF NOT EXISTS productos_nombre_prefijo ON productos (nombre text_pattern_ops);")
+for columna in ("precio", "cantidad", "ultima_modificacion"):
+    cur.execute(f"CREATE INDEX IF NOT EXISTS productos_{columna} ON productos ({columna});")
+
+# Log de cambios append-only: una entrada por escritura, con lápida (eliminado=TRUE) para los borrados
+cur.execute("""
+CREATE TABLE IF NOT EXISTS cambios (
+    seq BIGSERIAL PRIMARY KEY,
+    producto_id INT NOT NULL,
+    eliminado BOOLEAN NOT NULL DEFAULT FALSE,
+    nombre VARCHAR(255),
+    descripcion TEXT,
+    cantidad INT,
+    precio NUMERIC(10,2),
+    ultima_modificacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    delta INT
+);
+""")
+
+# Ajuste de stock que produjo la entrada (NULL si fue una escritura de la fila completa)
+cur.execute("ALTER TABLE cambios ADD COLUMN IF NOT EXISTS delta INT;")
+
+# 🕰️ Sello (reloj lógico híbrido, nodo) de la escritura que produjo cada versión: en las filas, en el log y, en
+# sincronizacion, el más nuevo que escribió o recibió cada servidor. Las réplicas comparan versiones con él.
+for tabla in ("productos", "cambios", "sincronizacion"):
+    cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS hlc BIGINT NOT NULL DEFAULT 0;")
+    cur.execute(f"ALTER TABLE {tabla} ADD COLUMN IF NOT EXISTS nodo VARCHAR(255) NOT NULL DEFAULT '';")
+
+# 🌳 Árbol de Merkle sobre rangos de IDs: cada hoja cubre MERKLE_RANGO IDs y guarda el XOR de los hashes
+# de sus filas. Un trigger lo mantiene al día en cada escritura, así que comparar réplicas no requiere leer la tabla.
+MERKLE_RANGO = 1024  # Debe coincidir con MERKLE_RANGO en server.py
+
+cur.execute("""
+CREATE TABLE IF NOT EXISTS merkle (
+    hoja INT PRIMARY KEY,
+    hash BIGINT NOT NULL DEFAULT 0,
+    filas INT NOT NULL DEFAULT 0
+);
+""")
+
+# Hash de 64 bits del contenido de un producto (sin ultima_modificacion, que difiere entre réplicas)
+cur.execute("""
+CREATE OR REPLACE FUNCTION hash_producto(p productos) RETURNS BIGINT AS $$
+    SELECT ('x' || substr(md5(concat_ws('|', p.id, quote_nullable(p.nombre), quote_nullable(p.descripcion),
+                                        p.cantidad, p.precio)), 1, 16))::bit(64)::bigint
+$$ LANGUAGE SQL IMMUTABLE;
+""")
+
+cur.execute(f"""
+CREATE OR REPLACE FUNCTION merkle_actualizar() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO merkle (hoja, hash, filas) VALUES (OLD.id / {MERKLE_RANGO}, hash_producto(OLD), -1)
+        ON CONFLICT (hoja) DO UPDATE SET hash = merkle.hash # EXCLUDED.hash, filas = merkle.filas + EXCLUDED.filas;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO merkle (hoja, hash, filas) VALUES (NEW.id / {MERKLE_RANGO}, hash_producto(NEW), 1)
+        ON CONFLICT (hoja) DO UPDATE SET hash = merkle.hash # EXCLUDED.hash, filas = merkle.filas + EXCLUDED.filas;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+""")
+
+cur.execute("DROP TRIGGER IF EXISTS productos_merkle ON productos;")
+cur.execute("""
+CREATE TRIGGER productos_merkle AFTER INSERT OR UPDATE OR DELETE ON productos
+FOR EACH ROW EXECUTE FUNCTION merkle_actualizar();
+""")
+
+# Reconstruir el árbol desde la tabla, bloqueando escrituras mientras tanto
+cur.execute("LOCK TABLE productos IN SHARE MODE;")
+cur.execute("DELETE FROM merkle;")
+cur.execute(f"""
+INSERT INTO merkle (hoja, hash, filas)
+SELECT id / {MERKLE_RANGO}, bit_xor(hash_producto(p)), COUNT(*) FROM productos p GROUP BY 1;
+""")
+
 # Guardar cambios y cerrar conexión
 conn.commit()
 cur.close()
@@ -0,0 +1,194 @@
+"""Formato compacto por columnas y compresión gzip negociada, para server.py y replicacion.py.
+
+Un bloque lleva N filas con un esquema conocido por ambos lados, guardadas columna por columna: los
+enteros, precios (en centavos) y fechas (en microsegundos) como arreglos de int64 y los textos como
+longitudes más un solo buffer UTF-8. Codificar y decodificar es una pasada de `array` por columna en
+vez de un objeto JSON por fila, y el resultado comprime mucho mejor con gzip.
+"""
+from array import array
+from datetime import datetime, timedelta
+from decimal import Decimal
+from flask import request
+import gzip
+import os
+import struct
+import sys
+import zlib
+
+TIPO_COLUMNAS = "application/x-columnas"  # Content-Type de los cuerpos en formato por columnas
+COMPRESION_MIN = int(os.getenv("COMPRESION_MIN", "1024"))  # Bytes desde los que se comprime una respuesta
+COMPRESION_NIVEL = int(os.getenv("COMPRESION_NIVEL", "1"))  # Nivel de gzip: 1 cuesta poca CPU y ya reduce mucho
+
+# Tipos de columna: entero, booleano, texto, precio (NUMERIC(10,2)) y fecha (TIMESTAMP sin zona)
+ENTERO, BOOLEANO, TEXTO, PRECIO, FECHA = "i", "b", "t", "p", "f"
+
+# Las filas y las operaciones replicadas terminan con su sello (hlc, nodo); en /productos/bulk es nulo si la
+# operación es local y el servidor debe sellarla
+ESQUEMA_PRODUCTO = (ENTERO, TEXTO, TEXTO, ENTERO, PRECIO, FECHA, ENTERO, TEXTO)  # Columnas de GET /productos
+ESQUEMA_CAMBIO = (ENTERO, ENTERO, BOOLEANO, TEXTO, TEXTO, ENTERO, PRECIO, FECHA, ENTERO, ENTERO, TEXTO)  # Columnas de GET /cambios
+ESQUEMA_UPSERT = (ENTERO, TEXTO, TEXTO, ENTERO, PRECIO, ENTERO, TEXTO)  # UPSERTs de POST /productos/bulk
+ESQUEMA_ELIMINACION = (ENTERO, ENTERO, TEXTO)  # Eliminaciones de POST /productos/bulk
+ESQUEMA_AJUSTE = (ENTERO, ENTERO, ENTERO, TEXTO)  # Ajustes de stock (ID, delta y sello) de POST /productos/bulk
+
+EPOCA = datetime(1970, 1, 1)
+CABECERA = struct.Struct("<II")  # Longitud del bloque en bytes y cantidad de filas
+
+def _enteros(valores):
+    datos = array("q", valores)
+    if sys.byteorder == "big":
+        datos.byteswap()
+    return datos.tobytes()
+
+def _leer_enteros(vista, pos, n):
+    datos = array("q")
+    datos.frombytes(vista[pos:pos + 8 * n])
+    if sys.byteorder == "big":
+        datos.byteswap()
+    return datos, pos + 8 * n
+
+def _a_entero(tipo, valor):
+    if tipo == PRECIO:
+        return round(valor * 100)
+    if tipo == FECHA:
+        return (valor - EPOCA) // timedelta(microseconds=1)
+    return int(valor)
+
+def _de_entero(tipo, valor):
+    if tipo == PRECIO:
+        return Decimal(valor).scaleb(-2)
+    if tipo == FECHA:
+        return EPOCA + timedelta(microseconds=valor)
+    return valor
+
+def codificar(filas, esquema):
+    """Codifica una lista de filas (tuplas con las columnas del esquema) en un bloque por columnas.
+
+    Cada columna va precedida de un byte que indica si trae un mapa de nulos (un byte por fila).
+    """
+    partes = []
+    for columna, tipo in enumerate(esquema):
+        valores = [fila[columna] for fila in filas]
+        nulos = bytes(valor is None for valor in valores)
+        if any(nulos):
+            partes += [b"\x01", nulos]
+        else:
+            partes.append(b"\x00")
+        if tipo == TEXTO:
+            textos = [valor.encode() if valor is not None else b"" for valor in valores]
+            partes += [_enteros(len(texto) for texto in textos), b"".join(textos)]
+        elif tipo == BOOLEANO:
+            partes.append(bytes(bool(valor) for valor in valores))
+        else:
+            partes.append(_enteros(_a_entero(tipo, valor) if valor is not None else 0 for valor in valores))
+    cuerpo = b"".join(partes)
+    return CABECERA.pack(len(cuerpo), len(filas)) + cuerpo
+
+def decodificar(bloque, esquema):
+    """Decodifica un bloque (filas, bytes) de separar_bloques o leer_bloques; retorna la lista de tuplas."""
+    n, vista = bloque
+    pos = 0
+    columnas = []
+    for tipo in esquema:
+        nulos = None
+        if vista[pos]:
+            nulos = vista[pos + 1:pos + 1 + n]
+            pos += n
+        pos += 1
+        if tipo == TEXTO:
+            longitudes, pos = _leer_enteros(vista, pos, n)
+            valores = []
+            for longitud in longitudes:
+                valores.append(str(vista[pos:pos + longitud], "utf-8"))
+                pos += longitud
+        elif tipo == BOOLEANO:
+            valores = [bool(b) for b in vista[pos:pos + n]]
+            pos += n
+        else:
+            valores, pos = _leer_enteros(vista, pos, n)
+            valores = valores.tolist() if tipo == ENTERO else [_de_entero(tipo, valor) for valor in valores]
+        if nulos is not None:
+            valores = [None if nulo else valor for valor, nulo in zip(valores, nulos)]
+        columnas.append(valores)
+    return list(zip(*columnas))
+
+def separar_bloques(datos):
+    """Itera los bloques (filas, bytes) de un cuerpo ya leído completo."""
+    vista = memoryview(datos)
+    pos = 0
+    while pos < len(vista):
+        longitud, n = CABECERA.unpack_from(vista, pos)
+        pos += CABECERA.size
+        yield n, vista[pos:pos + longitud]
+        pos += longitud
+
+def _leer_exacto(archivo, cantidad):
+    datos = b""
+    while len(datos) < cantidad:
+        fragmento = archivo.read(cantidad - len(datos))
+        if not fragmento:
+            break
+        datos += fragmento
+    return datos
+
+def leer_bloques(archivo):
+    """Itera los bloques (filas, bytes) de un flujo con método read(), a medida que llegan."""
+    while True:
+        cabecera = _leer_exacto(archivo, CABECERA.size)
+        if not cabecera:
+            return
+        if len(cabecera) < CABECERA.size:
+            raise ValueError("Bloque por columnas truncado")
+        longitud, n = CABECERA.unpack(cabecera)
+        cuerpo = _leer_exacto(archivo, longitud)
+        if len(cuerpo) < longitud:
+            raise ValueError("Bloque por columnas truncado")
+        yield n, memoryview(cuerpo)
+
+def acepta_columnas():
+    """Indica si el cliente pidió la respuesta en el formato por columnas."""
+    return TIPO_COLUMNAS in request.headers.get("Accept", "")
+
+def cuerpo_solicitud():
+    """Cuerpo de la solicitud actual, descomprimido si llegó con Content-Encoding: gzip."""
+    datos = request.get_data()
+    if request.headers.get("Content-Encoding") == "gzip":
+        datos = gzip.decompress(datos)
+    return datos
+
+def _comprimir_flujo(fragmentos):
+    compresor = zlib.compressobj(COMPRESION_NIVEL, zlib.DEFLATED, 31)  # wbits 31: formato gzip
+    try:
+        for fragmento in fragmentos:
+            if isinstance(fragmento, str):
+                fragmento = fragmento.encode()
+            # Se vacía el compresor en cada fragmento para que un flujo lento (p. ej. /eventos) no se retrase
+            datos = compresor.compress(fragmento) + compresor.flush(zlib.Z_SYNC_FLUSH)
+            if datos:
+                yield datos
+        yield compresor.flush()
+    finally:
+        # Si el cliente se desconecta, el generador original libera su conexión de inmediato
+        if hasattr(fragmentos, "close"):
+            fragmentos.close()
+
+def comprimir_respuestas(app):
+    """Comprime con gzip las respuestas de la app cuando el cliente lo acepta.
+
+    Las respuestas transmitidas se comprimen fragmento a fragmento; las demás, solo desde COMPRESION_MIN bytes.
+    """
+    @app.after_request
+    def _comprimir(response):
+        if (response.status_code != 200 or "Content-Encoding" in response.headers or response.direct_passthrough
+                or "gzip" not in request.headers.get("Accept-Encoding", "")):
+            return response
+        if response.is_streamed:
+            response.response = _comprimir_flujo(response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            datos = response.get_data()
+            if len(datos) < COMPRESION_MIN:
+                return response
+            response.set_data(gzip.compress(datos, COMPRESION_NIVEL))
+        response.headers["Content-Encoding"] = "gzip"
+        response.vary.add("Accept-Encoding")
+        return response
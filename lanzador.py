@@ -0,0 +1,116 @@
+"""Levanta un clúster local con un solo comando: N servidores con almacén SQLite y el replicador.
+
+Cada servidor usa su propio archivo en la carpeta de datos, así que no hace falta PostgreSQL ni Docker.
+Las demás variables de entorno (MODO_LECTURA, MODO_FRAGMENTADO, ...) pasan tal cual a los procesos.
+Cada proceso deja su PID en <datos>/<nombre>.pid, para poder tirar uno a mano o desde
+`cliente.py benchmark --caida "kill $(cat cluster_local/local2.pid)"`. Ctrl+C detiene todo el clúster.
+
+    python lanzador.py -n 3
+"""
+import argparse
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+import requests
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+ESPERA_INICIO = 15  # Segundos máximos para que un servidor empiece a responder
+ESPERA_CIERRE = 5  # Segundos de gracia para que un proceso termine antes de matarlo
+
+def iniciar_proceso(script, entorno, archivo_pid):
+    proceso = subprocess.Popen([sys.executable, os.path.join(DIRECTORIO, script)], env={**os.environ, **entorno},
+                               cwd=DIRECTORIO)
+    with open(archivo_pid, "w") as archivo:
+        archivo.write(str(proceso.pid))
+    return proceso
+
+def esperar_servidor(url, proceso):
+    """Espera a que el servidor responda en /ultimo_cambio. Retorna False si terminó o no respondió a tiempo."""
+    limite = time.monotonic() + ESPERA_INICIO
+    while time.monotonic() < limite and proceso.poll() is None:
+        try:
+            if requests.get(f"{url}/ultimo_cambio", timeout=1).status_code == 200:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+def detener(procesos):
+    for _, proceso in procesos:
+        if proceso.poll() is None:
+            proceso.terminate()
+    limite = time.monotonic() + ESPERA_CIERRE
+    for nombre, proceso in procesos:
+        try:
+            proceso.wait(max(0, limite - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            print(f"⚠️ {nombre} no terminó a tiempo, forzando el cierre")
+            proceso.kill()
+
+def main():
+    parser = argparse.ArgumentParser(description="Levanta N servidores con SQLite y el replicador en esta máquina.")
+    parser.add_argument("-n", "--servidores", type=int, default=3, help="Cantidad de servidores (por defecto 3)")
+    parser.add_argument("--puerto", type=int, default=5000, help="Puerto del primer servidor; los demás siguen en orden")
+    parser.add_argument("--datos", default="cluster_local", help="Carpeta de las bases SQLite y la cola del replicador")
+    parser.add_argument("--limpiar", action="store_true", help="Borra los datos de una ejecución anterior")
+    parser.add_argument("--sin-replicador", action="store_true", help="Levanta solo los servidores")
+    args = parser.parse_args()
+
+    datos = os.path.abspath(args.datos)
+    if args.limpiar and os.path.isdir(datos):
+        shutil.rmtree(datos)
+    os.makedirs(datos, exist_ok=True)
+
+    # Un SIGTERM (p. ej. de un script de benchmark) también detiene a los procesos hijos
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    procesos = []
+    urls = []
+    try:
+        for i in range(args.servidores):
+            nombre = f"local{i + 1}"
+            puerto = args.puerto + i
+            proceso = iniciar_proceso("server.py", {
+                "ALMACEN": "sqlite",
+                "SQLITE_RUTA": os.path.join(datos, f"{nombre}.db"),
+                "SERVER_NAME": nombre,
+                "PORT": str(puerto),
+            }, os.path.join(datos, f"{nombre}.pid"))
+            procesos.append((nombre, proceso))
+            urls.append(f"http://localhost:{puerto}")
+
+        for (nombre, proceso), url in zip(procesos, urls):
+            if not esperar_servidor(url, proceso):
+                print(f"❌ {nombre} no respondió en {url}")
+                return 1
+        print(f"✅ {len(urls)} servidores listos: {', '.join(urls)}")
+
+        if not args.sin_replicador:
+            procesos.append(("replicador", iniciar_proceso("replicacion.py", {
+                "SERVIDORES": ",".join(urls),
+                "COLA_RUTA": os.path.join(datos, "cola_escrituras.db"),
+            }, os.path.join(datos, "replicador.pid"))))
+            print("✅ Replicador iniciado en http://localhost:4000")
+
+        # Un servidor caído no detiene al resto (así se prueban las caídas); el replicador sí
+        vivos = {nombre for nombre, _ in procesos}
+        while True:
+            for nombre, proceso in procesos:
+                if nombre in vivos and proceso.poll() is not None:
+                    vivos.discard(nombre)
+                    print(f"⚠️ {nombre} terminó con código {proceso.returncode}")
+                    if nombre == "replicador" or not vivos:
+                        print("❌ Deteniendo el clúster")
+                        return 1
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("\n🛑 Deteniendo el clúster...")
+        return 0
+    finally:
+        detener(procesos)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Métricas en formato de texto de Prometheus para server.py y replicacion.py.
+
+Cada métrica guarda sus valores en memoria con un lock propio; registrar una observación es una
+búsqueda binaria y una suma, así que la instrumentación puede quedar activa en producción.
+"""
+from flask import Response, g, request
+import bisect
+import threading
+import time
+
+# Límites (en segundos) de los buckets de los histogramas de latencia
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def formatear_etiquetas(nombres, valores, extra=""):
+    pares = [f'{nombre}="{str(valor)}"' for nombre, valor in zip(nombres, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+class Registro:
+    """Conjunto de métricas que se exponen juntas en /metrics."""
+
+    def __init__(self):
+        self._metricas = []
+
+    def agregar(self, metrica):
+        self._metricas.append(metrica)
+        return metrica
+
+    def exponer(self):
+        """Retorna todas las métricas en el formato de texto de Prometheus."""
+        lineas = []
+        for metrica in self._metricas:
+            lineas.append(f"# HELP {metrica.nombre} {metrica.ayuda}")
+            lineas.append(f"# TYPE {metrica.nombre} {metrica.tipo}")
+            lineas.extend(metrica.lineas())
+        return "\n".join(lineas) + "\n"
+
+registro = Registro()
+
+class Contador:
+    """Valor que solo aumenta, por combinación de etiquetas."""
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+        self._valores = {}
+        registro.agregar(self)
+
+    def inc(self, valor=1, **etiquetas):
+        clave = tuple(etiquetas[nombre] for nombre in self.etiquetas)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def lineas(self):
+        with self._lock:
+            valores = list(self._valores.items())
+        return [f"{self.nombre}{formatear_etiquetas(self.etiquetas, clave)} {valor}" for clave, valor in valores]
+
+class Medidor:
+    """Valor que sube y baja. Con `funcion`, se calcula al exponer: debe retornar {tupla de etiquetas: valor}."""
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.funcion = funcion
+        self._lock = threading.Lock()
+        self._valores = {}
+        registro.agregar(self)
+
+    def set(self, valor, **etiquetas):
+        clave = tuple(etiquetas[nombre] for nombre in self.etiquetas)
+        with self._lock:
+            self._valores[clave] = valor
+
+    def lineas(self):
+        if self.funcion is not None:
+            valores = list(self.funcion().items())
+        else:
+            with self._lock:
+                valores = list(self._valores.items())
+        return [f"{self.nombre}{formatear_etiquetas(self.etiquetas, clave)} {valor}"
+                for clave, valor in valores if valor is not None]
+
+class Histograma:
+    """Distribución de valores en buckets acumulativos, con suma y cantidad, por combinación de etiquetas."""
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}  # {etiquetas: [conteos por bucket (+Inf al final), suma]}
+        registro.agregar(self)
+
+    def observar(self, valor, **etiquetas):
+        clave = tuple(etiquetas[nombre] for nombre in self.etiquetas)
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * (len(self.buckets) + 1), 0.0]
+            serie[0][indice] += 1
+            serie[1] += valor
+
+    def lineas(self):
+        with self._lock:
+            series = [(clave, list(conteos), suma) for clave, (conteos, suma) in self._series.items()]
+        lineas = []
+        for clave, conteos, suma in series:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ("+Inf",), conteos):
+                acumulado += conteo
+                le = f'le="{limite}"'
+                lineas.append(f"{self.nombre}_bucket{formatear_etiquetas(self.etiquetas, clave, le)} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{formatear_etiquetas(self.etiquetas, clave)} {suma}")
+            lineas.append(f"{self.nombre}_count{formatear_etiquetas(self.etiquetas, clave)} {acumulado}")
+        return lineas
+
+solicitudes = Histograma("http_solicitud_segundos", "Duración de las solicitudes HTTP atendidas, por ruta",
+                         ("ruta", "metodo", "estado"))
+
+def instrumentar(app):
+    """Mide la duración de cada solicitud de la app y agrega la ruta /metrics."""
+    @app.before_request
+    def _iniciar_medicion():
+        g.inicio_solicitud = time.perf_counter()
+
+    @app.after_request
+    def _terminar_medicion(response):
+        inicio = g.pop("inicio_solicitud", None)
+        if inicio is not None:
+            # Se usa la regla de la ruta (p. ej. /productos/<int:id>) para no crear una serie por cada ID
+            ruta = request.url_rule.rule if request.url_rule else "sin_ruta"
+            solicitudes.observar(time.perf_counter() - inicio, ruta=ruta, metodo=request.method,
+                                 estado=response.status_code)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        """Expone las métricas en el formato de texto de Prometheus."""
+        return Response(registro.exponer(), mimetype="text/plain; version=0.0.4")
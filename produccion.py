@@ -0,0 +1,139 @@
+"""Modo de producción: sirve server.py, server2.py o replicacion.py con gunicorn en varios procesos.
+
+Cada worker importa la aplicación después del fork, así que abre sus propias conexiones (pool de la base,
+sesiones HTTP) y sus hilos (monitor, exportador de trazas); el proceso principal nunca importa la aplicación.
+Con replicacion.py, además, el proceso principal levanta un único proceso sincronizador con los hilos de
+sincronización, de /eventos y de la cola de escrituras, para que no arranquen una vez por worker.
+
+    python produccion.py server
+    python produccion.py replicacion
+
+`kill -HUP <pid del proceso principal>` recarga el código sin cortar solicitudes: levanta workers nuevos,
+deja terminar a los viejos (hasta GRACEFUL_TIMEOUT segundos) y reinicia el sincronizador.
+Las métricas, la caché y el estado del monitor son de cada worker; las marcas de agua de la replicación las
+copian del sincronizador.
+"""
+import argparse
+import fcntl
+import os
+import signal
+import subprocess
+import sys
+from gunicorn.app.base import BaseApplication
+from werkzeug.serving import make_server
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+SERVICIOS = {"server": "5000", "server2": "5002", "replicacion": "4000"}  # Puerto por defecto de cada servicio (debe coincidir con su app.run)
+TRABAJADORES = int(os.getenv("TRABAJADORES", str(os.cpu_count() or 1)))  # Procesos que atienden solicitudes
+HILOS = int(os.getenv("HILOS", "8"))  # Hilos por worker (las respuestas transmitidas y /eventos ocupan uno cada una)
+KEEPALIVE = int(os.getenv("KEEPALIVE", "30"))  # Segundos que una conexión keep-alive queda abierta esperando otra solicitud
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", "30"))  # Segundos para terminar las solicitudes en curso al recargar o detener
+TIMEOUT = int(os.getenv("TIMEOUT", "60"))  # Segundos sin señales de vida antes de reiniciar un worker
+MAX_SOLICITUDES = int(os.getenv("MAX_SOLICITUDES", "0"))  # Reinicia cada worker tras estas solicitudes (0: nunca)
+SINCRONIZADOR_LOCK = os.getenv("SINCRONIZADOR_LOCK", "sincronizador.lock")  # Archivo que impide dos sincronizadores en la máquina
+SINCRONIZADOR_PUERTO = int(os.getenv("SINCRONIZADOR_PUERTO", "4001"))  # Puerto local donde el sincronizador responde /sincronizacion
+
+class Aplicacion(BaseApplication):
+    """Aplicación de gunicorn configurada desde variables de entorno en vez de un archivo de configuración."""
+
+    def __init__(self, servicio, opciones):
+        self.servicio = servicio
+        self.opciones = opciones
+        super().__init__()
+
+    def load_config(self):
+        for clave, valor in self.opciones.items():
+            self.cfg.set(clave, valor)
+
+    def load(self):
+        # Se llama en cada worker, después del fork
+        return __import__(self.servicio).app
+
+class Sincronizador:
+    """Proceso sincronizador único de replicacion.py, lanzado y reiniciado por el proceso principal de gunicorn."""
+
+    def __init__(self):
+        self.proceso = None
+
+    def iniciar(self):
+        # Sin SINCRONIZADOR_URL: el sincronizador no debe consultarse a sí mismo (copiar_marcas_agua, /sincronizacion)
+        entorno = {clave: valor for clave, valor in os.environ.items() if clave != "SINCRONIZADOR_URL"}
+        self.proceso = subprocess.Popen([sys.executable, os.path.abspath(__file__), "sincronizador"], cwd=DIRECTORIO,
+                                        env=entorno)
+        print(f"🔁 Sincronizador iniciado (pid {self.proceso.pid})")
+
+    def detener(self):
+        if self.proceso is None or self.proceso.poll() is not None:
+            return
+        self.proceso.terminate()
+        try:
+            self.proceso.wait(GRACEFUL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print("⚠️ El sincronizador no terminó a tiempo, forzando el cierre")
+            self.proceso.kill()
+            self.proceso.wait()
+
+    def reiniciar(self):
+        self.detener()
+        self.iniciar()
+
+def ejecutar_sincronizador():
+    """Corre la sincronización de replicacion.py, con un lock para que haya una sola por máquina.
+
+    Solo atiende HTTP en localhost, para que los workers le pregunten el estado en /sincronizacion.
+    """
+    lock = open(SINCRONIZADOR_LOCK, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"❌ Ya hay un sincronizador corriendo (lock en {SINCRONIZADOR_LOCK})")
+        return 1
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    import replicacion
+    replicacion.iniciar_proceso()
+    replicacion.iniciar_sincronizacion()
+    try:
+        make_server("127.0.0.1", SINCRONIZADOR_PUERTO, replicacion.app, threaded=True).serve_forever()
+    except KeyboardInterrupt:
+        return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Sirve un servicio con gunicorn en varios procesos.")
+    parser.add_argument("servicio", choices=[*SERVICIOS, "sincronizador"])
+    args = parser.parse_args()
+    if args.servicio == "sincronizador":
+        return ejecutar_sincronizador()
+
+    servicio = args.servicio
+    puerto = SERVICIOS[servicio] if servicio == "replicacion" else os.getenv("PORT", SERVICIOS[servicio])
+
+    def post_worker_init(worker):
+        sys.modules[servicio].iniciar_proceso()
+
+    opciones = {
+        "bind": f"0.0.0.0:{puerto}",
+        "workers": TRABAJADORES,
+        "threads": HILOS,
+        "worker_class": "gthread",
+        "keepalive": KEEPALIVE,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "timeout": TIMEOUT,
+        "max_requests": MAX_SOLICITUDES,
+        "max_requests_jitter": MAX_SOLICITUDES // 10,
+        "preload_app": False,
+        "chdir": DIRECTORIO,
+        "post_worker_init": post_worker_init,
+    }
+    if servicio == "replicacion":
+        # El anillo del modo fragmentado vive en cada worker: replicacion.py necesita saber cuántos hay
+        os.environ["TRABAJADORES"] = str(TRABAJADORES)
+        os.environ["SINCRONIZADOR_URL"] = f"http://127.0.0.1:{SINCRONIZADOR_PUERTO}"
+        sincronizador = Sincronizador()
+        opciones.update(when_ready=lambda arbiter: sincronizador.iniciar(),
+                        on_reload=lambda arbiter: sincronizador.reiniciar(),
+                        on_exit=lambda arbiter: sincronizador.detener())
+    print(f"🚀 {servicio} en el puerto {puerto}: {TRABAJADORES} workers x {HILOS} hilos")
+    Aplicacion(servicio, opciones).run()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,124 +1,1961 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import bisect
+import hashlib
+import heapq
+import itertools
+from requests.adapters import HTTPAdapter
+from datetime import datetime
+from decimal import Decimal
+from werkzeug.http import parse_date, unquote_etag
+import collections
+import gzip
+import json
+import os
+import random
 import requests
+import sqlite3
 import threading
 import time
+import formato
+import metricas
+import trazas
 
 app = Flask(__name__)
+metricas.instrumentar(app)
+trazas.instrumentar(app, "replicador")
+formato.comprimir_respuestas(app)
 
-SERVIDORES = ["http://localhost:5000", "http://localhost:5001"]
-SYNC_INTERVAL = 5  # Intervalo de sincronización en segundos
+class ErrorSincronizacion(Exception):
+    """El destino rechazó parte de un lote de sincronización."""
+
+# Servidores separados por comas (el lanzador local los define con los puertos que levanta)
+SERVIDORES = os.getenv("SERVIDORES", "http://localhost:5000,http://localhost:5001").split(",")
+SYNC_INTERVAL = 5  # Segundos máximos entre revisiones de una réplica sin suscripción a /eventos
+SYNC_INTERVALO_MIN = float(os.getenv("SYNC_INTERVALO_MIN", "0.5"))  # Segundos mínimos entre revisiones de una réplica con muchos cambios
+SYNC_INTERVALO_MAX = float(os.getenv("SYNC_INTERVALO_MAX", "60"))  # Segundos máximos entre revisiones de una réplica sin cambios
+SYNC_BACKOFF_MAX = float(os.getenv("SYNC_BACKOFF_MAX", "300"))  # Espera máxima entre reintentos a una réplica caída
+SYNC_BANDA_MAX = int(os.getenv("SYNC_BANDA_MAX", "0"))  # Bytes por segundo enviados a todas las réplicas juntas (0: sin límite)
+SYNC_SUAVIZADO = 0.3  # Peso de la última muestra en la tasa de cambios de cada réplica (media móvil exponencial)
+SINCRONIZADOR_URL = os.getenv("SINCRONIZADOR_URL")  # Proceso sincronizador al que se consulta /sincronizacion (lo define produccion.py)
+EVENTOS_TIMEOUT = float(os.getenv("EVENTOS_TIMEOUT", "35"))  # Segundos sin recibir nada de /eventos antes de reconectar
+CAMBIOS_LOTE = 1000  # Entradas del log de cambios pedidas por solicitud
+BULK_LOTE = 1000  # Operaciones enviadas por solicitud a /productos/bulk
+PAGINA_MAX = 1000  # Máximo de productos por página en GET /productos?limit= (debe coincidir con server.py)
+STREAM_CHUNK = 64 * 1024  # Bytes por fragmento al retransmitir respuestas
+
+# Anti-entropía con árboles de Merkle
+MERKLE_PARTES = 16  # Subrangos pedidos al descender por un rango distinto
+MERKLE_FILAS_DIRECTO = 1000  # Con menos filas que esto en ambos lados, el rango se compara fila a fila
+MERKLE_INTERVALO = float(os.getenv("MERKLE_INTERVALO", "300"))  # Segundos entre verificaciones completas de cada réplica
+SNAPSHOT_FRACCION = float(os.getenv("SNAPSHOT_FRACCION", "0.5"))  # Diferencia de filas (fracción de la fuente) desde la que se copia un snapshot
+SNAPSHOT_TIMEOUT = float(os.getenv("SNAPSHOT_TIMEOUT", "600"))  # Segundos máximos sin datos al copiar un snapshot
+
+# Monitor de servidores en segundo plano
+MONITOR_INTERVALO = float(os.getenv("MONITOR_INTERVALO", "1"))  # Segundos entre consultas a /ultimo_cambio
+MONITOR_TTL = float(os.getenv("MONITOR_TTL", "5"))  # Segundos tras los cuales el estado de un servidor se considera vencido
+MONITOR_TIMEOUT = float(os.getenv("MONITOR_TIMEOUT", "2"))  # Tiempo de espera de cada consulta
+
+# Enrutamiento de lecturas y escrituras
+MODO_LECTURA = os.getenv("MODO_LECTURA", "lider")  # "lider": todo al más actualizado; "balanceado": reparte entre réplicas al día
+LECTURA_LAG_MAX = int(os.getenv("LECTURA_LAG_MAX", "10"))  # Cambios pendientes tolerados en una réplica para leer de ella
+PRIMARIO = os.getenv("PRIMARIO")  # Servidor que recibe las escrituras; si no se define, el más actualizado
+if PRIMARIO and PRIMARIO not in SERVIDORES:
+    raise ValueError(f"PRIMARIO={PRIMARIO} no está en SERVIDORES")
+
+# Caché de respuestas GET del proxy
+CACHE_ENTRADAS = int(os.getenv("CACHE_ENTRADAS", "256"))  # Respuestas guardadas como máximo (LRU)
+CACHE_ENTRADA_MAX = int(os.getenv("CACHE_ENTRADA_MAX", str(1024 * 1024)))  # Bytes máximos de una respuesta para guardarla
+
+# Modo fragmentado: cada producto vive solo en FACTOR_REPLICACION servidores, elegidos por hashing consistente
+MODO_FRAGMENTADO = os.getenv("MODO_FRAGMENTADO") == "1"
+NODOS_VIRTUALES = int(os.getenv("NODOS_VIRTUALES", "64"))  # Puntos de cada servidor en el anillo
+FACTOR_REPLICACION = int(os.getenv("FACTOR_REPLICACION", "2"))  # Copias de cada producto
+ASIGNADOR_IDS = os.getenv("ASIGNADOR_IDS", SERVIDORES[0])  # Servidor cuya secuencia reparte las IDs nuevas
+TRABAJADORES = int(os.getenv("TRABAJADORES", "1"))  # Workers que atienden solicitudes con produccion.py
+IDS_BLOQUE = 100  # IDs reservadas por cada consulta al asignador
+
+# Cola durable de escrituras diferidas
+ESCRITURA_DIFERIDA = os.getenv("ESCRITURA_DIFERIDA") == "1"  # Si se activa, las escrituras se encolan y se responde 202 al instante
+COLA_RUTA = os.getenv("COLA_RUTA", "cola_escrituras.db")  # Archivo SQLite de la cola
+COLA_REINTENTO_MAX = 30  # Segundos máximos entre reintentos mientras el servidor de escritura no responde
+
+# Conexiones HTTP reutilizables y concurrencia
+HTTP_POOL_MAX = int(os.getenv("HTTP_POOL_MAX", "20"))  # Conexiones keep-alive por servidor
+HILOS_CONSULTA = int(os.getenv("HILOS_CONSULTA", str(2 * len(SERVIDORES))))  # Hilos para consultas de estado en paralelo
+
+# Cortacircuitos y lecturas con cobertura
+CIRCUITO_FALLOS = int(os.getenv("CIRCUITO_FALLOS", "5"))  # Fallos seguidos que abren el circuito hacia un servidor
+CIRCUITO_ESPERA = float(os.getenv("CIRCUITO_ESPERA", "10"))  # Segundos con el circuito abierto antes de dejar pasar una sonda
+COBERTURA_PERCENTIL = float(os.getenv("COBERTURA_PERCENTIL", "95"))  # Percentil de latencia tras el que se cubre una lectura (0 la desactiva)
+COBERTURA_MUESTRAS = 1000  # Latencias recientes usadas para calcular el percentil
+COBERTURA_MUESTRAS_MIN = 20  # Sin esta cantidad de muestras no se cubre
+HILOS_LECTURA = int(os.getenv("HILOS_LECTURA", "32"))  # Hilos para las lecturas con cobertura
+
+# Marca de agua por réplica: {(fuente, destino): última secuencia del log de la fuente aplicada en el destino}
+marcas_agua = {}
+# Última verificación por árbol de Merkle: {(fuente, destino): time.monotonic()}
+ultima_verificacion = {}
+
+# Métricas del proxy y la sincronización
+metrica_upstream = metricas.Histograma("proxy_upstream_segundos",
+                                       "Tiempo hasta recibir los encabezados de cada solicitud a un servidor",
+                                       ("servidor", "metodo"))
+metrica_ciclo = metricas.Histograma("sync_ciclo_segundos", "Duración de cada sincronización de una réplica",
+                                    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+metrica_eventos = metricas.Contador("sync_eventos_recibidos_total", "Eventos recibidos por /eventos, por tipo",
+                                    ("tipo",))
+metrica_filas = metricas.Contador("sync_filas_enviadas_total", "Operaciones aplicadas en cada réplica por la sincronización",
+                                  ("servidor",))
+
+class CircuitoAbiertoError(requests.exceptions.ConnectionError):
+    """El circuito hacia un servidor está abierto: la solicitud se rechaza sin tocar la red."""
+
+class Circuito:
+    """Cortacircuitos de un servidor: cerrado, abierto tras CIRCUITO_FALLOS fallos seguidos y semiabierto
+    cuando pasa la espera, dejando pasar una sola sonda que lo cierra o lo vuelve a abrir."""
+
+    def __init__(self, fallos_max, espera):
+        self.fallos_max = fallos_max
+        self.espera = espera
+        self._lock = threading.Lock()
+        self.estado = "cerrado"
+        self._fallos = 0
+        self._abierto_en = 0.0
+
+    def permitir(self):
+        with self._lock:
+            if self.estado == "cerrado":
+                return True
+            if self.estado == "abierto" and time.monotonic() - self._abierto_en >= self.espera:
+                self.estado = "semiabierto"
+                return True  # Esta solicitud es la sonda
+            return False
+
+    def exito(self):
+        with self._lock:
+            if self.estado != "cerrado":
+                print("🟢 Circuito cerrado de nuevo")
+            self.estado = "cerrado"
+            self._fallos = 0
+
+    def fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if self.estado == "semiabierto" or (self.estado == "cerrado" and self._fallos >= self.fallos_max):
+                self.estado = "abierto"
+                self._abierto_en = time.monotonic()
+
+class SesionProtegida(requests.Session):
+    """Sesión que pasa cada solicitud por el cortacircuitos de su servidor.
+
+    Cuentan como fallo los errores de conexión, los timeouts y las respuestas 502/503/504. Dentro de una solicitud
+    trazada, cada salto al servidor es un tramo y lleva los encabezados B3 para continuar la traza allí.
+    """
+
+    def __init__(self, circuito):
+        super().__init__()
+        self.circuito = circuito
+
+    def request(self, method, url, *args, **kwargs):
+        if not self.circuito.permitir():
+            raise CircuitoAbiertoError(f"Circuito abierto hacia {url}")
+        with trazas.tramo(f"http {method}", "CLIENT", url=url) as tramo:
+            if tramo is not None:
+                kwargs["headers"] = {**(kwargs.get("headers") or {}), **trazas.cabeceras()}
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except requests.exceptions.RequestException:
+                self.circuito.fallo()
+                raise
+            if tramo is not None:
+                tramo.etiquetas["http.status_code"] = response.status_code
+        if response.status_code >= 502:
+            self.circuito.fallo()
+        else:
+            self.circuito.exito()
+        return response
+
+circuitos = {}
+
+def crear_sesion(servidor):
+    """Crea una sesión HTTP con un pool de conexiones keep-alive, cortacircuitos y medición de latencia."""
+    circuitos[servidor] = Circuito(CIRCUITO_FALLOS, CIRCUITO_ESPERA)
+    sesion = SesionProtegida(circuitos[servidor])
+    adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAX)
+    sesion.mount("http://", adaptador)
+    sesion.mount("https://", adaptador)
+    sesion.hooks["response"].append(
+        lambda response, *args, **kwargs: metrica_upstream.observar(
+            response.elapsed.total_seconds(), servidor=servidor, metodo=response.request.method))
+    return sesion
+
+# Una sesión por servidor: cada solicitud reutiliza una conexión TCP abierta en vez de abrir una nueva
+sesiones = {servidor: crear_sesion(servidor) for servidor in SERVIDORES}
+
+def sesion(servidor):
+    """Retorna la sesión HTTP con conexiones reutilizables hacia un servidor."""
+    return sesiones[servidor]
+
+ejecutor_consultas = ThreadPoolExecutor(max_workers=HILOS_CONSULTA, thread_name_prefix="consulta")
+ejecutor_lecturas = ThreadPoolExecutor(max_workers=HILOS_LECTURA, thread_name_prefix="lectura")
+
+def en_paralelo(ejecutor, funcion, servidores):
+    """Ejecuta funcion(servidor) para todos los servidores a la vez y retorna {servidor: resultado}.
+
+    El tiempo total es el del servidor más lento, no la suma. La función debe manejar sus propios errores.
+    """
+    futuros = {servidor: ejecutor.submit(trazas.en_contexto(funcion), servidor) for servidor in servidores}
+    return {servidor: futuro.result() for servidor, futuro in futuros.items()}
+
+class MonitorServidores:
+    """Sigue en segundo plano el último cambio, la salud y la latencia de cada servidor.
+
+    Las decisiones de enrutamiento leen el estado en memoria y nunca tocan la red.
+    """
+
+    def __init__(self, servidores, intervalo, ttl, timeout):
+        self.servidores = list(servidores)
+        self.intervalo = intervalo
+        self.ttl = ttl
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._estado = {
+            servidor: {"sano": False, "ultimo_cambio": None, "ultimo_seq": None, "latencia_ms": None, "verificado": None}
+            for servidor in self.servidores
+        }
+        self._lider = None
+        self._lider_verificado = 0.0
+
+    def _consultar(self, servidor):
+        """Consulta /ultimo_cambio de un servidor y retorna su nuevo estado."""
+        inicio = time.monotonic()
+        try:
+            response = sesion(servidor).get(f"{servidor}/ultimo_cambio", timeout=self.timeout)
+            latencia_ms = round(1000 * (time.monotonic() - inicio), 3)
+            if response.status_code != 200:
+                return {"sano": False, "ultimo_cambio": None, "ultimo_seq": None, "latencia_ms": latencia_ms,
+                        "verificado": time.monotonic()}
+            data = response.json()
+            ultimo_cambio = None
+            if data.get("servidor") and data.get("ultimo_cambio") != "2000-01-01T00:00:00":
+                ultimo_cambio = data["ultimo_cambio"]
+            return {"sano": True, "ultimo_cambio": ultimo_cambio, "ultimo_seq": data.get("ultimo_seq"),
+                    "sello": (data.get("hlc") or 0, data.get("nodo") or ""), "latencia_ms": latencia_ms, "verificado": time.monotonic(), "almacen": data.get("almacen", "postgres")}
+        except requests.exceptions.RequestException:
+            return {"sano": False, "ultimo_cambio": None, "ultimo_seq": None, "latencia_ms": None,
+                    "verificado": time.monotonic()}
+
+    def actualizar(self):
+        """Consulta todos los servidores en paralelo y recalcula el más actualizado."""
+        for servidor, nuevo in en_paralelo(ejecutor_consultas, self._consultar, self.servidores).items():
+            with self._lock:
+                if self._estado[servidor]["sano"] and not nuevo["sano"]:
+                    print(f"⚠️ No se pudo obtener el último cambio de {servidor}")
+                self._estado[servidor] = nuevo
+        self._recalcular_lider()
+
+    def _recalcular_lider(self):
+        """Elige el servidor sano con el sello (hlc, nodo) más nuevo.
+
+        Una réplica al día empata con el líder, porque registra el sello de lo que recibe: en un empate se
+        mantiene el líder actual, y si no está entre los empatados, el primero en orden (así un clúster
+        recién creado escribe en el primer servidor sano).
+        """
+        with self._lock:
+            ahora = time.monotonic()
+            candidatos = {
+                servidor: self._estado[servidor]["sello"] for servidor in self.servidores
+                if self._estado[servidor]["sano"] and ahora - self._estado[servidor]["verificado"] <= self.ttl
+            }
+            lider = None
+            if candidatos:
+                mas_nuevo = max(candidatos.values())
+                empatados = [servidor for servidor, sello in candidatos.items() if sello == mas_nuevo]
+                lider = self._lider if self._lider in empatados else empatados[0]
+            if lider != self._lider:
+                if lider:
+                    print(f"✅ Servidor más actualizado: {lider}")
+                else:
+                    print("❌ No hay servidores con datos en sincronización.")
+            self._lider = lider
+            self._lider_verificado = ahora
+
+    def agregar(self, servidor):
+        """Empieza a seguir un servidor nuevo."""
+        with self._lock:
+            if servidor not in self._estado:
+                self.servidores.append(servidor)
+                self._estado[servidor] = {"sano": False, "ultimo_cambio": None, "ultimo_seq": None,
+                                          "latencia_ms": None, "verificado": None}
+
+    def quitar(self, servidor):
+        """Deja de seguir un servidor."""
+        with self._lock:
+            if servidor in self._estado:
+                self.servidores.remove(servidor)
+                del self._estado[servidor]
+        self._recalcular_lider()
+
+    def marcar_caido(self, servidor):
+        """Marca un servidor como caído tras un error al reenviarle una solicitud."""
+        with self._lock:
+            if servidor in self._estado:
+                self._estado[servidor]["sano"] = False
+        self._recalcular_lider()
+
+    def lider(self):
+        """Retorna el servidor más actualizado según el último estado vigente, o None."""
+        with self._lock:
+            if time.monotonic() - self._lider_verificado > self.ttl:
+                return None
+            return self._lider
+
+    def version(self, servidor):
+        """Última secuencia del log de cambios vista en un servidor sano y vigente, o None."""
+        return self.vigentes().get(servidor)
+
+    def almacen(self, servidor):
+        """Almacén del servidor ("postgres" o "sqlite") según la última consulta exitosa, o None."""
+        with self._lock:
+            return self._estado.get(servidor, {}).get("almacen")
+
+    def vigentes(self):
+        """Retorna {servidor: última secuencia del log} de los servidores sanos con estado vigente."""
+        with self._lock:
+            ahora = time.monotonic()
+            return {
+                servidor: info["ultimo_seq"] for servidor, info in self._estado.items()
+                if info["sano"] and ahora - info["verificado"] <= self.ttl
+            }
+
+    def estado(self):
+        """Retorna una copia del estado de cada servidor, con la antigüedad de la última verificación."""
+        with self._lock:
+            ahora = time.monotonic()
+            return {
+                servidor: {
+                    "sano": info["sano"],
+                    "ultimo_cambio": info["ultimo_cambio"],
+                    "ultimo_seq": info["ultimo_seq"],
+                    "hlc": info["sello"][0] if info["sano"] else None,
+                    "nodo": info["sello"][1] if info["sano"] else None,
+                    "latencia_ms": info["latencia_ms"],
+                    "antiguedad_s": round(ahora - info["verificado"], 3) if info["verificado"] else None,
+                    "vigente": bool(info["verificado"]) and ahora - info["verificado"] <= self.ttl,
+                }
+                for servidor, info in self._estado.items()
+            }
+
+    def ejecutar(self):
+        while True:
+            self.actualizar()
+            time.sleep(self.intervalo)
+
+    def iniciar(self):
+        threading.Thread(target=self.ejecutar, daemon=True).start()
+
+monitor = MonitorServidores(SERVIDORES, MONITOR_INTERVALO, MONITOR_TTL, MONITOR_TIMEOUT)
 
 def obtener_servidor_mas_actualizado():
-    """Determina qué servidor tiene el último cambio registrado."""
-    servidores_info = {}
+    """Determina qué servidor tiene el último cambio registrado, según el monitor en segundo plano."""
+    with trazas.tramo("obtener_servidor_mas_actualizado"):
+        return monitor.lider()
+
+def servidor_escritura():
+    """Servidor que recibe las escrituras (y es fuente de la sincronización): el primario designado o el más actualizado."""
+    return PRIMARIO or obtener_servidor_mas_actualizado()
+
+class BalanceadorLecturas:
+    """Reparte lecturas eligiendo la réplica con menos solicitudes en curso; los empates se turnan."""
+
+    def __init__(self, servidores):
+        self._lock = threading.Lock()
+        # Los servidores que se agregan al anillo después empiezan en 0
+        self._en_curso = collections.defaultdict(int, {servidor: 0 for servidor in servidores})
+        self._turno = itertools.count()
+
+    def elegir(self, candidatos):
+        """Elige un servidor entre los candidatos y cuenta la solicitud como en curso hasta llamar a terminar()."""
+        with self._lock:
+            desplazamiento = next(self._turno) % len(candidatos)
+            rotados = candidatos[desplazamiento:] + candidatos[:desplazamiento]
+            servidor = min(rotados, key=self._en_curso.__getitem__)
+            self._en_curso[servidor] += 1
+            return servidor
 
+    def terminar(self, servidor):
+        with self._lock:
+            self._en_curso[servidor] = max(self._en_curso[servidor] - 1, 0)
+
+    def en_curso(self):
+        with self._lock:
+            return dict(self._en_curso)
+
+balanceador = BalanceadorLecturas(SERVIDORES)
+
+def retraso(referencia, servidor, seq_referencia):
+    """Cambios del log de la referencia que el servidor aún no recibió, o None si no se sabe."""
+    if servidor == referencia:
+        return 0
+    marca = marcas_agua.get((referencia, servidor))
+    if marca is None or seq_referencia is None:
+        return None
+    return max(0, seq_referencia - marca)
+
+def replicas_al_dia():
+    """Servidores sanos cuyo retraso respecto del servidor de escritura no supera LECTURA_LAG_MAX."""
+    referencia = servidor_escritura()
+    vigentes = monitor.vigentes()
+    if referencia not in vigentes:
+        return []
+    candidatos = []
     for servidor in SERVIDORES:
+        if servidor in vigentes:
+            atraso = retraso(referencia, servidor, vigentes[referencia])
+            if atraso is not None and atraso <= LECTURA_LAG_MAX:
+                candidatos.append(servidor)
+    return candidatos
+
+def servidor_lectura():
+    """Elige el servidor para una lectura. Quien lo use debe llamar a balanceador.terminar(servidor) al acabar."""
+    candidatos = replicas_al_dia() if MODO_LECTURA == "balanceado" else []
+    if not candidatos:
+        servidor = obtener_servidor_mas_actualizado()
+        if not servidor:
+            return None
+        candidatos = [servidor]
+    return balanceador.elegir(candidatos)
+
+class CacheRespuestas:
+    """Caché LRU de respuestas GET por (servidor, ruta), válida mientras no cambie la versión del servidor.
+
+    La versión es la última secuencia del log de cambios que ve el monitor, así que una escritura hecha
+    directamente en un servidor se nota a más tardar en MONITOR_INTERVALO; las que pasan por el proxy
+    (incluida la sincronización) invalidan la caché al instante.
+    """
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._entradas = collections.OrderedDict()
+        self._aciertos = 0
+        self._revalidadas = 0
+        self._fallos = 0
+        self._invalidaciones = 0
+
+    def obtener(self, servidor, ruta):
+        with self._lock:
+            entrada = self._entradas.get((servidor, ruta))
+            if entrada is not None:
+                self._entradas.move_to_end((servidor, ruta))
+            return entrada
+
+    def guardar(self, servidor, ruta, entrada):
+        with self._lock:
+            self._entradas[(servidor, ruta)] = entrada
+            self._entradas.move_to_end((servidor, ruta))
+            while len(self._entradas) > self.maximo:
+                self._entradas.popitem(last=False)
+
+    def contar(self, resultado):
+        """Cuenta un acierto, una revalidación (304 del servidor) o un fallo."""
+        with self._lock:
+            if resultado == "acierto":
+                self._aciertos += 1
+            elif resultado == "revalidada":
+                self._revalidadas += 1
+            else:
+                self._fallos += 1
+
+    def invalidar(self, servidor=None):
+        """Descarta las respuestas de un servidor, o todas si no se indica."""
+        with self._lock:
+            self._invalidaciones += 1
+            if servidor is None:
+                self._entradas.clear()
+            else:
+                for clave in [clave for clave in self._entradas if clave[0] == servidor]:
+                    del self._entradas[clave]
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "maximo": self.maximo,
+                "aciertos": self._aciertos,
+                "revalidadas": self._revalidadas,
+                "fallos": self._fallos,
+                "invalidaciones": self._invalidaciones,
+            }
+
+cache = CacheRespuestas(CACHE_ENTRADAS)
+
+CREAR_COLA = """
+    CREATE TABLE IF NOT EXISTS cola (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        destino TEXT NOT NULL DEFAULT '',
+        producto_id INTEGER,
+        operacion TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        encolado REAL NOT NULL,
+        UNIQUE (destino, producto_id)
+    )
+"""
+
+class ColaEscrituras:
+    """Cola durable de escrituras pendientes, en SQLite (modo WAL) para sobrevivir a reinicios del replicador.
+
+    Las operaciones sobre una misma ID se fusionan: un UPSERT o DELETE reemplaza a la pendiente y un ajuste de
+    stock se suma al delta o a la cantidad de la pendiente, como hace /productos/bulk. Las creaciones sin ID y
+    los ajustes que no se pueden sumar (sobre un DELETE pendiente) se guardan por separado y no se fusionan.
+    Cada entrada tiene una versión para no confirmar una operación que cambió mientras se reproducía.
+
+    Cada entrada va a un destino: "" es el servidor de escritura del momento; en modo fragmentado, las
+    reparaciones van al propietario en el que falló la escritura, y se fusionan por destino e ID.
+    """
+
+    def __init__(self, ruta):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(CREAR_COLA)
+        if "destino" not in {fila[1] for fila in self._conn.execute("PRAGMA table_info(cola)")}:
+            self._migrar()
+        self.hay_pendientes = threading.Event()
+        if self.estadisticas()["profundidad"]:
+            self.hay_pendientes.set()
+
+    def _migrar(self):
+        """Recrea una cola de una versión anterior (sin destino) conservando sus entradas."""
+        self._conn.execute("BEGIN IMMEDIATE")
+        self._conn.execute("ALTER TABLE cola RENAME TO cola_anterior")
+        self._conn.execute(CREAR_COLA)
+        self._conn.execute("""
+            INSERT INTO cola (seq, producto_id, operacion, version, encolado)
+            SELECT seq, producto_id, operacion, version, encolado FROM cola_anterior
+        """)
+        self._conn.execute("DROP TABLE cola_anterior")
+        self._conn.execute("COMMIT")
+
+    def encolar(self, operacion, destino=""):
+        """Guarda una operación para /productos/bulk de `destino` en disco y retorna su secuencia en la cola."""
+        producto_id = operacion.get("id")
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            if operacion.get("op") == "stock" and producto_id is not None:
+                pendiente = self._conn.execute("SELECT operacion FROM cola WHERE destino = ? AND producto_id = ?",
+                                               (destino, producto_id)).fetchone()
+                combinada = sumar_ajuste(json.loads(pendiente[0]), operacion) if pendiente else operacion
+                if combinada is None:
+                    producto_id = None  # Entrada propia, fuera de la fusión por ID
+                else:
+                    operacion = combinada
+            cur = self._conn.execute("""
+                INSERT INTO cola (destino, producto_id, operacion, encolado) VALUES (?, ?, ?, ?)
+                ON CONFLICT (destino, producto_id) DO UPDATE
+                SET operacion = excluded.operacion, version = cola.version + 1
+                RETURNING seq
+            """, (destino, producto_id, json.dumps(operacion), time.time()))
+            seq = cur.fetchone()[0]
+            self._conn.execute("COMMIT")
+        self.hay_pendientes.set()
+        return seq
+
+    def destinos(self):
+        """Destinos con entradas pendientes."""
+        with self._lock:
+            return [fila[0] for fila in self._conn.execute("SELECT DISTINCT destino FROM cola ORDER BY destino")]
+
+    def lote(self, maximo, destino=""):
+        """Retorna hasta `maximo` entradas pendientes de un destino, las más antiguas primero: [(seq, version, operacion)]."""
+        with self._lock:
+            filas = self._conn.execute("SELECT seq, version, operacion FROM cola WHERE destino = ? ORDER BY seq LIMIT ?",
+                                       (destino, maximo)).fetchall()
+        return [(seq, version, json.loads(operacion)) for seq, version, operacion in filas]
+
+    def confirmar(self, entradas):
+        """Quita de la cola las entradas ya aplicadas, salvo las que cambiaron mientras tanto.
+
+        Si a un ajuste de stock en curso se le sumaron otros, queda pendiente solo el delta que falta aplicar.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for seq, version, aplicada in entradas:
+                fila = self._conn.execute("SELECT version, operacion FROM cola WHERE seq = ?", (seq,)).fetchone()
+                if fila is None:
+                    continue
+                actual = json.loads(fila[1])
+                if fila[0] == version:
+                    self._conn.execute("DELETE FROM cola WHERE seq = ?", (seq,))
+                elif aplicada.get("op") == "stock" and actual.get("op") == "stock":
+                    resto = actual["delta"] - aplicada["delta"]
+                    if resto:
+                        self._conn.execute("UPDATE cola SET operacion = ? WHERE seq = ?",
+                                           (json.dumps(dict(actual, delta=resto)), seq))
+                    else:
+                        self._conn.execute("DELETE FROM cola WHERE seq = ?", (seq,))
+            self._conn.execute("COMMIT")
+
+    def estadisticas(self):
+        with self._lock:
+            profundidad, mas_antiguo = self._conn.execute("SELECT COUNT(*), MIN(encolado) FROM cola").fetchone()
+        return {
+            "profundidad": profundidad,
+            "antiguedad_s": round(time.time() - mas_antiguo, 3) if mas_antiguo else 0.0,
+        }
+
+cola = ColaEscrituras(COLA_RUTA)
+
+def encolar_escritura(operacion, motivo):
+    """Encola una escritura para aplicarla después y responde 202."""
+    seq = cola.encolar(operacion)
+    print(f"📥 Escritura sobre {operacion.get('id', 'nuevo producto')} encolada ({motivo}).")
+    return jsonify({"warning": f"{motivo.capitalize()}. El cambio se aplicará en cuanto se procese la cola.",
+                    "encolado": seq}), 202
+
+def operacion_escritura(producto_id=None):
+    """Convierte la solicitud de escritura actual en una operación para /productos/bulk."""
+    if request.method == "DELETE":
+        return {"op": "delete", "id": producto_id}
+    if request.method == "PATCH":
+        return {"op": "stock", "id": producto_id, "delta": (request.json or {}).get("delta")}
+    operacion = dict(request.json or {}, op="upsert")
+    if producto_id is not None:
+        operacion["id"] = producto_id
+    return operacion
+
+def sumar_ajuste(pendiente, ajuste):
+    """Suma un ajuste de stock al delta o a la cantidad de la operación pendiente sobre la misma ID.
+
+    Retorna None si no se pueden combinar: la pendiente es un DELETE o algún valor no es entero.
+    """
+    campo = {"upsert": "cantidad", "stock": "delta"}.get(pendiente.get("op", "upsert"))
+    if campo is None or not isinstance(pendiente.get(campo), int) or not isinstance(ajuste.get("delta"), int):
+        return None
+    return dict(pendiente, **{campo: pendiente[campo] + ajuste["delta"]})
+
+def reproducir_lote(destino):
+    """Aplica un lote de escrituras encoladas de un destino. Retorna False si el servidor no respondió."""
+    entradas = cola.lote(BULK_LOTE, destino)
+    servidor = destino or servidor_escritura()
+    if not entradas:
+        return True
+    if not servidor:
+        return False
+    try:
+        response = sesion(servidor).post(f"{servidor}/productos/bulk",
+                                         json={"operaciones": [operacion for _, _, operacion in entradas]}, timeout=30)
+        response.raise_for_status()
+        resultados = response.json()["resultados"]
+    except requests.exceptions.RequestException:
+        monitor.marcar_caido(servidor)
+        print(f"⚠️ {servidor} no responde; {len(entradas)} escrituras siguen en cola.")
+        return False
+    finally:
+        cache.invalidar()
+    for (seq, _, operacion), resultado in zip(entradas, resultados):
+        if resultado["estado"] == "error":
+            # Un error de validación no se arregla reintentando: se descarta para no bloquear la cola
+            print(f"❌ Escritura encolada {seq} descartada: {resultado.get('error')} ({operacion})")
+    cola.confirmar(entradas)
+    print(f"📤 {len(entradas)} escrituras encoladas aplicadas en {servidor}")
+    return True
+
+def reproducir_cola():
+    """Aplica las escrituras encoladas en lotes en su destino, reintentando mientras no responda.
+
+    Cada destino avanza por su cuenta: uno caído no frena la reparación de los demás.
+    """
+    espera = 1
+    while True:
+        cola.hay_pendientes.wait(timeout=1)
+        destinos = cola.destinos()
+        if not destinos:
+            cola.hay_pendientes.clear()
+            continue
+        if all([reproducir_lote(destino) for destino in destinos]):
+            espera = 1
+            continue
+        espera = min(2 * espera, COLA_REINTENTO_MAX)
+        print(f"⏳ Reintento de la cola en {espera}s.")
+        time.sleep(espera)
+
+def respuesta_cacheada(entrada):
+    """Sirve una respuesta guardada, o 304 si el cliente ya tiene esa versión."""
+    if request.if_none_match.contains(entrada["etag"]):
+        response = Response(status=304)
+    else:
+        response = Response(entrada["cuerpo"], status=200, content_type=entrada["content_type"])
+    response.set_etag(entrada["etag"])
+    return response
+
+class LatenciasRecientes:
+    """Últimas latencias de lectura observadas, para calcular el percentil tras el que se cubre una lectura."""
+
+    def __init__(self, maximo):
+        self._lock = threading.Lock()
+        self._muestras = collections.deque(maxlen=maximo)
+        self._ordenadas = None
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._muestras.append(segundos)
+            self._ordenadas = None
+
+    def percentil(self, p):
+        with self._lock:
+            if len(self._muestras) < COBERTURA_MUESTRAS_MIN:
+                return None
+            if self._ordenadas is None:
+                self._ordenadas = sorted(self._muestras)
+            return self._ordenadas[min(len(self._ordenadas) - 1, int(len(self._ordenadas) * p / 100))]
+
+latencias_lectura = LatenciasRecientes(COBERTURA_MUESTRAS)
+metrica_coberturas = metricas.Contador("proxy_lecturas_cubiertas_total",
+                                       "Lecturas repetidas en otra réplica, por réplica que respondió primero",
+                                       ("ganador",))
+
+def get_cubierto(servidor, ruta, params, headers):
+    """GET a un servidor que, si no responde dentro del percentil COBERTURA_PERCENTIL de la latencia
+    observada, se repite en otra réplica al día; se usa la primera respuesta exitosa.
+
+    Retorna (servidor que respondió, respuesta). La solicitud al servidor recibido ya debe estar contada
+    en el balanceador; esta función termina las de los demás servidores y deja contada solo la ganadora.
+    """
+    def pedir(destino):
+        response = sesion(destino).get(f"{destino}{ruta}", params=params, headers=headers, stream=True, timeout=3)
+        latencias_lectura.registrar(response.elapsed.total_seconds())
+        return destino, response
+
+    espera = latencias_lectura.percentil(COBERTURA_PERCENTIL) if COBERTURA_PERCENTIL > 0 else None
+    alternativas = [otro for otro in replicas_al_dia() if otro != servidor] if espera is not None else []
+    if not alternativas:
         try:
-            response = requests.get(f"{servidor}/ultimo_cambio", timeout=3)
-            if response.status_code == 200:
-                data = response.json()
-                if data.get("servidor") and data.get("ultimo_cambio") != "2000-01-01T00:00:00":
-                    servidores_info[servidor] = data["ultimo_cambio"]
+            return pedir(servidor)
         except requests.exceptions.RequestException:
-            print(f"⚠️ No se pudo obtener el último cambio de {servidor}")
+            balanceador.terminar(servidor)
+            raise
+
+    def descartar(futuro):
+        # La solicitud que perdió se cierra y deja de contar en el balanceador al terminar
+        if futuro.exception() is None:
+            futuro.result()[1].close()
+        balanceador.terminar(lanzadas[futuro])
+
+    primero = ejecutor_lecturas.submit(trazas.en_contexto(pedir), servidor)
+    lanzadas = {primero: servidor}
+    hechos, _ = wait([primero], timeout=espera)
+    if not hechos:
+        segundo_servidor = balanceador.elegir(alternativas)
+        lanzadas[ejecutor_lecturas.submit(trazas.en_contexto(pedir), segundo_servidor)] = segundo_servidor
 
-    if servidores_info:
-        servidor_actualizado = max(servidores_info, key=servidores_info.get)
-        print(f"✅ Servidor más actualizado: {servidor_actualizado}")
-        return servidor_actualizado
-    
-    print("❌ No hay servidores con datos en sincronización.")
-    return None
+    pendientes = set(lanzadas)
+    terminados = set()  # Futuros fallidos ya descontados del balanceador
+    error = None
+    while pendientes:
+        hechos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            if futuro.exception() is None:
+                ganador = futuro.result()
+                if len(lanzadas) > 1:
+                    metrica_coberturas.inc(ganador=ganador[0])
+                for otro in lanzadas:
+                    if otro is not futuro and otro not in terminados:
+                        otro.add_done_callback(descartar)
+                return ganador
+            error = futuro.exception()
+            balanceador.terminar(lanzadas[futuro])
+            terminados.add(futuro)
+    raise error
+
+def proxy_get_productos(servidor, ruta_servidor="/productos"):
+    """Reenvía un GET de productos usando la caché: sin consultar al servidor si su versión no cambió,
+    o revalidando con If-None-Match si cambió. Las respuestas grandes o transmitidas no se guardan."""
+    ruta = f"{request.full_path}|{request.headers.get('Accept', '*/*')}"
+    version = monitor.version(servidor)
+    entrada = cache.obtener(servidor, ruta)
+    if entrada and version is not None and entrada["version"] == version:
+        balanceador.terminar(servidor)
+        cache.contar("acierto")
+        return respuesta_cacheada(entrada)
+
+    headers = {"Accept": request.headers.get("Accept", "*/*")}
+    if entrada:
+        headers["If-None-Match"] = f'"{entrada["etag"]}"'
+    elif "If-None-Match" in request.headers:
+        headers["If-None-Match"] = request.headers["If-None-Match"]
+    # 🔹 Se reenvían los parámetros de paginación y el formato pedido, y la respuesta se transmite tal cual
+    servidor_usado, response = get_cubierto(servidor, ruta_servidor, request.args, headers)
+    if servidor_usado != servidor:
+        # Respondió otra réplica: la entrada guardada era de la primera y no sirve para revalidar
+        servidor, entrada, version = servidor_usado, None, monitor.version(servidor_usado)
+
+    if entrada and response.status_code == 304:
+        response.close()
+        balanceador.terminar(servidor)
+        cache.contar("revalidada")
+        cache.guardar(servidor, ruta, dict(entrada, version=version))
+        return respuesta_cacheada(entrada)
+
+    cache.contar("fallo")
+    etag = response.headers.get("ETag")
+    # Con gzip, Content-Length es el tamaño comprimido: solo descarta lo que ni comprimido entra en la caché
+    largo = int(response.headers.get("Content-Length", CACHE_ENTRADA_MAX + 1))
+    if response.status_code == 200 and etag and version is not None and largo <= CACHE_ENTRADA_MAX:
+        resto = None
+        try:
+            cuerpo, resto = leer_hasta(response, CACHE_ENTRADA_MAX)
+        finally:
+            if resto is None:
+                response.close()
+                balanceador.terminar(servidor)
+        if resto is not None:
+            # Descomprimida no entra: se transmite lo ya leído y lo que falta, sin guardarla
+            return retransmitir(response, al_terminar=lambda: balanceador.terminar(servidor), fragmentos=resto)
+        entrada = {"version": version, "etag": unquote_etag(etag)[0], "cuerpo": cuerpo,
+                   "content_type": response.headers.get("Content-Type")}
+        cache.guardar(servidor, ruta, entrada)
+        return respuesta_cacheada(entrada)
+    return retransmitir(response, al_terminar=lambda: balanceador.terminar(servidor))
+
+def leer_hasta(response, maximo):
+    """Lee el cuerpo descomprimido de una respuesta si no pasa de `maximo` bytes.
+
+    Retorna (cuerpo, None), o (None, fragmentos) con lo ya leído seguido del resto si es más largo.
+    """
+    fragmentos = response.iter_content(chunk_size=STREAM_CHUNK)
+    leidos = []
+    largo = 0
+    for fragmento in fragmentos:
+        leidos.append(fragmento)
+        largo += len(fragmento)
+        if largo > maximo:
+            return None, itertools.chain(leidos, fragmentos)
+    return b"".join(leidos), None
+
+def retransmitir(response, al_terminar=None, fragmentos=None):
+    """Retransmite una respuesta del servidor al cliente por fragmentos, sin cargarla completa en memoria.
+
+    Si llegó comprimida y el cliente acepta esa compresión, se reenvía tal cual sin descomprimirla.
+    `fragmentos` reemplaza al cuerpo si ya se empezó a leer descomprimido.
+    """
+    codificacion = response.headers.get("Content-Encoding")
+    headers = {}
+    if fragmentos is None and codificacion and codificacion in request.headers.get("Accept-Encoding", ""):
+        fragmentos = response.raw.stream(STREAM_CHUNK, decode_content=False)
+        headers = {"Content-Encoding": codificacion, "Vary": "Accept-Encoding"}
+    elif fragmentos is None:
+        fragmentos = response.iter_content(chunk_size=STREAM_CHUNK)
+
+    def generar():
+        try:
+            for fragmento in fragmentos:
+                yield fragmento
+        finally:
+            response.close()
+            if al_terminar:
+                al_terminar()
+
+    return Response(generar(), status=response.status_code, content_type=response.headers.get("Content-Type"),
+                    headers=headers)
+
+def hash_anillo(clave):
+    """Posición de una clave en el anillo: los primeros 64 bits de su MD5."""
+    return int.from_bytes(hashlib.md5(str(clave).encode()).digest()[:8], "big")
+
+class AnilloHash:
+    """Anillo de hashing consistente con nodos virtuales.
+
+    Los propietarios de una clave son los `replicas` servidores distintos que siguen a su posición en el
+    anillo. Agregar o quitar un servidor solo cambia los propietarios de los tramos vecinos a sus puntos.
+    """
+
+    def __init__(self, nodos, virtuales, replicas):
+        self.nodos = list(nodos)
+        self.virtuales = virtuales
+        self.replicas = replicas
+        self._puntos = sorted((hash_anillo(f"{nodo}#{i}"), nodo) for nodo in self.nodos for i in range(virtuales))
+        self._posiciones = [posicion for posicion, _ in self._puntos]
+
+    def propietarios(self, clave):
+        """Servidores responsables de una clave, el principal primero."""
+        cantidad = min(self.replicas, len(self.nodos))
+        i = bisect.bisect(self._posiciones, hash_anillo(clave))
+        resultado = []
+        while len(resultado) < cantidad:
+            nodo = self._puntos[i % len(self._puntos)][1]
+            if nodo not in resultado:
+                resultado.append(nodo)
+            i += 1
+        return resultado
+
+    def reparto(self):
+        """Fracción del espacio de claves de la que cada servidor es propietario principal."""
+        fracciones = {nodo: 0.0 for nodo in self.nodos}
+        for i, (posicion, nodo) in enumerate(self._puntos):
+            anterior = self._puntos[i - 1][0] if i else self._puntos[-1][0] - 2**64
+            fracciones[nodo] += (posicion - anterior) / 2**64
+        return {nodo: round(fraccion, 4) for nodo, fraccion in fracciones.items()}
+
+anillo = AnilloHash(SERVIDORES, NODOS_VIRTUALES, FACTOR_REPLICACION)
+anillo_destino = None  # Anillo al que se está rebalanceando; mientras tanto se escribe en ambos
+lock_anillo = threading.Lock()
+
+def propietarios(producto_id):
+    """Servidores donde se escribe un producto: los de ambos anillos durante un rebalanceo."""
+    resultado = anillo.propietarios(producto_id)
+    destino = anillo_destino
+    if destino is not None:
+        resultado += [nodo for nodo in destino.propietarios(producto_id) if nodo not in resultado]
+    return resultado
+
+class AsignadorIds:
+    """Reparte IDs nuevas reservándolas por bloques de la secuencia de un único servidor."""
+
+    def __init__(self, servidor, bloque):
+        self.servidor = servidor
+        self.bloque = bloque
+        self._lock = threading.Lock()
+        self._libres = collections.deque()
+
+    def siguiente(self):
+        with self._lock:
+            if not self._libres:
+                response = sesion(self.servidor).post(f"{self.servidor}/ids", params={"cantidad": self.bloque}, timeout=3)
+                response.raise_for_status()
+                self._libres.extend(response.json()["ids"])
+            return self._libres.popleft()
+
+asignador_ids = AsignadorIds(ASIGNADOR_IDS, IDS_BLOQUE)
+
+# Posición de cada columna en las filas de GET /productos y cómo compararla al mezclar fragmentos
+COLUMNAS_ORDEN = {"id": (0, int), "nombre": (1, str), "cantidad": (3, int), "precio": (4, Decimal),
+                  "ultima_modificacion": (5, parse_date)}
+
+def leer_fragmentos(servidores, params):
+    """Junta en orden los productos de varios servidores, leídos en NDJSON a la vez.
+
+    El orden es por ID o por la columna de `orden` si viene en los parámetros (cada servidor ya filtra y ordena).
+    Si un producto viene de más de una réplica se queda la de su propietario principal.
+    """
+    orden = params.get("orden", "id")
+    descendente = orden.startswith("-")
+    posicion, convertir = COLUMNAS_ORDEN.get(orden.lstrip("-"), COLUMNAS_ORDEN["id"])
+
+    def etiquetar(servidor):
+        respuesta = sesion(servidor).get(f"{servidor}/productos", params=dict(params, formato="ndjson"),
+                                         stream=True, timeout=30)
+        respuesta.raise_for_status()
+        def filas():
+            with respuesta:
+                for linea in respuesta.iter_lines():
+                    if linea:
+                        producto = json.loads(linea)
+                        responsables = propietarios(producto[0])
+                        rango = responsables.index(servidor) if servidor in responsables else len(responsables)
+                        valor = producto[posicion]
+                        # Como en PostgreSQL, los nulos van al final en orden ascendente
+                        clave = (valor is None, convertir(valor) if valor is not None else 0)
+                        yield clave, producto[0], -rango if descendente else rango, producto
+        return filas()
+
+    # Las conexiones se abren en paralelo; las filas se consumen a medida que se mezclan
+    flujos = en_paralelo(ejecutor_consultas, etiquetar, servidores)
+    ultimo_id = None
+    for _, producto_id, _, producto in heapq.merge(*flujos.values(), key=lambda fila: fila[:3], reverse=descendente):
+        if producto_id != ultimo_id:
+            ultimo_id = producto_id
+            yield producto
+
+def proxy_listar_fragmentado():
+    """GET /productos en modo fragmentado: consulta todos los servidores sanos a la vez y mezcla los resultados."""
+    vigentes = monitor.vigentes()
+    servidores = [servidor for servidor in anillo.nodos if servidor in vigentes]
+    if not servidores:
+        return jsonify({"error": "No hay servidores disponibles"}), 500
+    params = {clave: valor for clave, valor in request.args.items() if clave != "formato"}
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({"error": f"Valor inválido para limit: {limit}"}), 400
+    ndjson = request.args.get("formato") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", "")
+    if limit is not None and not ndjson:
+        limit = params["limit"] = max(1, min(limit, PAGINA_MAX))
+    try:
+        productos = leer_fragmentos(servidores, params)
+        if ndjson:
+            if limit is not None:
+                productos = itertools.islice(productos, max(0, limit))
+            primera = next(productos, None)
+            def generar():
+                if primera is not None:
+                    yield json.dumps(primera) + "\n"
+                for producto in productos:
+                    yield json.dumps(producto) + "\n"
+            return Response(generar(), mimetype="application/x-ndjson")
+        if limit is None:
+            return jsonify(list(productos))
+        pagina = list(itertools.islice(productos, limit))
+        productos.close()
+        siguiente = pagina[-1][0] if len(pagina) == limit and request.args.get("orden", "id") == "id" else None
+        return jsonify({"productos": pagina, "siguiente": siguiente})
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "No se pudo conectar con los servidores"}), 500
+
+def proxy_escribir_fragmentado(metodo, producto_id, cuerpo):
+    """Aplica una escritura en todos los propietarios del producto a la vez.
+
+    Responde con la respuesta del primero que la aceptó e informa las réplicas que fallaron.
+    """
+    responsables = propietarios(producto_id)
+
+    def escribir(servidor):
+        try:
+            if metodo == "POST":
+                return sesion(servidor).post(f"{servidor}/productos", json=cuerpo, timeout=3)
+            if metodo == "PUT":
+                return sesion(servidor).put(f"{servidor}/productos/{producto_id}", json=cuerpo, timeout=3)
+            if metodo == "PATCH":
+                return sesion(servidor).patch(f"{servidor}/productos/{producto_id}/stock", json=cuerpo, timeout=3)
+            return sesion(servidor).delete(f"{servidor}/productos/{producto_id}", timeout=3)
+        except requests.exceptions.RequestException:
+            monitor.marcar_caido(servidor)
+            return None
+
+    respuestas = en_paralelo(ejecutor_consultas, escribir, responsables)
+    fallidas = [servidor for servidor, response in respuestas.items() if response is None or response.status_code >= 500]
+    exitosas = [(servidor, response) for servidor, response in respuestas.items()
+                if response is not None and response.status_code < 500]
+    if not exitosas:
+        return jsonify({"error": "No se pudo escribir en ningún propietario", "propietarios": responsables}), 500
+    fuente, response = exitosas[0]
+    if fallidas:
+        print(f"⚠️ Escritura de {producto_id} no aplicada en {fallidas}; se encola la reparación")
+        encolar_reparacion(producto_id, fuente, fallidas)
+    data = response.json()
+    data.update(propietarios=responsables, replicas_fallidas=fallidas)
+    return jsonify(data), response.status_code
+
+def encolar_reparacion(producto_id, fuente, destinos):
+    """Encola para cada propietario en el que falló una escritura la copia de la fila que quedó en `fuente`.
+
+    La copia lleva el sello de la fila: aplicarla dos veces, o después de una escritura más nueva, no cambia
+    nada, a diferencia de repetir un ajuste de stock. Si la fila ya no existe se encola su eliminación.
+    """
+    try:
+        response = sesion(fuente).get(f"{fuente}/productos/{producto_id}", timeout=3)
+        if response.status_code != 404:
+            response.raise_for_status()
+    except requests.exceptions.RequestException:
+        print(f"❌ No se pudo leer {producto_id} de {fuente}: {destinos} quedan sin reparar")
+        return
+    if response.status_code == 404:
+        operacion = {"op": "delete", "id": producto_id}
+    else:
+        producto = response.json()
+        operacion = {"op": "upsert", "id": producto[0], "nombre": producto[1], "descripcion": producto[2],
+                     "cantidad": int(producto[3]), "precio": float(producto[4]), "hlc": producto[6], "nodo": producto[7]}
+    for destino in destinos:
+        cola.encolar(operacion, destino)
+
+def rebalancear(anterior, nuevo):
+    """Mueve solo los productos cuyo conjunto de propietarios cambia entre dos anillos.
+
+    Los servidores guardan los productos por ID y no por posición en el anillo, así que se recorren las
+    IDs de cada servidor anterior, pero solo se copian (y luego se borran del origen) los productos
+    afectados. Retorna la cantidad de copias y de borrados.
+    """
+    copias = collections.defaultdict(list)  # {destino: [operaciones]}
+    borrados = collections.defaultdict(list)  # {origen: [operaciones]}
+    programados = set()
+    copiadas = 0
+    for origen in anterior.nodos:
+        try:
+            for producto in leer_productos(origen):
+                producto_id = producto[0]
+                antes, despues = anterior.propietarios(producto_id), nuevo.propietarios(producto_id)
+                if set(antes) == set(despues):
+                    continue
+                if producto_id not in programados:
+                    programados.add(producto_id)
+                    for destino in set(despues) - set(antes):
+                        copias[destino].append({
+                            "op": "upsert",
+                            "id": producto_id,
+                            "nombre": producto[1],
+                            "descripcion": producto[2],
+                            "cantidad": int(producto[3]),
+                            "precio": float(producto[4]),
+                            "hlc": producto[6],
+                            "nodo": producto[7]
+                        })
+                        if len(copias[destino]) >= BULK_LOTE:
+                            enviar_lote(destino, copias.pop(destino))
+                        copiadas += 1
+                if origen not in despues:
+                    borrados[origen].append({"op": "delete", "id": producto_id, "hlc": producto[6], "nodo": producto[7]})
+        except requests.exceptions.RequestException:
+            # Un servidor que se quita puede estar caído: sus productos se copian desde las otras réplicas
+            print(f"⚠️ No se pudo leer {origen} durante el rebalanceo.")
+
+    for destino, operaciones in copias.items():
+        enviar_lote(destino, operaciones)
+    # Solo se borra después de copiar todo, para no quedar nunca con menos réplicas
+    borradas = 0
+    for origen, operaciones in borrados.items():
+        if origen in nuevo.nodos:
+            enviar_lote(origen, operaciones)
+            borradas += len(operaciones)
+    return copiadas, borradas
+
+def cambiar_nodos(nodos):
+    """Rebalancea hacia un anillo con otros servidores y lo activa al terminar."""
+    global anillo, anillo_destino
+    with lock_anillo:
+        nuevo = AnilloHash(nodos, NODOS_VIRTUALES, FACTOR_REPLICACION)
+        for servidor in nodos:
+            if servidor not in sesiones:
+                sesiones[servidor] = crear_sesion(servidor)
+            monitor.agregar(servidor)
+        anillo_destino = nuevo
+        try:
+            inicio = time.perf_counter()
+            copiadas, borradas = rebalancear(anillo, nuevo)
+            anillo = nuevo
+            print(f"🔁 Rebalanceo terminado en {time.perf_counter() - inicio:.1f}s: "
+                  f"{copiadas} copias, {borradas} borrados")
+        finally:
+            anillo_destino = None
+        for servidor in list(monitor.servidores):
+            if servidor not in nodos:
+                monitor.quitar(servidor)
+        return copiadas, borradas
+
+@app.route("/anillo", methods=["GET"])
+def estado_anillo():
+    """Retorna los servidores del anillo, su reparto del espacio de claves y si hay un rebalanceo en curso."""
+    return jsonify({
+        "fragmentado": MODO_FRAGMENTADO,
+        "nodos": anillo.nodos,
+        "nodos_virtuales": anillo.virtuales,
+        "factor_replicacion": anillo.replicas,
+        "reparto": anillo.reparto(),
+        "rebalanceando": anillo_destino is not None,
+    })
+
+@app.route("/anillo/nodos", methods=["POST", "DELETE"])
+def modificar_anillo():
+    """Agrega (POST) o quita (DELETE) el servidor {"servidor": url} y rebalancea solo los productos afectados."""
+    if not MODO_FRAGMENTADO:
+        return jsonify({"error": "El anillo solo se usa con MODO_FRAGMENTADO=1"}), 400
+    if TRABAJADORES > 1:
+        # Cada worker tiene su propia copia del anillo en memoria y solo cambiaría la de uno
+        return jsonify({"error": "Cambiar el anillo requiere un solo worker (TRABAJADORES=1)"}), 409
+    servidor = (request.json or {}).get("servidor")
+    if not servidor:
+        return jsonify({"error": "Falta 'servidor'"}), 400
+    nodos = [nodo for nodo in anillo.nodos if nodo != servidor]
+    if request.method == "POST":
+        nodos.append(servidor)
+    if not nodos or nodos == anillo.nodos:
+        return jsonify({"error": "El anillo no cambia"}), 400
+    try:
+        copiadas, borradas = cambiar_nodos(nodos)
+    except (requests.exceptions.RequestException, ErrorSincronizacion) as e:
+        return jsonify({"error": f"Rebalanceo incompleto: {e}"}), 500
+    return jsonify({"nodos": anillo.nodos, "copias": copiadas, "borrados": borradas})
 
 @app.route("/productos", methods=["GET", "POST"])
 def proxy_productos():
-    """Redirige solicitudes de productos al servidor más actualizado."""
-    servidor = obtener_servidor_mas_actualizado()
+    """Redirige las lecturas de productos a una réplica al día y las creaciones al servidor de escritura."""
+    if MODO_FRAGMENTADO:
+        if request.method == "GET":
+            return proxy_listar_fragmentado()
+        cuerpo = dict(request.json or {})
+        if "id" not in cuerpo:
+            try:
+                cuerpo["id"] = asignador_ids.siguiente()
+            except requests.exceptions.RequestException:
+                return jsonify({"error": "No se pudo reservar una ID nueva"}), 500
+        return proxy_escribir_fragmentado("POST", cuerpo["id"], cuerpo)
+    if request.method == "GET":
+        return proxy_lectura("/productos")
+    if ESCRITURA_DIFERIDA:
+        return encolar_escritura(operacion_escritura(), "escritura diferida")
+    servidor = servidor_escritura()
     if not servidor:
         return jsonify({"error": "No hay servidores disponibles"}), 500
 
-    url = f"{servidor}/productos"
     try:
-        if request.method == "GET":
-            response = requests.get(url, timeout=3)
-        elif request.method == "POST":
-            response = requests.post(url, json=request.json, timeout=3)
+        try:
+            response = sesion(servidor).post(f"{servidor}/productos", json=request.json, timeout=3)
+        finally:
+            cache.invalidar()  # La escritura pasó por el proxy: las respuestas guardadas ya no sirven
         return jsonify(response.json()), response.status_code
     except requests.exceptions.RequestException:
+        monitor.marcar_caido(servidor)
         return jsonify({"error": "No se pudo conectar con el servidor"}), 500
 
+def proxy_lectura(ruta):
+    """Reenvía una lectura de productos a una réplica al día (o al líder), con la caché del proxy."""
+    servidor = servidor_lectura()
+    if not servidor:
+        return jsonify({"error": "No hay servidores disponibles"}), 500
+    try:
+        return proxy_get_productos(servidor, ruta)
+    except requests.exceptions.RequestException:
+        monitor.marcar_caido(servidor)
+        return jsonify({"error": "No se pudo conectar con el servidor"}), 500
+
+def proxy_buscar_fragmentado(ids):
+    """Lecturas por ID en modo fragmentado: cada ID se pide a su primer propietario sano, agrupadas en un
+    GET /productos/lote por servidor y todos a la vez. Retorna {id: fila} de los productos encontrados."""
+    vigentes = monitor.vigentes()
+    grupos = collections.defaultdict(list)
+    for producto_id in ids:
+        servidor = next((servidor for servidor in propietarios(producto_id) if servidor in vigentes), None)
+        if servidor is None:
+            raise requests.exceptions.ConnectionError(f"Ningún propietario de {producto_id} está disponible")
+        grupos[servidor].append(producto_id)
+
+    def pedir(servidor):
+        response = sesion(servidor).get(f"{servidor}/productos/lote",
+                                        params={"ids": ",".join(map(str, grupos[servidor]))}, timeout=3)
+        response.raise_for_status()
+        return response.json()["productos"]
+
+    return {producto[0]: producto for filas in en_paralelo(ejecutor_consultas, pedir, list(grupos)).values()
+            for producto in filas}
+
+@app.route("/productos/<int:producto_id>", methods=["GET"])
+def proxy_obtener_producto(producto_id):
+    """Redirige la lectura de un producto por ID como las demás lecturas; en modo fragmentado, a un propietario."""
+    if not MODO_FRAGMENTADO:
+        return proxy_lectura(f"/productos/{producto_id}")
+    try:
+        encontrados = proxy_buscar_fragmentado([producto_id])
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "No se pudo conectar con los servidores"}), 500
+    if producto_id not in encontrados:
+        return jsonify({"error": "Producto no encontrado"}), 404
+    return jsonify(encontrados[producto_id])
+
+@app.route("/productos/lote", methods=["GET"])
+def proxy_lote_productos():
+    """Redirige la lectura de varios productos por ID (`ids=1,2,3`); en modo fragmentado la reparte entre los
+    propietarios de cada ID y junta las respuestas en el orden pedido."""
+    if not MODO_FRAGMENTADO:
+        return proxy_lectura("/productos/lote")
+    try:
+        ids = list(dict.fromkeys(int(pid) for pid in request.args.get("ids", "").split(",") if pid.strip()))
+    except ValueError:
+        ids = []
+    if not ids:
+        return jsonify({"error": "Se esperaba `ids` con IDs enteras separadas por comas"}), 400
+    try:
+        encontrados = proxy_buscar_fragmentado(ids)
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "No se pudo conectar con los servidores"}), 500
+    return jsonify({"productos": [encontrados[pid] for pid in ids if pid in encontrados],
+                    "faltantes": [pid for pid in ids if pid not in encontrados]})
+
 @app.route("/productos/<int:producto_id>", methods=["PUT", "DELETE"])
 def proxy_producto_id(producto_id):
-    """Redirige las solicitudes de actualización y eliminación de productos al servidor más actualizado."""
-    servidor = obtener_servidor_mas_actualizado()
+    """Redirige las solicitudes de actualización y eliminación de productos al servidor de escritura.
+
+    Con ESCRITURA_DIFERIDA, o si el servidor no está disponible, la escritura se guarda en la cola durable.
+    """
+    if MODO_FRAGMENTADO:
+        return proxy_escribir_fragmentado(request.method, producto_id, request.json)
+    if ESCRITURA_DIFERIDA:
+        return encolar_escritura(operacion_escritura(producto_id), "escritura diferida")
+    servidor = servidor_escritura()
     if not servidor:
-        return jsonify({"error": "No hay servidores disponibles"}), 500
+        return encolar_escritura(operacion_escritura(producto_id), "no hay servidores disponibles")
 
     url = f"{servidor}/productos/{producto_id}"
     try:
-        if request.method == "PUT":
-            response = requests.put(url, json=request.json, timeout=3)
-        elif request.method == "DELETE":
-            response = requests.delete(url, timeout=3)
+        try:
+            if request.method == "PUT":
+                response = sesion(servidor).put(url, json=request.json, timeout=3)
+            elif request.method == "DELETE":
+                response = sesion(servidor).delete(url, timeout=3)
+        finally:
+            cache.invalidar()  # La escritura pasó por el proxy: las respuestas guardadas ya no sirven
+
+        return jsonify(response.json()), response.status_code
+    except requests.exceptions.RequestException:
+        monitor.marcar_caido(servidor)
+        print(f"⚠️ No se pudo conectar con {servidor}. Encolando la escritura.")
+        return encolar_escritura(operacion_escritura(producto_id), "servidor no disponible")
+
+@app.route("/productos/<int:producto_id>/stock", methods=["PATCH"])
+def proxy_ajustar_stock(producto_id):
+    """Redirige un ajuste de stock (delta) al servidor de escritura.
+
+    Un ajuste sin `minimo` puede diferirse en la cola como delta. Uno con `minimo` necesita la respuesta del
+    servidor, así que nunca se encola. Si la conexión se corta después de enviarlo no se reintenta, porque el
+    ajuste pudo haberse aplicado y repetirlo lo sumaría dos veces.
+    """
+    if MODO_FRAGMENTADO:
+        return proxy_escribir_fragmentado("PATCH", producto_id, request.json)
+    con_minimo = (request.json or {}).get("minimo") is not None
+    if ESCRITURA_DIFERIDA and not con_minimo:
+        return encolar_escritura(operacion_escritura(producto_id), "escritura diferida")
+    servidor = servidor_escritura()
+    if not servidor:
+        if con_minimo:
+            return jsonify({"error": "No hay servidores disponibles"}), 500
+        return encolar_escritura(operacion_escritura(producto_id), "no hay servidores disponibles")
+
+    try:
+        try:
+            response = sesion(servidor).patch(f"{servidor}/productos/{producto_id}/stock", json=request.json, timeout=3)
+        finally:
+            cache.invalidar()  # La escritura pasó por el proxy: las respuestas guardadas ya no sirven
+        return jsonify(response.json()), response.status_code
+    except requests.exceptions.ConnectionError:
+        monitor.marcar_caido(servidor)
+        if con_minimo:
+            return jsonify({"error": "No se pudo conectar con el servidor"}), 500
+        print(f"⚠️ No se pudo conectar con {servidor}. Encolando el ajuste.")
+        return encolar_escritura(operacion_escritura(producto_id), "servidor no disponible")
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "Sin respuesta del servidor: el ajuste pudo haberse aplicado"}), 504
 
+@app.route("/productos/stock", methods=["POST"])
+def proxy_reservar_stock():
+    """Redirige una reserva de varios productos al servidor de escritura, que la aplica de forma atómica."""
+    if MODO_FRAGMENTADO:
+        # Los productos pueden vivir en fragmentos distintos y no hay transacciones entre servidores
+        return jsonify({"error": "Las reservas de varios productos no están disponibles en modo fragmentado"}), 501
+    servidor = servidor_escritura()
+    if not servidor:
+        return jsonify({"error": "No hay servidores disponibles"}), 500
+    try:
+        try:
+            response = sesion(servidor).post(f"{servidor}/productos/stock", json=request.json, timeout=10)
+        finally:
+            cache.invalidar()
         return jsonify(response.json()), response.status_code
+    except requests.exceptions.ConnectionError:
+        monitor.marcar_caido(servidor)
+        return jsonify({"error": "No se pudo conectar con el servidor"}), 500
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "Sin respuesta del servidor: la reserva pudo haberse aplicado"}), 504
+
+@app.route("/servidores", methods=["GET"])
+def estado_servidores():
+    """Retorna el estado que el monitor tiene de cada servidor, el más actualizado y el reparto de lecturas."""
+    referencia = servidor_escritura()
+    estado = monitor.estado()
+    en_curso = balanceador.en_curso()
+    for servidor, info in estado.items():
+        info["en_curso"] = en_curso.get(servidor, 0)
+        info["retraso"] = retraso(referencia, servidor, estado.get(referencia, {}).get("ultimo_seq"))
+        info["circuito"] = circuitos[servidor].estado if servidor in circuitos else None
+    return jsonify({
+        "lider": monitor.lider(),
+        "escritura": referencia,
+        "modo_lectura": MODO_LECTURA,
+        "lectura_al_dia": replicas_al_dia(),
+        "cache": cache.estadisticas(),
+        "servidores": estado,
+    })
+
+@app.route("/sincronizacion", methods=["GET"])
+def estado_sincronizacion():
+    """Retorna el estado de la sincronización de cada réplica: retraso, tasa de cambios, intervalo, fallos
+    seguidos y próxima revisión, junto con el uso del límite de banda.
+
+    Con produccion.py la sincronización corre en otro proceso, al que se le pregunta.
+    """
+    if not planificador.activo:
+        if not SINCRONIZADOR_URL:
+            return jsonify({"error": "La sincronización no corre en este proceso"}), 503
+        try:
+            response = requests.get(f"{SINCRONIZADOR_URL}/sincronizacion", timeout=3)
+            return jsonify(response.json()), response.status_code
+        except requests.exceptions.RequestException:
+            return jsonify({"error": "No se pudo consultar al proceso sincronizador"}), 503
+    return jsonify({"suscrito": suscrito.is_set(), "banda": limitador_banda.estadisticas(),
+                    "replicas": planificador.estado(),
+                    "marcas_agua": [{"fuente": fuente, "destino": destino, "marca": marca}
+                                    for (fuente, destino), marca in list(marcas_agua.items())]})
+
+@app.route("/cola", methods=["GET"])
+def estado_cola():
+    """Retorna la profundidad de la cola de escrituras diferidas y la antigüedad de la más vieja."""
+    return jsonify(dict(cola.estadisticas(), escritura_diferida=ESCRITURA_DIFERIDA))
+
+def obtener_ultimo_seq(servidor):
+    """Retorna la secuencia más reciente del log de cambios de un servidor."""
+    response = sesion(servidor).get(f"{servidor}/cambios", params={"limite": 0}, timeout=3)
+    response.raise_for_status()
+    return response.json()["ultimo_seq"]
+
+class LimitadorBanda:
+    """Cubeta de fichas compartida por las sincronizaciones de todas las réplicas: limita los bytes por
+    segundo que se les envían juntas, con ráfagas de hasta un segundo de tasa.
+
+    Un envío más grande que la cubeta pasa igual, pero deja la cuenta en negativo y los siguientes esperan.
+    """
+
+    def __init__(self, bytes_por_segundo):
+        self.tasa = bytes_por_segundo
+        self._lock = threading.Lock()
+        self._fichas = float(bytes_por_segundo)
+        self._ultimo = time.monotonic()
+        self._bytes = 0
+        self._espera_total = 0.0
+
+    def consumir(self, cantidad):
+        """Descuenta `cantidad` bytes y espera lo necesario para no superar la tasa."""
+        with self._lock:
+            self._bytes += cantidad
+            if self.tasa <= 0:
+                return
+            ahora = time.monotonic()
+            self._fichas = min(self.tasa, self._fichas + (ahora - self._ultimo) * self.tasa) - cantidad
+            self._ultimo = ahora
+            espera = -self._fichas / self.tasa if self._fichas < 0 else 0
+            self._espera_total += espera
+        if espera:
+            time.sleep(espera)
+
+    def limitar(self, fragmentos):
+        """Itera los fragmentos de una transmisión descontando cada uno."""
+        for fragmento in fragmentos:
+            self.consumir(len(fragmento))
+            yield fragmento
+
+    def estadisticas(self):
+        with self._lock:
+            return {"bytes_por_segundo_max": self.tasa or None, "bytes_enviados": self._bytes,
+                    "espera_total_s": round(self._espera_total, 3)}
+
+limitador_banda = LimitadorBanda(SYNC_BANDA_MAX)
+
+def codificar_lote(operaciones):
+    """Cuerpo por columnas de /productos/bulk, comprimido: bloques de UPSERTs, de IDs a eliminar y de ajustes de stock.
+
+    Cada operación lleva el sello (hlc, nodo) de su origen, o nulos si no tiene (escrituras encoladas).
+    """
+    upserts = [(op["id"], op["nombre"], op["descripcion"], op["cantidad"], op["precio"], op.get("hlc"), op.get("nodo"))
+               for op in operaciones if op["op"] == "upsert"]
+    eliminaciones = [(op["id"], op.get("hlc"), op.get("nodo")) for op in operaciones if op["op"] == "delete"]
+    ajustes = [(op["id"], op["delta"], op.get("hlc"), op.get("nodo")) for op in operaciones if op["op"] == "stock"]
+    cuerpo = (formato.codificar(upserts, formato.ESQUEMA_UPSERT)
+              + formato.codificar(eliminaciones, formato.ESQUEMA_ELIMINACION))
+    if ajustes:
+        cuerpo += formato.codificar(ajustes, formato.ESQUEMA_AJUSTE)
+    return gzip.compress(cuerpo, formato.COMPRESION_NIVEL)
+
+def enviar_lote(servidor, operaciones):
+    """Envía operaciones a /productos/bulk del servidor en lotes de BULK_LOTE, una transacción por lote.
+
+    Los lotes viajan en el formato por columnas comprimido con gzip.
+    """
+    for inicio in range(0, len(operaciones), BULK_LOTE):
+        lote = operaciones[inicio:inicio + BULK_LOTE]
+        cuerpo = codificar_lote(lote)
+        limitador_banda.consumir(len(cuerpo))
+        try:
+            response = sesion(servidor).post(f"{servidor}/productos/bulk", data=cuerpo, timeout=30,
+                                             headers={"Content-Type": formato.TIPO_COLUMNAS, "Content-Encoding": "gzip"})
+        finally:
+            cache.invalidar(servidor)
+        response.raise_for_status()
+        data = response.json()
+        if data["errores"]:
+            fallidas = [r for r in data["resultados"] if r["estado"] == "error"]
+            raise ErrorSincronizacion(f"{servidor} rechazó {data['errores']} operaciones: {fallidas[:5]}")
+        metrica_filas.inc(data["aplicadas"], servidor=servidor)
+        omitidas = data.get("omitidas", 0)
+        print(f"📦 {data['aplicadas']} operaciones aplicadas en {servidor}"
+              + (f" ({omitidas} omitidas, el destino tenía una versión más nueva)" if omitidas else ""))
+
+def cambio_a_operacion(cambio):
+    """Convierte una entrada del log de cambios en una operación para /productos/bulk.
+
+    Un ajuste de stock se envía como delta, para no pisar otros ajustes que el destino haya recibido. Todas
+    las operaciones llevan el sello del cambio, así el destino omite las que ya tiene en una versión más nueva.
+    """
+    sello = {"hlc": cambio.get("hlc"), "nodo": cambio.get("nodo")}
+    if cambio["eliminado"]:
+        return {"op": "delete", "id": cambio["id"], **sello}
+    if cambio.get("delta") is not None:
+        return {"op": "stock", "id": cambio["id"], "delta": cambio["delta"], **sello}
+    return {
+        "op": "upsert",
+        "id": cambio["id"],
+        "nombre": cambio["nombre"],
+        "descripcion": cambio["descripcion"],
+        "cantidad": cambio["cantidad"],
+        "precio": cambio["precio"],
+        **sello
+    }
+
+def leer_productos(servidor, desde_id=None, hasta_id=None):
+    """Itera los productos de un servidor con IDs en [desde_id, hasta_id) a medida que llegan, sin cargarlos en memoria.
+
+    Se piden en el formato por columnas; un servidor que no lo conozca responde NDJSON.
+    """
+    params = {"formato": "ndjson"}
+    if desde_id is not None:
+        params["after"] = desde_id - 1
+    if hasta_id is not None:
+        params["before"] = hasta_id
+    with sesion(servidor).get(f"{servidor}/productos", params=params, headers={"Accept": formato.TIPO_COLUMNAS},
+                              stream=True, timeout=30) as response:
+        response.raise_for_status()
+        if response.headers.get("Content-Type") == formato.TIPO_COLUMNAS:
+            response.raw.decode_content = True
+            for bloque in formato.leer_bloques(response.raw):
+                yield from formato.decodificar(bloque, formato.ESQUEMA_PRODUCTO)
+            return
+        for linea in response.iter_lines():
+            if linea:
+                yield json.loads(linea)
+
+def consultar_merkle(servidor, desde=None, hasta=None, partes=1):
+    """Retorna el rango de IDs por hoja y los subrangos del árbol de Merkle de un servidor."""
+    params = {"partes": partes}
+    if desde is not None:
+        params.update(desde=desde, hasta=hasta)
+    response = sesion(servidor).get(f"{servidor}/merkle", params=params, timeout=3)
+    response.raise_for_status()
+    data = response.json()
+    return data["rango"], data["partes"]
+
+def comparar_merkle(servidor_fuente, servidor, desde=None, hasta=None):
+    """Compara los árboles de Merkle de dos servidores y retorna los rangos de IDs [desde_id, hasta_id) que difieren.
+
+    Solo se desciende por los subárboles cuyo hash no coincide, así que dos réplicas idénticas cuestan una
+    consulta a cada una. Un rango pequeño, o vacío en alguno de los lados, se entrega completo sin descender más.
+    """
+    consultas = en_paralelo(ejecutor_consultas, lambda s: consultar_merkle(s, desde, hasta, 1), [servidor_fuente, servidor])
+    rango = consultas[servidor_fuente][0]
+    pendientes = [(consultas[servidor_fuente][1][0], consultas[servidor][1][0])]
+    diferentes = []
+    while pendientes:
+        nodo_fuente, nodo = pendientes.pop()
+        if nodo_fuente["hash"] == nodo["hash"] and nodo_fuente["filas"] == nodo["filas"]:
+            continue
+        if (nodo_fuente["desde"] == nodo_fuente["hasta"] or min(nodo_fuente["filas"], nodo["filas"]) == 0
+                or max(nodo_fuente["filas"], nodo["filas"]) <= MERKLE_FILAS_DIRECTO):
+            diferentes.append((nodo_fuente["desde"] * rango, (nodo_fuente["hasta"] + 1) * rango))
+            continue
+        hijos = en_paralelo(ejecutor_consultas,
+                            lambda s: consultar_merkle(s, nodo_fuente["desde"], nodo_fuente["hasta"], MERKLE_PARTES)[1],
+                            [servidor_fuente, servidor])
+        pendientes.extend(zip(hijos[servidor_fuente], hijos[servidor]))
+    return sorted(diferentes)
+
+def reconciliar_rango(servidor_fuente, servidor, desde_id, hasta_id):
+    """Deja las IDs [desde_id, hasta_id) del destino iguales a las de la fuente, enviando solo las filas distintas.
+
+    Cada fila viaja con su sello (hlc, nodo), y el destino omite las que ya tiene en una versión más nueva.
+    Las eliminaciones llevan el sello de la fila del destino, que es justo el que borran.
+    """
+    destino = {p[0]: (tuple(p[1:5]), (p[6], p[7])) for p in leer_productos(servidor, desde_id, hasta_id)}
+    vistos = set()
+    lote = []
+    for producto in leer_productos(servidor_fuente, desde_id, hasta_id):
+        vistos.add(producto[0])
+        fila = destino.get(producto[0])
+        if fila and (fila[0] == tuple(producto[1:5]) or fila[1] > (producto[6], producto[7])):
+            continue
+        lote.append({
+            "op": "upsert",
+            "id": producto[0],
+            "nombre": producto[1],
+            "descripcion": producto[2],
+            "cantidad": int(producto[3]),
+            "precio": float(producto[4]),
+            "hlc": producto[6],
+            "nodo": producto[7]
+        })
+        if len(lote) >= BULK_LOTE:
+            enviar_lote(servidor, lote)
+            lote = []
+    lote += [{"op": "delete", "id": producto_id, "hlc": destino[producto_id][1][0], "nodo": destino[producto_id][1][1]}
+             for producto_id in destino.keys() - vistos]
+    enviar_lote(servidor, lote)
+
+def sincronizacion_completa(servidor_fuente, servidor):
+    """Verifica el destino contra la fuente con árboles de Merkle y corrige solo los rangos que difieren."""
+    diferentes = comparar_merkle(servidor_fuente, servidor)
+    if not diferentes:
+        print(f"🌳 {servidor} coincide con {servidor_fuente}")
+        return
+    print(f"🌳 {len(diferentes)} rangos de IDs difieren entre {servidor_fuente} y {servidor}")
+    for desde_id, hasta_id in diferentes:
+        reconciliar_rango(servidor_fuente, servidor, desde_id, hasta_id)
+
+def obtener_cambios(servidor, desde):
+    """Consulta /cambios de un servidor en el formato por columnas (o JSON si no lo conoce).
+
+    Retorna un diccionario como el JSON de /cambios: ultimo_seq, cambios y hay_mas.
+    """
+    response = sesion(servidor).get(f"{servidor}/cambios", params={"desde": desde, "limite": CAMBIOS_LOTE},
+                                    headers={"Accept": formato.TIPO_COLUMNAS}, timeout=3)
+    response.raise_for_status()
+    if response.headers.get("Content-Type") != formato.TIPO_COLUMNAS:
+        return response.json()
+    campos = ("seq", "id", "eliminado", "nombre", "descripcion", "cantidad", "precio", "ultima_modificacion", "delta",
+              "hlc", "nodo")
+    cambios = [dict(zip(campos, fila))
+               for bloque in formato.separar_bloques(response.content)
+               for fila in formato.decodificar(bloque, formato.ESQUEMA_CAMBIO)]
+    return {"ultimo_seq": int(response.headers["X-Ultimo-Seq"]), "cambios": cambios,
+            "hay_mas": response.headers.get("X-Hay-Mas") == "1"}
+
+def sincronizacion_incremental(servidor_fuente, servidor, marca):
+    """Envía al destino solo los cambios del log de la fuente posteriores a la marca de agua.
+
+    Retorna la nueva marca, o None si el log de la fuente se reinició y hace falta una copia completa.
+    """
+    while True:
+        data = obtener_cambios(servidor_fuente, marca)
+        if data["ultimo_seq"] < marca:
+            print(f"⚠️ El log de cambios de {servidor_fuente} retrocedió ({data['ultimo_seq']} < {marca}).")
+            return None
+        if not data["cambios"]:
+            return marca
+
+        # 🔹 Solo importa la última versión de cada producto dentro del lote. Los ajustes seguidos viajan cada uno
+        # con su sello: sumados llevarían solo el último, y el destino que ya tiene los primeros los sumaría otra vez
+        ultimos = {}  # {id: [cambios a enviar, en orden]}
+        for cambio in data["cambios"]:
+            previos = ultimos.get(cambio["id"])
+            if cambio.get("delta") is not None and previos and not previos[-1]["eliminado"]:
+                if previos[-1].get("delta") is not None:
+                    previos.append(cambio)
+                    continue
+                cambio = dict(cambio, delta=None)  # Tras una escritura completa se envía la fila completa
+            ultimos[cambio["id"]] = [cambio]
+        print(f"📦 {len(data['cambios'])} cambios ({len(ultimos)} productos) de {servidor_fuente} para {servidor}")
+        enviar_lote(servidor, [cambio_a_operacion(cambio) for cambios in ultimos.values() for cambio in cambios])
+
+        # La marca solo avanza cuando todo el lote quedó aplicado
+        marca = data["cambios"][-1]["seq"]
+        marcas_agua[(servidor_fuente, servidor)] = marca
+        if not data["hay_mas"]:
+            return marca
+
+def conviene_snapshot(servidor_fuente, servidor):
+    """Indica si el destino está vacío o tan lejos de la fuente que conviene copiarle un snapshot completo."""
+    raices = en_paralelo(ejecutor_consultas, lambda s: consultar_merkle(s)[1][0], [servidor_fuente, servidor])
+    filas_fuente, filas_destino = raices[servidor_fuente]["filas"], raices[servidor]["filas"]
+    if raices[servidor_fuente]["hash"] == raices[servidor]["hash"] and filas_fuente == filas_destino:
+        return False
+    return filas_fuente > 0 and (filas_destino == 0 or abs(filas_fuente - filas_destino) > SNAPSHOT_FRACCION * filas_fuente)
+
+def copiar_snapshot(servidor_fuente, servidor):
+    """Transmite el snapshot de la fuente directamente a la carga del destino.
+
+    Entre dos servidores PostgreSQL va en COPY binario; si alguno usa otro almacén, en el formato por columnas,
+    que todos saben cargar. Retorna la secuencia del log de la fuente a la que corresponde, desde donde sigue
+    la sincronización incremental.
+    """
+    nativo = monitor.almacen(servidor_fuente) == "postgres" and monitor.almacen(servidor) == "postgres"
+    headers = {} if nativo else {"Accept": formato.TIPO_COLUMNAS}
+    with sesion(servidor_fuente).get(f"{servidor_fuente}/snapshot", stream=True, headers=headers,
+                                     timeout=(3, SNAPSHOT_TIMEOUT)) as origen:
+        origen.raise_for_status()
+        seq = int(origen.headers["X-Snapshot-Seq"])
+        fragmentos = limitador_banda.limitar(origen.iter_content(chunk_size=STREAM_CHUNK))
+        try:
+            response = sesion(servidor).put(f"{servidor}/snapshot", data=fragmentos,
+                                            headers={"Content-Type": origen.headers.get("Content-Type",
+                                                                                        "application/octet-stream")},
+                                            timeout=(3, SNAPSHOT_TIMEOUT))
+        finally:
+            cache.invalidar(servidor)
+        response.raise_for_status()
+    data = response.json()
+    metrica_filas.inc(data["filas"], servidor=servidor)
+    print(f"📸 Snapshot de {servidor_fuente} (seq {seq}) cargado en {servidor}: {data['filas']} productos")
+    return seq
+
+def verificacion_pendiente(servidor_fuente, servidor):
+    """Indica si pasó MERKLE_INTERVALO desde la última verificación completa del destino contra la fuente."""
+    return time.monotonic() - ultima_verificacion.get((servidor_fuente, servidor), float("-inf")) > MERKLE_INTERVALO
+
+def sincronizar_destino(servidor_fuente, servidor):
+    """Lleva un servidor destino al estado de la fuente, de forma incremental si ya tiene marca de agua.
+
+    Un destino sin marca que está vacío o muy atrasado recibe primero un snapshot y sigue desde su secuencia.
+    Retorna True si el destino quedó sincronizado.
+    """
+    try:
+        marca = marcas_agua.get((servidor_fuente, servidor))
+        if marca is None and conviene_snapshot(servidor_fuente, servidor):
+            print(f"\n📸 Copiando un snapshot de {servidor_fuente} a {servidor}...")
+            marca = copiar_snapshot(servidor_fuente, servidor)
+            marcas_agua[(servidor_fuente, servidor)] = marca
+            ultima_verificacion[(servidor_fuente, servidor)] = time.monotonic()
+        if marca is not None:
+            marca = sincronizacion_incremental(servidor_fuente, servidor, marca)
+        if marca is None or verificacion_pendiente(servidor_fuente, servidor):
+            print(f"\n🔄 Sincronización completa de {servidor} con {servidor_fuente}...")
+            # La marca se toma antes de comparar: lo que cambie mientras tanto se reenvía después
+            marca = obtener_ultimo_seq(servidor_fuente)
+            sincronizacion_completa(servidor_fuente, servidor)
+            marcas_agua[(servidor_fuente, servidor)] = marca
+            ultima_verificacion[(servidor_fuente, servidor)] = time.monotonic()
+        return True
+
     except requests.exceptions.RequestException:
-        print(f"⚠️ No se pudo conectar con {servidor}. Esperando sincronización.")
-        return jsonify({"warning": "Servidor no disponible. El cambio se aplicará cuando se sincronice."}), 202
+        print(f"⚠️ No se pudo conectar con {servidor}, esperando a que vuelva.")
+        return False
+    except ErrorSincronizacion as e:
+        print(f"⚠️ Sincronización incompleta: {e}")
+        return False
+
+# Activo mientras hay una suscripción abierta a /eventos
+suscrito = threading.Event()
 
-def sincronizar_servidores():
-    """Sincroniza todos los servidores con los datos del más actualizado, manejando servidores caídos."""
+def escuchar_eventos():
+    """Se suscribe a /eventos del servidor de escritura y avisa a la sincronización de cada cambio.
+
+    Si la conexión se corta o cambia el servidor de escritura, se vuelve a suscribir; mientras tanto cada
+    réplica se revisa al menos cada SYNC_INTERVAL.
+    """
     while True:
-        time.sleep(SYNC_INTERVAL)
-        servidor_fuente = obtener_servidor_mas_actualizado()
+        servidor_fuente = servidor_escritura()
         if not servidor_fuente:
-            print("⚠️ No hay servidores disponibles para sincronizar.")
+            time.sleep(1)
             continue
+        try:
+            with sesion(servidor_fuente).get(f"{servidor_fuente}/eventos", stream=True,
+                                             timeout=(3, EVENTOS_TIMEOUT)) as response:
+                response.raise_for_status()
+                print(f"📡 Suscrito a los eventos de {servidor_fuente}")
+                suscrito.set()
+                for linea in response.iter_lines():
+                    if not linea:
+                        continue
+                    evento = json.loads(linea)
+                    metrica_eventos.inc(tipo=evento["tipo"])
+                    if evento["tipo"] in ("inicio", "cambio"):
+                        planificador.avisar()
+                    if servidor_escritura() != servidor_fuente:
+                        print("🔀 Cambió el servidor de escritura, renovando la suscripción...")
+                        break
+        except (requests.exceptions.RequestException, ValueError):
+            print(f"⚠️ Se perdió la suscripción a los eventos de {servidor_fuente}")
+        finally:
+            if suscrito.is_set():
+                suscrito.clear()
+                planificador.avisar()  # Reconciliar lo que pudo perderse mientras no había suscripción
+        time.sleep(1)
+
+class PlanificadorSincronizacion:
+    """Sincroniza cada réplica en su propio hilo, con su propio intervalo, para que una réplica caída o lenta
+    no demore a las demás.
+
+    Cada hilo revisa su réplica cuando llega un evento de cambio o vence su intervalo. Si solo venció el
+    intervalo y el monitor no ve cambios pendientes, no toca la red. El intervalo sigue la tasa de cambios
+    observada (media móvil): una réplica con muchos cambios se revisa cada SYNC_INTERVALO_MIN y una sin
+    cambios se espacia hasta SYNC_INTERVALO_MAX (SYNC_INTERVAL sin suscripción a /eventos). Una réplica
+    atrasada más de LECTURA_LAG_MAX vuelve al mínimo. Tras un fallo se reintenta con espera exponencial
+    hasta SYNC_BACKOFF_MAX, sin atender los eventos mientras tanto.
+    """
+
+    def __init__(self, servidores):
+        self.servidores = list(servidores)
+        self._lock = threading.Lock()
+        self._avisos = {servidor: threading.Event() for servidor in self.servidores}
+        self._estado = {
+            servidor: {"estado": "pendiente", "intervalo_s": SYNC_INTERVALO_MIN, "tasa_cambios": 0.0,
+                       "fallos_seguidos": 0, "proxima": time.monotonic(), "ultima_revision": None,
+                       "ultima_sincronizacion": None, "duracion_s": None, "cambios": 0, "retraso": None}
+            for servidor in self.servidores
+        }
+        self.activo = False
+
+    def iniciar(self):
+        self.activo = True
+        for servidor in self.servidores:
+            threading.Thread(target=self._ejecutar, args=(servidor,), daemon=True,
+                             name=f"sincronizacion-{servidor}").start()
+
+    def avisar(self):
+        """Despierta a todas las réplicas: hay cambios nuevos en el servidor de escritura."""
+        for aviso in self._avisos.values():
+            aviso.set()
+
+    def _actualizar(self, servidor, **datos):
+        with self._lock:
+            self._estado[servidor].update(datos)
+
+    def _ejecutar(self, servidor):
+        aviso = self._avisos[servidor]
+        while True:
+            with self._lock:
+                info = dict(self._estado[servidor])
+            espera = info["proxima"] - time.monotonic()
+            avisado = aviso.wait(timeout=max(0, espera))
+            if avisado and info["fallos_seguidos"] and time.monotonic() < info["proxima"]:
+                aviso.clear()  # En espera tras un fallo: el evento no adelanta el reintento
+                continue
+            aviso.clear()
+            self._revisar(servidor, info, avisado)
+
+    def _revisar(self, servidor, info, avisado):
+        ahora = time.monotonic()
+        servidor_fuente = servidor_escritura()
+        if servidor_fuente is None or servidor_fuente == servidor:
+            self._actualizar(servidor, estado="fuente" if servidor_fuente else "sin_fuente",
+                             retraso=0 if servidor_fuente else None, intervalo_s=self._tope(),
+                             proxima=ahora + self._tope(), ultima_revision=ahora)
+            return
+
+        atraso = retraso(servidor_fuente, servidor, monitor.version(servidor_fuente))
+        cambios = 0
+        if avisado or atraso != 0 or verificacion_pendiente(servidor_fuente, servidor):
+            self._actualizar(servidor, estado="sincronizando", retraso=atraso)
+            marca_anterior = marcas_agua.get((servidor_fuente, servidor))
+            inicio = time.perf_counter()
+            sincronizado = sincronizar_destino(servidor_fuente, servidor)
+            duracion = time.perf_counter() - inicio
+            metrica_ciclo.observar(duracion)
+            ahora = time.monotonic()
+            if not sincronizado:
+                fallos = info["fallos_seguidos"] + 1
+                espera = min(SYNC_BACKOFF_MAX, SYNC_INTERVALO_MIN * 2 ** fallos) * random.uniform(0.8, 1.2)
+                if fallos == 1 or espera >= SYNC_BACKOFF_MAX * 0.8:
+                    print(f"⏳ {servidor}: reintento de sincronización en {espera:.1f}s ({fallos} fallos seguidos)")
+                self._actualizar(servidor, estado="caida", fallos_seguidos=fallos, intervalo_s=espera,
+                                 proxima=ahora + espera, duracion_s=round(duracion, 3), ultima_revision=ahora)
+                return
+            marca = marcas_agua.get((servidor_fuente, servidor))
+            if marca is not None and marca_anterior is not None:
+                cambios = max(0, marca - marca_anterior)
+            atraso = retraso(servidor_fuente, servidor, monitor.version(servidor_fuente))
+            self._actualizar(servidor, ultima_sincronizacion=time.time(), duracion_s=round(duracion, 3), cambios=cambios)
+
+        # La tasa se calcula también en las revisiones sin cambios, así una réplica inactiva se espacia
+        transcurrido = ahora - info["ultima_revision"] if info["ultima_revision"] is not None else None
+        tasa = info["tasa_cambios"]
+        if transcurrido:
+            tasa = SYNC_SUAVIZADO * cambios / transcurrido + (1 - SYNC_SUAVIZADO) * tasa
+        tope = self._tope()
+        intervalo = min(tope, max(SYNC_INTERVALO_MIN, 1 / tasa)) if tasa > 0 else tope
+        if atraso is not None and atraso > LECTURA_LAG_MAX:
+            intervalo = SYNC_INTERVALO_MIN
+        self._actualizar(servidor, estado="al_dia" if not atraso else "atrasada", retraso=atraso, tasa_cambios=tasa,
+                         intervalo_s=intervalo, fallos_seguidos=0, proxima=ahora + intervalo, ultima_revision=ahora)
+
+    def _tope(self):
+        """Intervalo máximo: sin suscripción a /eventos los cambios solo se notan revisando."""
+        return SYNC_INTERVALO_MAX if suscrito.is_set() else min(SYNC_INTERVALO_MAX, SYNC_INTERVAL)
+
+    def estado(self):
+        """Estado de la sincronización de cada réplica, con la espera hasta su próxima revisión."""
+        with self._lock:
+            ahora = time.monotonic()
+            return {
+                servidor: {
+                    "estado": info["estado"],
+                    "retraso": info["retraso"],
+                    "tasa_cambios": round(info["tasa_cambios"], 3),
+                    "intervalo_s": round(info["intervalo_s"], 3),
+                    "proxima_en_s": round(max(0, info["proxima"] - ahora), 3),
+                    "fallos_seguidos": info["fallos_seguidos"],
+                    "cambios_ultima": info["cambios"],
+                    "duracion_s": info["duracion_s"],
+                    "ultima_sincronizacion": (datetime.fromtimestamp(info["ultima_sincronizacion"]).isoformat()
+                                              if info["ultima_sincronizacion"] else None),
+                }
+                for servidor, info in self._estado.items()
+            }
+
+planificador = PlanificadorSincronizacion(SERVIDORES)
+
+def retrasos_replicas():
+    referencia = servidor_escritura()
+    seq_referencia = monitor.version(referencia) if referencia else None
+    return {(servidor,): retraso(referencia, servidor, seq_referencia) for servidor in SERVIDORES}
+
+def estado_planificador():
+    if not planificador.activo:
+        return {}
+    estado = planificador.estado()
+    return {(servidor, dato): info[dato] for servidor, info in estado.items()
+            for dato in ("intervalo_s", "tasa_cambios", "fallos_seguidos", "retraso")}
+
+def estadisticas_cache():
+    estadisticas = cache.estadisticas()
+    return {(resultado,): estadisticas[resultado] for resultado in ("aciertos", "revalidadas", "fallos")}
+
+def estados_circuitos():
+    return {(servidor, estado): int(circuito.estado == estado)
+            for servidor, circuito in list(circuitos.items()) for estado in ("cerrado", "abierto", "semiabierto")}
+
+metricas.Medidor("proxy_circuito_estado", "Estado del cortacircuitos de cada servidor (1 en el estado actual)",
+                 ("servidor", "estado"), funcion=estados_circuitos)
+metricas.Medidor("replicacion_retraso_cambios", "Cambios del servidor de escritura pendientes en cada réplica",
+                 ("servidor",), funcion=retrasos_replicas)
+def estadisticas_cola():
+    estadisticas = cola.estadisticas()
+    return {("profundidad",): estadisticas["profundidad"], ("antiguedad_s",): estadisticas["antiguedad_s"]}
+
+metricas.Medidor("cola_escrituras", "Escrituras diferidas pendientes y antigüedad en segundos de la más vieja",
+                 ("dato",), funcion=estadisticas_cola)
+metricas.Medidor("sync_replica", "Intervalo, tasa de cambios, fallos seguidos y retraso de la sincronización de cada réplica",
+                 ("servidor", "dato"), funcion=estado_planificador)
+metricas.Medidor("proxy_cache_solicitudes", "Solicitudes GET resueltas por la caché del proxy, por resultado",
+                 ("resultado",), funcion=estadisticas_cache)
+
+def copiar_marcas_agua():
+    """Trae las marcas de agua del proceso sincronizador, al ritmo del monitor.
+
+    Con produccion.py los workers no sincronizan: sin esto no sabrían el retraso de cada réplica y no habría
+    réplicas al día para las lecturas balanceadas ni con cobertura.
+    """
+    while True:
+        try:
+            response = requests.get(f"{SINCRONIZADOR_URL}/sincronizacion", timeout=MONITOR_TIMEOUT)
+            response.raise_for_status()
+            nuevas = {(m["fuente"], m["destino"]): m["marca"] for m in response.json()["marcas_agua"]}
+            marcas_agua.update(nuevas)
+            for clave in set(marcas_agua) - set(nuevas):
+                marcas_agua.pop(clave, None)
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            pass  # Se conservan las últimas: con el tiempo muestran más retraso, no menos
+        time.sleep(MONITOR_INTERVALO)
+
+def iniciar_proceso():
+    """Arranca el monitor de este proceso. Con produccion.py corre en cada worker, después del fork."""
+    monitor.actualizar()  # Estado inicial antes de aceptar solicitudes
+    monitor.iniciar()
+    if SINCRONIZADOR_URL and not MODO_FRAGMENTADO:
+        threading.Thread(target=copiar_marcas_agua, daemon=True).start()
+
+def iniciar_sincronizacion():
+    """Arranca los hilos de sincronización, de suscripción a /eventos y de la cola de escrituras.
 
-        for servidor in SERVIDORES:
-            if servidor != servidor_fuente:
-                try:
-                    print(f"\n🔄 Sincronizando {servidor} con {servidor_fuente}...")
-
-                    # Obtener lista de productos del servidor más actualizado
-                    response_fuente = requests.get(f"{servidor_fuente}/productos", timeout=3)
-                    response_servidor = requests.get(f"{servidor}/productos", timeout=3)
-
-                    if response_fuente.status_code == 200 and response_servidor.status_code == 200:
-                        productos_fuente = {p[0]: p for p in response_fuente.json()}  # Diccionario {id: producto}
-                        productos_servidor = {p[0] for p in response_servidor.json()}  # Conjunto de IDs
-
-                        print(f"📥 Productos en {servidor_fuente}: {productos_fuente.keys()}")
-                        print(f"📤 Productos en {servidor}: {productos_servidor}")
-
-                        # 🔹 Actualizar o crear productos
-                        for id_producto, producto in productos_fuente.items():
-                            producto_dict = {
-                                "id": producto[0],
-                                "nombre": producto[1],
-                                "descripcion": producto[2],
-                                "cantidad": int(producto[3]),
-                                "precio": float(producto[4]),
-                                "ultima_modificacion": producto[5]
-                            }
-
-                            if id_producto in productos_servidor:
-                                print(f"📝 Actualizando producto {id_producto} en {servidor}...")
-                                requests.put(f"{servidor}/productos/{id_producto}", json=producto_dict, timeout=3)
-                            else:
-                                print(f"➕ Creando producto {id_producto} en {servidor}...")
-                                requests.post(f"{servidor}/productos", json=producto_dict, timeout=3)
-
-                        # 🔹 Manejar eliminaciones
-                        productos_eliminados = productos_servidor - productos_fuente.keys()
-                        for producto_id in productos_eliminados:
-                            print(f"🗑️ Eliminando producto {producto_id} en {servidor}...")
-                            requests.delete(f"{servidor}/productos/{producto_id}", timeout=3)
-
-                except requests.exceptions.RequestException:
-                    print(f"⚠️ No se pudo conectar con {servidor}, esperando a que vuelva.")
+    Debe correr en un solo proceso: con produccion.py es el proceso sincronizador, no los workers.
+    """
+    if MODO_FRAGMENTADO:
+        # Cada producto vive solo en sus propietarios: la replicación completa entre servidores no aplica,
+        # pero la cola repara los propietarios en los que falló una escritura
+        print(f"🧩 Modo fragmentado: {len(anillo.nodos)} servidores, factor de replicación {anillo.replicas}")
+        threading.Thread(target=reproducir_cola, daemon=True).start()
+        return
+    planificador.iniciar()
+    threading.Thread(target=escuchar_eventos, daemon=True).start()
+    threading.Thread(target=reproducir_cola, daemon=True).start()
 
 if __name__ == "__main__":
     print("🔄 Iniciando módulo de replicación como Proxy y sincronizador...")
-    threading.Thread(target=sincronizar_servidores, daemon=True).start()
+    iniciar_proceso()
+    iniciar_sincronizacion()
     app.run(host="0.0.0.0", port=4000)
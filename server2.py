@@ -1,157 +1,692 @@
-from flask import Flask, request, jsonify
-import psycopg2
+from flask import Flask, Response, request, jsonify
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import hashlib
+import json
 import os
+import formato
+import metricas
+import trazas
+from cache_productos import CacheProductos
+from almacen import AlmacenNoDisponibleError, StockInsuficienteError, TIPO_COPY, crear_almacen
 
 app = Flask(__name__)
+metricas.instrumentar(app)
+formato.comprimir_respuestas(app)
 
 # Configuración de la base de datos desde variables de entorno
+ALMACEN = os.getenv("ALMACEN", "postgres")  # "postgres", o "sqlite" para un servidor embebido sin PostgreSQL
 DB_HOST = os.getenv("DB_HOST", "db")
 DB_NAME = os.getenv("DB_NAME", "my_db")
 DB_USER = os.getenv("DB_USER", "cliente_sistema")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "misistema")
 SERVER_NAME = os.getenv("SERVER_NAME", os.uname().nodename)  # Nombre único del servidor
+SQLITE_RUTA = os.getenv("SQLITE_RUTA", f"{SERVER_NAME}.db")  # Archivo de la base con ALMACEN=sqlite
+PORT = int(os.getenv("PORT", "5002"))  # Puerto HTTP del servidor
 
-def conectar_bd():
-    """Intenta conectar a la base de datos y muestra si la conexión fue exitosa o fallida."""
-    try:
-        conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
-        print(f"✅ Conexión exitosa a la base de datos {DB_NAME} en {DB_HOST}")
-        return conn
-    except Exception as e:
-        print(f"❌ Error al conectar a la base de datos: {e}")
+trazas.instrumentar(app, SERVER_NAME)
+
+# Configuración del pool de conexiones
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))  # Conexiones abiertas al iniciar
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))  # Máximo de conexiones simultáneas a PostgreSQL
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # Segundos de espera para obtener una conexión
+DB_POOL_HEALTHCHECK = float(os.getenv("DB_POOL_HEALTHCHECK", "30"))  # Segundos de inactividad antes de verificar una conexión
+
+CAMBIOS_LIMITE = 1000  # Máximo de entradas del log de cambios por respuesta
+EVENTOS_LATIDO = float(os.getenv("EVENTOS_LATIDO", "15"))  # Segundos sin eventos antes de enviar un latido por /eventos
+BULK_MAX = 10000  # Máximo de operaciones por solicitud a /productos/bulk
+CAMPOS_PRODUCTO = ("nombre", "descripcion", "cantidad", "precio")
+PAGINA_MAX = 1000  # Máximo de productos por página en GET /productos?limit=
+ORDENES_PRODUCTO = ("id", "nombre", "cantidad", "precio", "ultima_modificacion")  # Columnas válidas para ?orden=
+STREAM_ITERSIZE = 500  # Filas que trae el cursor del servidor en cada viaje al transmitir NDJSON o bloques por columnas
+MERKLE_RANGO = 1024  # IDs por hoja del árbol de Merkle (debe coincidir con create_db.py)
+MERKLE_HOJAS = 2**31 // MERKLE_RANGO  # Hojas necesarias para cubrir todas las IDs (INT)
+MERKLE_PARTES_MAX = 256  # Máximo de subrangos por consulta a /merkle
+CACHE_PRODUCTOS_ENTRADAS = int(os.getenv("CACHE_PRODUCTOS_ENTRADAS", "10000"))  # Filas en la caché de lecturas por ID (0 la desactiva)
+CACHE_PRODUCTOS_TTL = float(os.getenv("CACHE_PRODUCTOS_TTL", "30"))  # Segundos que vale una fila guardada
+CACHE_PRODUCTOS_VERIFICACION = int(os.getenv("CACHE_PRODUCTOS_VERIFICACION", "100"))  # Milisegundos entre consultas del log de cambios de otros workers
+
+if ALMACEN == "sqlite":
+    almacen = crear_almacen(ALMACEN, ruta=SQLITE_RUTA, servidor=SERVER_NAME, merkle_rango=MERKLE_RANGO,
+                            timeout=DB_POOL_TIMEOUT, tanda=STREAM_ITERSIZE)
+else:
+    almacen = crear_almacen(ALMACEN, host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                            servidor=SERVER_NAME, merkle_rango=MERKLE_RANGO, pool_min=DB_POOL_MIN, pool_max=DB_POOL_MAX,
+                            pool_timeout=DB_POOL_TIMEOUT, pool_salud=DB_POOL_HEALTHCHECK, tanda=STREAM_ITERSIZE)
+
+cache_productos = CacheProductos(CACHE_PRODUCTOS_ENTRADAS, CACHE_PRODUCTOS_TTL, CACHE_PRODUCTOS_VERIFICACION / 1000)
+
+def estadisticas_cache_productos():
+    estadisticas = cache_productos.estadisticas()
+    return {(dato,): estadisticas[dato] for dato in ("entradas", "aciertos", "fallos", "vencidas", "desalojos",
+                                                     "invalidaciones")}
+
+metricas.Medidor("servidor_cache_productos", "Caché de lecturas por ID: filas guardadas y consultas por resultado",
+                 ("dato",), funcion=estadisticas_cache_productos)
+
+def respuesta_error(e):
+    """Respuesta JSON para una excepción: 503 si el almacén no está disponible (p. ej. pool agotado), 500 en otro caso."""
+    return jsonify({"error": str(e)}), 503 if isinstance(e, AlmacenNoDisponibleError) else 500
+
+def cambio_a_dict(fila):
+    """Convierte una fila del log de cambios en un diccionario serializable."""
+    seq, producto_id, eliminado, nombre, descripcion, cantidad, precio, ultima_modificacion, delta, hlc, nodo = fila
+    return {
+        "seq": seq,
+        "id": producto_id,
+        "eliminado": eliminado,
+        "nombre": nombre,
+        "descripcion": descripcion,
+        "cantidad": cantidad,
+        "precio": float(precio) if precio is not None else None,
+        "ultima_modificacion": ultima_modificacion.isoformat() if ultima_modificacion else None,
+        "delta": delta,
+        "hlc": hlc,
+        "nodo": nodo,
+    }
+
+def sello_operacion(op):
+    """Sello (hlc, nodo) de una operación replicada de /productos/bulk, o None si es local. Lanza ValueError si es inválido."""
+    if op.get("hlc") is None:
         return None
+    return int(op["hlc"]), str(op.get("nodo") or "")
 
-def registrar_cambio():
-    """Registra en la tabla de sincronización que hubo un cambio en este servidor."""
-    try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO sincronizacion (servidor, ultimo_cambio)
-            VALUES (%s, NOW())
-            ON CONFLICT (servidor) DO UPDATE 
-            SET ultimo_cambio = EXCLUDED.ultimo_cambio;
-        """, (SERVER_NAME,))
-        conn.commit()
-        cur.close()
-        conn.close()
-    except Exception as e:
-        print(f"⚠️ Error al registrar cambio en sincronización: {e}")
+def error_campos_producto(op):
+    """Mensaje de error si los campos de un UPSERT de /productos/bulk no tienen el tipo esperado, o None."""
+    if any(campo not in op for campo in CAMPOS_PRODUCTO):
+        return "Faltan campos del producto"
+    if not isinstance(op["nombre"], str) or not isinstance(op["descripcion"], (str, type(None))):
+        return "El nombre y la descripción deben ser texto"
+    if not isinstance(op["cantidad"], int) or isinstance(op["cantidad"], bool):
+        return "La cantidad debe ser un entero"
+    precio = op["precio"]
+    if not isinstance(precio, (int, float, Decimal)) or isinstance(precio, bool) or not Decimal(precio).is_finite():
+        return "El precio debe ser un número"
+    return None
 
 @app.route("/productos", methods=["POST"])
 def crear_producto():
     """Crea un producto. Si se proporciona ID (sincronización), la respeta; si no, la base de datos la genera."""
     data = request.json
     try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-
-        if "id" in data:
-            # 🔹 Si viene de sincronización, se usa la misma ID
-            cur.execute("""
-                INSERT INTO productos (id, nombre, descripcion, cantidad, precio, ultima_modificacion) 
-                VALUES (%s, %s, %s, %s, %s, NOW())
-                ON CONFLICT (id) DO UPDATE 
-                SET nombre=EXCLUDED.nombre, descripcion=EXCLUDED.descripcion, 
-                    cantidad=EXCLUDED.cantidad, precio=EXCLUDED.precio, 
-                    ultima_modificacion=NOW()
-            """, (data["id"], data["nombre"], data["descripcion"], data["cantidad"], data["precio"]))
-            producto_id = data["id"]
-        else:
-            # 🔹 Si lo crea el usuario, la ID es automática
-            cur.execute("""
-                INSERT INTO productos (nombre, descripcion, cantidad, precio, ultima_modificacion) 
-                VALUES (%s, %s, %s, %s, NOW()) RETURNING id
-            """, (data["nombre"], data["descripcion"], data["cantidad"], data["precio"]))
-            producto_id = cur.fetchone()[0]  # Obtener la ID generada automáticamente
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        registrar_cambio()  # Registrar el cambio
+        # 🔹 Si viene de sincronización se usa la misma ID; si lo crea el usuario, la ID es automática
+        producto_id = almacen.guardar_producto(data, data.get("id"))
+        cache_productos.invalidar([producto_id])
         return jsonify({"id": producto_id, "message": "Producto creado"}), 201
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respuesta_error(e)
+
+@app.route("/productos/bulk", methods=["POST"])
+def bulk_productos():
+    """Aplica en una sola transacción un lote de UPSERTs y eliminaciones.
+
+    Cuerpo: {"operaciones": [{"op": "upsert", "id": 1, "nombre": ..., ...}, {"op": "delete", "id": 2},
+    {"op": "stock", "id": 3, "delta": -1}, ...]}. También acepta el formato por columnas (opcionalmente con
+    gzip): un bloque de UPSERTs, uno de IDs a eliminar y, opcional, uno de ajustes de stock.
+    Un UPSERT sin ID crea el producto con ID automática. Si varias operaciones tocan la misma ID solo se
+    aplica la última, salvo los ajustes de stock, que se suman a la operación anterior. Las operaciones
+    replicadas traen el sello de su origen en "hlc" y "nodo": un UPSERT o una eliminación más vieja que la fila
+    actual se omite, igual que un ajuste que la fila ya tiene. Los ajustes seguidos con sellos distintos no se
+    suman: cada uno se aplica con su sello. Retorna un resultado por operación, en el mismo orden.
+    """
+    if request.mimetype == formato.TIPO_COLUMNAS:
+        try:
+            operaciones = operaciones_columnas()
+        except Exception:
+            return jsonify({"error": "Cuerpo por columnas inválido"}), 400
+    else:
+        cuerpo = request.get_json(silent=True)
+        operaciones = cuerpo.get("operaciones") if isinstance(cuerpo, dict) else None
+    if not isinstance(operaciones, list):
+        return jsonify({"error": "Se esperaba una lista 'operaciones'"}), 400
+    if len(operaciones) > BULK_MAX:
+        return jsonify({"error": f"Máximo {BULK_MAX} operaciones por solicitud"}), 413
+
+    operaciones = list(operaciones)  # Un ajuste de stock puede reemplazarse por su combinación con la operación anterior
+    resultados = [None] * len(operaciones)
+    ultima_por_id = {}  # {id: índice de la última operación sobre esa ID}
+    ajuste_anterior = {}  # {índice de un ajuste: índice del ajuste anterior de la misma ID, con otro sello}
+    nuevos = []  # Índices de los UPSERTs sin ID
+    for i, op in enumerate(operaciones):
+        tipo = op.get("op", "upsert") if isinstance(op, dict) else None
+        if tipo not in ("upsert", "delete", "stock"):
+            resultados[i] = {"estado": "error", "error": "Operación inválida"}
+            continue
+        error = error_campos_producto(op) if tipo == "upsert" else None
+        if error:
+            resultados[i] = {"id": op.get("id"), "estado": "error", "error": error}
+            continue
+        if tipo == "stock" and (not isinstance(op.get("delta"), int) or isinstance(op["delta"], bool)):
+            resultados[i] = {"id": op.get("id"), "estado": "error", "error": "Falta el delta entero del ajuste"}
+            continue
+        try:
+            sello_operacion(op)
+        except (TypeError, ValueError):
+            resultados[i] = {"id": op.get("id"), "estado": "error", "error": "Sello (hlc, nodo) inválido"}
+            continue
+        if "id" not in op:
+            if tipo != "upsert":
+                resultados[i] = {"estado": "error", "error": "Falta la ID del producto"}
+            else:
+                nuevos.append(i)
+            continue
+        try:
+            producto_id = int(op["id"])
+        except (TypeError, ValueError):
+            resultados[i] = {"id": op["id"], "estado": "error", "error": "ID inválida"}
+            continue
+        anterior = ultima_por_id.get(producto_id)
+        if tipo == "stock" and anterior is not None:
+            previa = operaciones[anterior]
+            tipo_previo = previa.get("op", "upsert")
+            if tipo_previo == "delete":
+                resultados[i] = {"id": producto_id, "estado": "no_encontrado"}
+                continue
+            if tipo_previo == "stock" and sello_operacion(previa) != sello_operacion(op):
+                # Si se sumaran, el destino que ya tiene el anterior lo volvería a sumar con el sello del último
+                ajuste_anterior[i] = anterior
+                ultima_por_id[producto_id] = i
+                continue
+            # El ajuste se suma a la cantidad del UPSERT anterior o al delta del ajuste anterior, con su propio sello
+            campo = "cantidad" if tipo_previo == "upsert" else "delta"
+            try:
+                operaciones[i] = dict(previa, **{campo: int(previa[campo]) + op["delta"], "hlc": op.get("hlc"),
+                                                 "nodo": op.get("nodo")})
+            except (TypeError, ValueError):
+                resultados[i] = {"id": producto_id, "estado": "error", "error": "Cantidad inválida"}
+                continue
+            if anterior in ajuste_anterior:
+                ajuste_anterior[i] = ajuste_anterior.pop(anterior)
+        # Un UPSERT o una eliminación reemplaza también a los ajustes encadenados antes
+        while anterior is not None:
+            resultados[anterior] = {"id": producto_id, "estado": "reemplazada"}
+            anterior = ajuste_anterior.pop(anterior, None) if tipo != "stock" else None
+        ultima_por_id[producto_id] = i
+
+    upserts = {pid: i for pid, i in ultima_por_id.items() if operaciones[i].get("op", "upsert") == "upsert"}
+    eliminaciones = {pid: i for pid, i in ultima_por_id.items() if operaciones[i].get("op") == "delete"}
+    ajustes = []  # Índices de los ajustes, los de cada ID en orden
+    for i in ultima_por_id.values():
+        if operaciones[i].get("op") == "stock":
+            cadena = [i]
+            while cadena[-1] in ajuste_anterior:
+                cadena.append(ajuste_anterior[cadena[-1]])
+            ajustes += reversed(cadena)
+    try:
+        insertados, ids_nuevos, eliminados, estados_ajustes, omitidos = almacen.aplicar_lote(
+            [(pid, *(operaciones[i][campo] for campo in CAMPOS_PRODUCTO), sello_operacion(operaciones[i]))
+             for pid, i in upserts.items()],
+            [tuple(operaciones[i][campo] for campo in CAMPOS_PRODUCTO) for i in nuevos],
+            [(pid, sello_operacion(operaciones[i])) for pid, i in eliminaciones.items()],
+            [(int(operaciones[i]["id"]), operaciones[i]["delta"], sello_operacion(operaciones[i])) for i in ajustes])
+        cache_productos.invalidar([*upserts, *eliminaciones, *(int(operaciones[i]["id"]) for i in ajustes)])
+        for pid, insertado in insertados.items():
+            resultados[upserts[pid]] = {"id": pid, "estado": "creado" if insertado else "actualizado"}
+        for i, pid in zip(nuevos, ids_nuevos):
+            resultados[i] = {"id": pid, "estado": "creado"}
+        for pid, i in eliminaciones.items():
+            resultados[i] = {"id": pid, "estado": "no_encontrado"}
+        for pid in eliminados:
+            resultados[eliminaciones[pid]] = {"id": pid, "estado": "eliminado"}
+        for i, estado in zip(ajustes, estados_ajustes):
+            resultados[i] = {"id": int(operaciones[i]["id"]), "estado": estado}
+        for pid in omitidos:
+            # El destino ya tiene una versión más nueva de la fila
+            resultados[upserts.get(pid, eliminaciones.get(pid))] = {"id": pid, "estado": "omitido"}
+
+        errores = sum(1 for r in resultados if r["estado"] == "error")
+        ajustados = estados_ajustes.count("ajustado")
+        omitidas = len(omitidos) + estados_ajustes.count("omitido")
+        aplicadas = len(insertados) + len(ids_nuevos) + len(eliminados) + ajustados
+        return jsonify({"resultados": resultados, "aplicadas": aplicadas, "omitidas": omitidas,
+                        "errores": errores}), 200
+    except Exception as e:
+        return respuesta_error(e)
+
+def operaciones_columnas():
+    """Convierte un cuerpo por columnas de /productos/bulk (UPSERTs, eliminaciones y ajustes) en operaciones."""
+    upserts, eliminaciones, *ajustes = formato.separar_bloques(formato.cuerpo_solicitud())
+    operaciones = [{"op": "upsert", "id": pid, "nombre": nombre, "descripcion": descripcion,
+                    "cantidad": cantidad, "precio": precio, "hlc": hlc, "nodo": nodo}
+                   for pid, nombre, descripcion, cantidad, precio, hlc, nodo
+                   in formato.decodificar(upserts, formato.ESQUEMA_UPSERT)]
+    operaciones += [{"op": "delete", "id": pid, "hlc": hlc, "nodo": nodo}
+                    for pid, hlc, nodo in formato.decodificar(eliminaciones, formato.ESQUEMA_ELIMINACION)]
+    for bloque in ajustes:
+        operaciones += [{"op": "stock", "id": pid, "delta": delta, "hlc": hlc, "nodo": nodo}
+                        for pid, delta, hlc, nodo in formato.decodificar(bloque, formato.ESQUEMA_AJUSTE)]
+    return operaciones
+
+def quiere_ndjson():
+    """Indica si el cliente pidió la respuesta transmitida como NDJSON."""
+    return request.args.get("formato") == "ndjson" or "application/x-ndjson" in request.headers.get("Accept", "")
+
+def transmitir_filas(tandas, columnas=False):
+    """Transmite las tandas de filas de almacen.transmitir_productos (STREAM_ITERSIZE filas cada una).
+
+    En NDJSON va una fila por línea; con `columnas`, un bloque del formato por columnas por cada tanda.
+    La primera tanda se obtiene antes de responder para que los errores de conexión o de SQL todavía
+    puedan devolverse como un error normal.
+    """
+    def generar():
+        for filas in tandas:
+            if columnas:
+                yield formato.codificar(filas, formato.ESQUEMA_PRODUCTO)
+            else:
+                yield "".join(app.json.dumps(fila) + "\n" for fila in filas)
+
+    filas = generar()
+    try:
+        primera = next(filas, "")
+    except Exception as e:
+        return respuesta_error(e)
+
+    def continuar():
+        yield primera
+        yield from filas
+
+    return Response(continuar(), mimetype=formato.TIPO_COLUMNAS if columnas else "application/x-ndjson")
+
+def filtros_productos():
+    """Lee y convierte los filtros de GET /productos; cada almacén los traduce a condiciones que usan sus índices.
+
+    Retorna ({filtro: valor}, columna de orden, descendente). Lanza ValueError si alguno es inválido.
+    """
+    filtros = {}
+    args = request.args
+    for parametro, convertir in (("prefijo", str), ("buscar", str), ("after", int), ("before", int),
+                                 ("precio_min", Decimal), ("precio_max", Decimal),
+                                 ("cantidad_min", int), ("cantidad_max", int),
+                                 ("modificado_desde", datetime.fromisoformat)):
+        if args.get(parametro):
+            try:
+                filtros[parametro] = convertir(args[parametro])
+            except (ValueError, InvalidOperation):
+                raise ValueError(f"Valor inválido para {parametro}: {args[parametro]}")
+
+    orden = args.get("orden", "id")
+    descendente = orden.startswith("-")
+    orden = orden.lstrip("-")
+    if orden not in ORDENES_PRODUCTO:
+        raise ValueError(f"Orden inválido: se acepta {', '.join(ORDENES_PRODUCTO)}, con '-' para descendente")
+    return filtros, orden, descendente
+
+def no_modificado(etag):
+    """Respuesta 304 para un GET condicional cuyo ETag coincide con la versión actual."""
+    response = Response(status=304)
+    response.set_etag(etag)
+    return response
+
+@app.route("/ids", methods=["POST"])
+def reservar_ids():
+    """Reserva `cantidad` IDs de la secuencia de productos sin crear filas.
+
+    El replicador en modo fragmentado crea todos los productos con IDs de un único servidor, para que
+    no se repitan entre fragmentos.
+    """
+    cantidad = max(1, min(request.args.get("cantidad", 1, type=int), BULK_MAX))
+    try:
+        ids = almacen.reservar_ids(cantidad)
+        return jsonify({"ids": ids}), 201
+    except Exception as e:
+        return respuesta_error(e)
 
 @app.route("/productos", methods=["GET"])
 def obtener_productos():
-    """Obtiene todos los productos almacenados en la base de datos."""
+    """Obtiene los productos almacenados en la base de datos, ordenados por ID.
+
+    Sin parámetros retorna la tabla completa. Con `limit` pagina por clave: `after` es la última ID de la
+    página anterior y la respuesta incluye la ID `siguiente`. `before` acota las IDs por arriba (exclusivo).
+    Filtros: `prefijo` o `buscar` (subcadena, sin distinguir mayúsculas) en el nombre, `precio_min`/`precio_max`,
+    `cantidad_min`/`cantidad_max` y `modificado_desde` (ISO 8601). `orden` ordena por otra columna (con '-'
+    delante, descendente); en ese caso `limit` retorna los primeros y no hay `siguiente`.
+    Con `formato=ndjson` (o Accept: application/x-ndjson) transmite una fila por línea a medida que se leen, y
+    con Accept: application/x-columnas transmite bloques del formato por columnas (lo usa el replicador).
+    La respuesta lleva un ETag con la versión de la tabla; un GET con If-None-Match igual recibe 304.
+    """
+    limit = request.args.get("limit", type=int)
     try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM productos")
-        productos = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify(productos)
+        filtros, orden, descendente = filtros_productos()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # La versión se lee antes que las filas: si cambia en medio, el ETag queda atrasado y el próximo GET no da 304
+    try:
+        etag = f"{SERVER_NAME}-{almacen.version()}"
+    except Exception as e:
+        return respuesta_error(e)
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+
+    if quiere_ndjson() or formato.acepta_columnas():
+        tandas = almacen.transmitir_productos(filtros, orden, descendente, max(0, limit) if limit is not None else None,
+                                              STREAM_ITERSIZE)
+        response = transmitir_filas(tandas, columnas=formato.acepta_columnas())
+        if isinstance(response, Response):
+            response.set_etag(etag)
+        return response
+
+    if limit is not None:
+        limit = max(1, min(limit, PAGINA_MAX))
+    try:
+        productos = almacen.listar_productos(filtros, orden, descendente, limit)
+        if limit is None:
+            response = jsonify(productos)
+        else:
+            siguiente = productos[-1][0] if len(productos) == limit and (orden, descendente) == ("id", False) else None
+            response = jsonify({"productos": productos, "siguiente": siguiente})
+        response.set_etag(etag)
+        return response
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respuesta_error(e)
+
+def ids_cambiadas(desde, hasta):
+    """IDs tocadas en el log de cambios entre dos secuencias, o None si son más de las que caben en la caché."""
+    if hasta - desde > CACHE_PRODUCTOS_ENTRADAS:
+        return None
+    _, entradas = almacen.cambios(desde, hasta - desde)
+    return {entrada[1] for entrada in entradas}
+
+def buscar_productos(ids):
+    """Filas de los productos con esas IDs, en el mismo orden y sin las que no existen.
+
+    Las que no están en la caché se leen juntas del almacén con una sola consulta. Antes se descartan de la
+    caché las filas que otro proceso cambió, según el log de cambios, que se consulta cada
+    CACHE_PRODUCTOS_VERIFICACION ms.
+    """
+    if CACHE_PRODUCTOS_ENTRADAS > 0:
+        cache_productos.ponerse_al_dia(almacen.version, ids_cambiadas)
+    generacion = cache_productos.generacion()
+    encontradas = cache_productos.obtener(ids)
+    faltan = [pid for pid in ids if pid not in encontradas]
+    if faltan:
+        filas = almacen.obtener_productos(faltan)
+        cache_productos.guardar(filas, generacion)
+        encontradas.update((fila[0], fila) for fila in filas)
+    return [encontradas[pid] for pid in ids if pid in encontradas]
+
+def etag_filas(filas):
+    """ETag de un conjunto de filas a partir de sus sellos (hlc, nodo), que cambian con cada escritura."""
+    sellos = ",".join(f"{fila[0]}:{fila[6]}:{fila[7]}" for fila in filas)
+    return f"{SERVER_NAME}-{hashlib.md5(sellos.encode()).hexdigest()}"
+
+@app.route("/productos/<int:id>", methods=["GET"])
+def obtener_producto(id):
+    """Obtiene un producto por ID, con las mismas columnas que GET /productos, desde la caché si está.
+
+    La respuesta lleva un ETag con el sello de la fila; un GET con If-None-Match igual recibe 304.
+    """
+    try:
+        filas = buscar_productos([id])
+    except Exception as e:
+        return respuesta_error(e)
+    if not filas:
+        return jsonify({"error": "Producto no encontrado"}), 404
+    etag = etag_filas(filas)
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+    response = jsonify(filas[0])
+    response.set_etag(etag)
+    return response
+
+@app.route("/productos/lote", methods=["GET"])
+def obtener_lote_productos():
+    """Obtiene varios productos por ID en una sola solicitud: `ids=1,2,3` (hasta PAGINA_MAX).
+
+    Retorna los productos encontrados en el orden pedido y las IDs que no existen en `faltantes`.
+    """
+    try:
+        ids = list(dict.fromkeys(int(pid) for pid in request.args.get("ids", "").split(",") if pid.strip()))
+    except ValueError:
+        return jsonify({"error": "Se esperaba `ids` con IDs enteras separadas por comas"}), 400
+    if not ids:
+        return jsonify({"error": "Se esperaba `ids` con IDs enteras separadas por comas"}), 400
+    if len(ids) > PAGINA_MAX:
+        return jsonify({"error": f"Máximo {PAGINA_MAX} IDs por solicitud"}), 413
+    try:
+        filas = buscar_productos(ids)
+    except Exception as e:
+        return respuesta_error(e)
+    etag = etag_filas(filas)
+    if request.if_none_match.contains(etag):
+        return no_modificado(etag)
+    encontradas = {fila[0] for fila in filas}
+    response = jsonify({"productos": filas, "faltantes": [pid for pid in ids if pid not in encontradas]})
+    response.set_etag(etag)
+    return response
+
+@app.route("/cache", methods=["GET"])
+def estadisticas_cache():
+    """Retorna las estadísticas de la caché de lecturas por ID: tasa de aciertos, vencidas y desalojos."""
+    return jsonify(cache_productos.estadisticas())
 
 @app.route("/productos/<int:id>", methods=["PUT"])
 def actualizar_producto(id):
     """Actualiza un producto y registra el cambio en sincronización."""
     data = request.json
     try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-        cur.execute("""
-            UPDATE productos 
-            SET nombre=%s, descripcion=%s, cantidad=%s, precio=%s, ultima_modificacion=NOW()
-            WHERE id=%s
-        """, (data.get("nombre"), data.get("descripcion"), data.get("cantidad"), data.get("precio"), id))
-
-        if cur.rowcount == 0:
+        if not almacen.actualizar_producto(id, data):
             return jsonify({"error": "Producto no encontrado"}), 404
-
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        registrar_cambio()  # Registrar el cambio
+        cache_productos.invalidar([id])
         return jsonify({"message": "Producto actualizado"}), 200
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respuesta_error(e)
 
 @app.route("/productos/<int:id>", methods=["DELETE"])
 def eliminar_producto(id):
     """Elimina un producto y registra el cambio en sincronización."""
     try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM productos WHERE id=%s", (id,))
+        if not almacen.eliminar_producto(id):
+            return jsonify({"error": "Producto no encontrado"}), 404
+        cache_productos.invalidar([id])
+        return jsonify({"message": "Producto eliminado"}), 200
+    except Exception as e:
+        return respuesta_error(e)
 
-        if cur.rowcount == 0:
+@app.route("/productos/<int:id>/stock", methods=["PATCH"])
+def ajustar_stock(id):
+    """Suma `delta` a la cantidad de un producto con un solo UPDATE condicional, sin leer antes la fila.
+
+    Con `minimo`, el ajuste solo se aplica si la cantidad resultante no queda por debajo; si quedaría, responde
+    409 con la cantidad actual. Las ventas concurrentes no se pisan porque nadie escribe un valor absoluto.
+    """
+    data = request.json or {}
+    delta, minimo = data.get("delta"), data.get("minimo")
+    if not isinstance(delta, int) or (minimo is not None and not isinstance(minimo, int)):
+        return jsonify({"error": "Se esperaba un 'delta' entero y, opcionalmente, un 'minimo' entero"}), 400
+    try:
+        aplicado, cantidad = almacen.ajustar_stock(id, delta, minimo)
+        if aplicado:
+            cache_productos.invalidar([id])
+        if cantidad is None:
             return jsonify({"error": "Producto no encontrado"}), 404
+        if not aplicado:
+            return jsonify({"error": "Stock insuficiente", "id": id, "cantidad": cantidad}), 409
+        return jsonify({"id": id, "cantidad": cantidad}), 200
+    except Exception as e:
+        return respuesta_error(e)
 
-        conn.commit()
-        cur.close()
-        conn.close()
+@app.route("/productos/stock", methods=["POST"])
+def reservar_stock():
+    """Aplica varios ajustes de stock de forma atómica: se aplican todos o ninguno.
 
-        registrar_cambio()  # Registrar el cambio
-        return jsonify({"message": "Producto eliminado"}), 200
+    Cuerpo: {"ajustes": [{"id": 1, "delta": -2, "minimo": 0}, ...], "minimo": 0}. El `minimo` general vale para
+    los ajustes que no traen uno propio. Los ajustes sobre la misma ID se suman. Si alguno no cumple su mínimo
+    o el producto no existe, responde 409 con los fallidos y no aplica nada.
+    """
+    data = request.json or {}
+    ajustes = data.get("ajustes")
+    if not isinstance(ajustes, list) or not ajustes:
+        return jsonify({"error": "Se esperaba una lista 'ajustes'"}), 400
+    if len(ajustes) > BULK_MAX:
+        return jsonify({"error": f"Máximo {BULK_MAX} ajustes por solicitud"}), 413
+
+    deltas = {}
+    minimos = {}
+    for ajuste in ajustes:
+        minimo = ajuste.get("minimo", data.get("minimo")) if isinstance(ajuste, dict) else None
+        if (not isinstance(ajuste, dict) or not isinstance(ajuste.get("id"), int)
+                or not isinstance(ajuste.get("delta"), int) or (minimo is not None and not isinstance(minimo, int))):
+            return jsonify({"error": "Cada ajuste necesita 'id' y 'delta' enteros (y 'minimo' entero si se indica)"}), 400
+        deltas[ajuste["id"]] = deltas.get(ajuste["id"], 0) + ajuste["delta"]
+        if minimo is not None:
+            minimos[ajuste["id"]] = max(minimos.get(ajuste["id"], minimo), minimo)
+
+    try:
+        filas = almacen.reservar_stock(deltas, minimos)
+        cache_productos.invalidar(deltas)
+        return jsonify({"ajustes": [{"id": pid, "cantidad": cantidad} for pid, cantidad in filas],
+                        "aplicados": len(filas)}), 200
+    except StockInsuficienteError as e:
+        return jsonify({"error": str(e), "fallidos": e.fallidos}), 409
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respuesta_error(e)
 
 @app.route("/ultimo_cambio", methods=["GET"])
 def obtener_ultimo_cambio():
-    """Retorna la última fecha de modificación registrada en la tabla sincronización."""
+    """Retorna la última fecha de modificación registrada en la tabla sincronización, el sello (hlc, nodo) más
+    nuevo que escribió o recibió este servidor y la última secuencia del log.
+
+    El replicador compara los sellos, no las fechas: no dependen de que los relojes estén sincronizados.
+    """
     try:
-        conn = conectar_bd()
-        cur = conn.cursor()
-        cur.execute("SELECT servidor, MAX(ultimo_cambio) FROM sincronizacion GROUP BY servidor ORDER BY MAX(ultimo_cambio) DESC LIMIT 1;")
-        resultado = cur.fetchone()
-        cur.close()
-        conn.close()
+        resultado, ultimo_seq = almacen.ultimo_cambio()
 
         if resultado:
-            return jsonify({"servidor": resultado[0], "ultimo_cambio": resultado[1].isoformat()})
+            return jsonify({"servidor": resultado[0], "ultimo_cambio": resultado[1].isoformat(), "hlc": resultado[2],
+                            "nodo": resultado[3], "ultimo_seq": ultimo_seq, "almacen": almacen.nombre})
         else:
-            return jsonify({"servidor": None, "ultimo_cambio": "2000-01-01T00:00:00"})
+            return jsonify({"servidor": None, "ultimo_cambio": "2000-01-01T00:00:00", "hlc": 0, "nodo": "",
+                            "ultimo_seq": ultimo_seq, "almacen": almacen.nombre})
+    except Exception as e:
+        return respuesta_error(e)
+
+@app.route("/cambios", methods=["GET"])
+def obtener_cambios():
+    """Retorna, en orden, las entradas del log de cambios con secuencia mayor a `desde`.
+
+    Con Accept: application/x-columnas las entradas van en un bloque por columnas y el resto de los
+    datos en las cabeceras X-Servidor, X-Ultimo-Seq y X-Hay-Mas.
+    """
+    desde = request.args.get("desde", 0, type=int)
+    limite = max(0, min(request.args.get("limite", CAMBIOS_LIMITE, type=int), CAMBIOS_LIMITE))
+    try:
+        ultimo_seq, filas = almacen.cambios(desde, limite)
+
+        hasta = filas[-1][0] if filas else desde
+        if formato.acepta_columnas():
+            return Response(formato.codificar(filas, formato.ESQUEMA_CAMBIO), mimetype=formato.TIPO_COLUMNAS,
+                            headers={"X-Servidor": SERVER_NAME, "X-Ultimo-Seq": str(ultimo_seq),
+                                     "X-Hay-Mas": "1" if hasta < ultimo_seq else "0"})
+        cambios = [cambio_a_dict(fila) for fila in filas]
+        return jsonify({
+            "servidor": SERVER_NAME,
+            "ultimo_seq": ultimo_seq,
+            "cambios": cambios,
+            "hay_mas": hasta < ultimo_seq,
+        })
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return respuesta_error(e)
+
+@app.route("/eventos", methods=["GET"])
+def transmitir_eventos():
+    """Transmite en NDJSON un evento por cada escritura confirmada en este servidor.
+
+    Usa una suscripción del almacén (en PostgreSQL, una conexión propia que escucha LISTEN/NOTIFY). El primer
+    evento lleva la secuencia actual del log y, si no hay escrituras, cada EVENTOS_LATIDO segundos se envía
+    un latido para que el suscriptor detecte una conexión caída.
+    """
+    try:
+        suscripcion = almacen.suscribir()
+    except Exception as e:
+        return respuesta_error(e)
+
+    def generar():
+        try:
+            yield json.dumps({"tipo": "inicio", "servidor": SERVER_NAME, "seq": suscripcion.seq}) + "\n"
+            while True:
+                secuencias = suscripcion.esperar(EVENTOS_LATIDO)
+                if secuencias:
+                    yield json.dumps({"tipo": "cambio", "seq": max(secuencias)}) + "\n"
+                else:
+                    yield json.dumps({"tipo": "latido"}) + "\n"
+        finally:
+            suscripcion.cerrar()
+
+    return Response(generar(), mimetype="application/x-ndjson")
+
+@app.route("/merkle", methods=["GET"])
+def obtener_merkle():
+    """Retorna los hashes del árbol de Merkle para el rango de hojas [desde, hasta] dividido en `partes` subrangos.
+
+    Cada hoja cubre MERKLE_RANGO IDs. El hash de un rango es el XOR de los hashes de sus filas, que un
+    trigger mantiene en cada escritura (SQLite lo calcula al consultar); sin parámetros se retorna la raíz,
+    que cubre todas las IDs.
+    """
+    desde = max(0, request.args.get("desde", 0, type=int))
+    hasta = min(MERKLE_HOJAS - 1, request.args.get("hasta", MERKLE_HOJAS - 1, type=int))
+    partes = max(1, min(request.args.get("partes", 1, type=int), MERKLE_PARTES_MAX, hasta - desde + 1))
+    ancho = -(-(hasta - desde + 1) // partes)  # Hojas por subrango, redondeando hacia arriba
+    try:
+        hashes = almacen.merkle(desde, hasta, ancho)
+
+        resultado = []
+        for parte in range(-(-(hasta - desde + 1) // ancho)):
+            hash_, filas = hashes.get(parte, (0, 0))
+            inicio = desde + parte * ancho
+            resultado.append({"desde": inicio, "hasta": min(hasta, inicio + ancho - 1), "hash": hash_, "filas": int(filas)})
+        return jsonify({"rango": MERKLE_RANGO, "partes": resultado})
+    except Exception as e:
+        return respuesta_error(e)
+
+@app.route("/snapshot", methods=["GET"])
+def exportar_snapshot():
+    """Transmite una copia consistente de la tabla productos.
+
+    Va en el formato nativo del almacén (COPY binario en PostgreSQL, por columnas en SQLite), o por columnas si se
+    pide con Accept: application/x-columnas. La copia y la secuencia del log (cabecera X-Snapshot-Seq) se leen en
+    la misma transacción, así que quien la cargue puede seguir con GET /cambios?desde=<esa secuencia> sin perder
+    ni repetir cambios.
+    """
+    tipo = formato.TIPO_COLUMNAS if formato.acepta_columnas() else almacen.formatos_snapshot[0]
+    trozos = almacen.exportar_snapshot(tipo)
+    try:
+        seq = next(trozos)
+    except Exception as e:
+        return respuesta_error(e)
+    return Response(trozos, mimetype=tipo, headers={"X-Snapshot-Seq": str(seq), "X-Servidor": SERVER_NAME})
+
+@app.route("/snapshot", methods=["PUT"])
+def cargar_snapshot():
+    """Reemplaza la tabla productos por un snapshot de GET /snapshot de otro servidor, en una sola transacción.
+
+    El Content-Type indica el formato; el log de cambios recibe una lápida por cada producto que desapareció y
+    una entrada por cada producto cargado.
+    """
+    tipo = request.mimetype
+    if tipo == "application/octet-stream":
+        tipo = TIPO_COPY  # Replicadores anteriores enviaban el COPY binario sin tipo propio
+    if tipo not in almacen.formatos_snapshot:
+        return jsonify({"error": f"Formato de snapshot no soportado por el almacén {almacen.nombre}: {tipo}"}), 415
+    try:
+        filas, lapidas = almacen.cargar_snapshot(request.stream, tipo)
+        cache_productos.invalidar()
+        print(f"📸 Snapshot cargado: {filas} productos, {lapidas} eliminados")
+        return jsonify({"filas": filas, "eliminados": lapidas}), 200
+    except Exception as e:
+        return respuesta_error(e)
+
+@app.route("/pool", methods=["GET"])
+def estadisticas_pool():
+    """Retorna las estadísticas del pool de conexiones del almacén para dimensionarlo."""
+    return jsonify(almacen.estadisticas())
+
+def iniciar_proceso():
+    """Verifica la conexión y prepara el almacén de este proceso. Con produccion.py corre en cada worker,
+    después del fork, así cada uno abre su propio pool de conexiones."""
+    print(almacen.iniciar())
 
 if __name__ == "__main__":
     print(f"🔄 Iniciando servidor {SERVER_NAME}...")
-    conectar_bd()  # Verificar conexión al iniciar
-    app.run(host="0.0.0.0", port=5002)
+    iniciar_proceso()
+    app.run(host="0.0.0.0", port=PORT)
@@ -0,0 +1,26 @@
+"""Pruebas de la validación de POST /productos/bulk."""
+import pytest
+import requests
+from test_sincronizacion import levantar_servidor
+
+@pytest.fixture
+def servidor(tmp_path):
+    proceso, url = levantar_servidor(tmp_path, "a")
+    yield url
+    proceso.terminate()
+    proceso.wait()
+
+@pytest.mark.parametrize("cuerpo", ["[1, 2]", "3", "null", '{"operaciones": 1}'])
+def test_cuerpo_que_no_es_un_objeto_con_operaciones(servidor, cuerpo):
+    response = requests.post(f"{servidor}/productos/bulk", data=cuerpo, headers={"Content-Type": "application/json"},
+                             timeout=3)
+    assert response.status_code == 400
+    assert response.json() == {"error": "Se esperaba una lista 'operaciones'"}
+
+def test_campos_con_tipo_invalido_se_reportan_como_error(servidor):
+    base = {"op": "upsert", "nombre": "p", "descripcion": None, "cantidad": 5, "precio": 1.25}
+    operaciones = [base, dict(base, cantidad="5"), dict(base, cantidad=True), dict(base, precio="1"),
+                   dict(base, precio=False), dict(base, nombre=3), {"op": "stock", "id": 1, "delta": True}]
+    cuerpo = requests.post(f"{servidor}/productos/bulk", json={"operaciones": operaciones}, timeout=3).json()
+    assert [r["estado"] for r in cuerpo["resultados"]] == ["creado"] + ["error"] * 6
+    assert (cuerpo["aplicadas"], cuerpo["errores"]) == (1, 6)
@@ -0,0 +1,23 @@
+"""Pruebas de la caché de productos por ID."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache_productos import CacheProductos
+
+def test_la_version_se_consulta_a_lo_sumo_una_vez_por_intervalo():
+    cache = CacheProductos(10, 30, verificacion=60)
+    consultas = []
+    def version():
+        consultas.append(1)
+        return 5
+    for _ in range(100):
+        cache.ponerse_al_dia(version, lambda desde, hasta: set())
+    assert len(consultas) == 1
+
+def test_ponerse_al_dia_invalida_las_ids_cambiadas():
+    cache = CacheProductos(10, 30, verificacion=0)
+    cache.ponerse_al_dia(lambda: 1, lambda desde, hasta: set())
+    cache.guardar([(1, "a"), (2, "b")], cache.generacion())
+    cache.ponerse_al_dia(lambda: 3, lambda desde, hasta: {2} if (desde, hasta) == (1, 3) else None)
+    assert set(cache.obtener([1, 2])) == {1}
@@ -0,0 +1,81 @@
+"""Pruebas de la sincronización entre dos servidores SQLite levantados en procesos aparte."""
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+import requests
+
+DIRECTORIO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def levantar_servidor(tmp_path, nombre):
+    puerto = puerto_libre()
+    entorno = dict(os.environ, ALMACEN="sqlite", SQLITE_RUTA=str(tmp_path / f"{nombre}.db"), SERVER_NAME=nombre,
+                   PORT=str(puerto))
+    proceso = subprocess.Popen([sys.executable, os.path.join(DIRECTORIO, "server.py")], env=entorno, cwd=DIRECTORIO,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{puerto}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/ultimo_cambio", timeout=1)
+            return proceso, url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    proceso.kill()
+    raise RuntimeError(f"{nombre} no arrancó")
+
+@pytest.fixture
+def servidores(tmp_path, monkeypatch):
+    procesos, urls = zip(*(levantar_servidor(tmp_path, nombre) for nombre in ("a", "b")))
+    monkeypatch.setenv("SERVIDORES", ",".join(urls))
+    monkeypatch.setenv("COLA_RUTA", str(tmp_path / "cola.db"))
+    monkeypatch.syspath_prepend(DIRECTORIO)
+    sys.modules.pop("replicacion", None)
+    import replicacion
+    yield replicacion, urls
+    for proceso in procesos:
+        proceso.terminate()
+        proceso.wait()
+
+def cantidad(url, producto_id):
+    return requests.get(f"{url}/productos/{producto_id}", timeout=3).json()[3]
+
+def ajustar(url, producto_id, delta):
+    requests.patch(f"{url}/productos/{producto_id}/stock", json={"delta": delta}, timeout=3).raise_for_status()
+
+def test_ajustes_reenviados_tras_merkle_no_se_suman_dos_veces(servidores):
+    replicacion, (fuente, replica) = servidores
+    producto_id = requests.post(f"{fuente}/productos", json={"nombre": "p", "descripcion": "d", "cantidad": 100,
+                                                             "precio": 1.5}, timeout=3).json()["id"]
+    replicacion.sincronizacion_completa(fuente, replica)
+
+    # Como sincronizar_destino: la marca se toma antes de la reconciliación Merkle
+    marca = replicacion.obtener_ultimo_seq(fuente)
+    ajustar(fuente, producto_id, -10)
+    replicacion.sincronizacion_completa(fuente, replica)
+    ajustar(fuente, producto_id, -5)
+    replicacion.sincronizacion_incremental(fuente, replica, marca)
+
+    assert cantidad(fuente, producto_id) == 85
+    assert cantidad(replica, producto_id) == 85
+
+def test_lote_reenviado_no_suma_los_ajustes_otra_vez(servidores):
+    replicacion, (fuente, replica) = servidores
+    producto_id = requests.post(f"{fuente}/productos", json={"nombre": "p", "descripcion": "d", "cantidad": 100,
+                                                             "precio": 1.5}, timeout=3).json()["id"]
+    replicacion.sincronizacion_completa(fuente, replica)
+    marca = replicacion.obtener_ultimo_seq(fuente)
+    ajustar(fuente, producto_id, -10)
+    ajustar(fuente, producto_id, -5)
+
+    # Una respuesta perdida deja la marca sin avanzar y el mismo lote se envía de nuevo
+    replicacion.sincronizacion_incremental(fuente, replica, marca)
+    replicacion.sincronizacion_incremental(fuente, replica, marca)
+
+    assert cantidad(replica, producto_id) == 85
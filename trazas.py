@@ -0,0 +1,311 @@
+"""Trazas de solicitudes con desglose de tiempos para server.py y replicacion.py.
+
+Cada solicitud abre un tramo raíz con la ID de traza recibida en X-B3-TraceId (o una nueva) y el código
+instrumentado agrega tramos hijos con `tramo()`. Las solicitudes salientes llevan los encabezados B3, así que
+una traza sigue la solicitud del proxy al servidor. Los tramos se exportan en formato JSON de Zipkin v2: una
+línea por tramo en TRAZAS_ARCHIVO y/o lotes enviados a TRAZAS_COLECTOR (p. ej. http://zipkin:9411/api/v2/spans).
+
+En las respuestas transmitidas el tramo raíz termina al empezar a enviar el cuerpo.
+"""
+from flask import Response, g, jsonify, request
+from contextlib import contextmanager
+import collections
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import requests
+import metricas
+
+TRAZAS_ACTIVAS = os.getenv("TRAZAS_ACTIVAS", "1") == "1"  # "0" quita toda la instrumentación de trazas
+TRAZAS_ARCHIVO = os.getenv("TRAZAS_ARCHIVO")  # Archivo donde se agregan los tramos, uno por línea
+TRAZAS_COLECTOR = os.getenv("TRAZAS_COLECTOR")  # URL que recibe lotes de tramos en JSON (API v2 de Zipkin)
+TRAZAS_MUESTREO = float(os.getenv("TRAZAS_MUESTREO", "1"))  # Fracción de las trazas nuevas que se exportan
+TRAZAS_LENTAS_MS = float(os.getenv("TRAZAS_LENTAS_MS", "1000"))  # Solicitudes más lentas se registran y exportan siempre (0 lo desactiva)
+TRAZAS_TRAMOS_MAX = 1000  # Tramos guardados como máximo por traza
+TRAZAS_COLA_MAX = 10000  # Trazas pendientes de exportar; las que no entran se descartan
+TRAZAS_LOTE = 500  # Tramos por envío al colector
+
+# Perfilador por muestreo, opcional, para las rutas calientes
+PERFIL_RUTAS = [ruta for ruta in os.getenv("PERFIL_RUTAS", "").split(",") if ruta]  # Reglas a perfilar, p. ej. "/productos,/cambios"
+PERFIL_INTERVALO = float(os.getenv("PERFIL_INTERVALO", "5")) / 1000  # Milisegundos entre muestras
+PERFIL_ARCHIVO = os.getenv("PERFIL_ARCHIVO")  # Archivo donde se vuelcan las pilas plegadas
+PERFIL_VOLCADO = 30  # Segundos entre volcados al archivo
+
+ID_VALIDA = re.compile(r"^(?:[0-9a-f]{16}|[0-9a-f]{32})$")
+
+metrica_exportadas = metricas.Contador("trazas_tramos_exportados_total", "Tramos exportados, por destino", ("destino",))
+metrica_descartadas = metricas.Contador("trazas_descartadas_total", "Trazas no exportadas, por motivo", ("motivo",))
+
+_actual = contextvars.ContextVar("tramo_actual", default=None)
+
+class Traza:
+    """Tramos terminados de una solicitud, compartidos por todos los hilos que trabajan para ella."""
+
+    def __init__(self, traza_id, muestreada, servicio):
+        self.id = traza_id
+        self.muestreada = muestreada
+        self.servicio = servicio
+        self._lock = threading.Lock()
+        self.tramos = []
+        self.omitidos = 0
+
+    def agregar(self, tramo):
+        with self._lock:
+            if len(self.tramos) < TRAZAS_TRAMOS_MAX:
+                self.tramos.append(tramo)
+            else:
+                self.omitidos += 1
+
+class Tramo:
+    """Intervalo de trabajo con nombre dentro de una traza."""
+    __slots__ = ("traza", "id", "padre", "nombre", "tipo", "etiquetas", "inicio", "_t0", "duracion")
+
+    def __init__(self, traza, nombre, padre=None, tipo=None, etiquetas=None):
+        self.traza = traza
+        self.id = secrets.token_hex(8)
+        self.padre = padre
+        self.nombre = nombre
+        self.tipo = tipo
+        self.etiquetas = etiquetas or {}
+        self.inicio = time.time()
+        self._t0 = time.perf_counter()
+        self.duracion = None
+
+    def terminar(self):
+        self.duracion = time.perf_counter() - self._t0
+        self.traza.agregar(self)
+
+    def zipkin(self):
+        datos = {
+            "traceId": self.traza.id,
+            "id": self.id,
+            "name": self.nombre,
+            "timestamp": int(self.inicio * 1_000_000),
+            "duration": max(1, int(self.duracion * 1_000_000)),
+            "localEndpoint": {"serviceName": self.traza.servicio},
+        }
+        if self.padre:
+            datos["parentId"] = self.padre
+        if self.tipo:
+            datos["kind"] = self.tipo
+        if self.etiquetas:
+            datos["tags"] = {clave: str(valor) for clave, valor in self.etiquetas.items()}
+        return datos
+
+@contextmanager
+def tramo(nombre, tipo=None, **etiquetas):
+    """Mide el bloque como tramo hijo del tramo actual. Fuera de una solicitud trazada no hace nada."""
+    padre = _actual.get()
+    if padre is None:
+        yield None
+        return
+    actual = Tramo(padre.traza, nombre, padre.id, tipo, etiquetas)
+    token = _actual.set(actual)
+    try:
+        yield actual
+    except BaseException as e:
+        actual.etiquetas["error"] = type(e).__name__
+        raise
+    finally:
+        # Un generador transmitido puede cerrar su tramo después de terminada la solicitud
+        if _actual.get() is actual:
+            _actual.reset(token)
+        actual.terminar()
+
+def cabeceras():
+    """Encabezados B3 para propagar la traza actual en una solicitud saliente."""
+    actual = _actual.get()
+    if actual is None:
+        return {}
+    return {"X-B3-TraceId": actual.traza.id, "X-B3-SpanId": actual.id,
+            "X-B3-Sampled": "1" if actual.traza.muestreada else "0"}
+
+def en_contexto(funcion):
+    """Envuelve la función para que, al correr en otro hilo (p. ej. un ThreadPoolExecutor), sus tramos cuelguen
+    del tramo actual. Cada envoltura sirve para una sola ejecución a la vez."""
+    contexto = contextvars.copy_context()
+    return lambda *args, **kwargs: contexto.run(funcion, *args, **kwargs)
+
+class Exportador:
+    """Escribe los tramos en segundo plano para no demorar las respuestas."""
+
+    def __init__(self, archivo, colector):
+        self.archivo = archivo
+        self.colector = colector
+        self._cola = queue.Queue(maxsize=TRAZAS_COLA_MAX)
+        threading.Thread(target=self.ejecutar, daemon=True).start()
+
+    def enviar(self, tramos):
+        try:
+            self._cola.put_nowait(tramos)
+        except queue.Full:
+            metrica_descartadas.inc(motivo="cola_llena")
+
+    def ejecutar(self):
+        while True:
+            tramos = list(self._cola.get())
+            while len(tramos) < TRAZAS_LOTE:
+                try:
+                    tramos.extend(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            if self.archivo:
+                try:
+                    with open(self.archivo, "a", encoding="utf-8") as archivo:
+                        archivo.write("".join(json.dumps(datos, separators=(",", ":")) + "\n" for datos in tramos))
+                    metrica_exportadas.inc(len(tramos), destino="archivo")
+                except OSError as e:
+                    print(f"⚠️ No se pudieron escribir las trazas en {self.archivo}: {e}")
+            if self.colector:
+                try:
+                    requests.post(self.colector, json=tramos, timeout=5).raise_for_status()
+                    metrica_exportadas.inc(len(tramos), destino="colector")
+                except requests.exceptions.RequestException as e:
+                    metrica_descartadas.inc(motivo="colector")
+                    print(f"⚠️ No se pudieron enviar las trazas a {self.colector}: {e}")
+
+exportador = Exportador(TRAZAS_ARCHIVO, TRAZAS_COLECTOR) if TRAZAS_ARCHIVO or TRAZAS_COLECTOR else None
+
+def resumen(traza, raiz):
+    """Tiempo total por nombre de tramo, de mayor a menor, para el registro de solicitudes lentas."""
+    totales = collections.defaultdict(lambda: [0, 0.0])
+    for hijo in traza.tramos:
+        if hijo is not raiz:
+            totales[hijo.nombre][0] += 1
+            totales[hijo.nombre][1] += hijo.duracion
+    partes = []
+    for nombre, (cantidad, duracion) in sorted(totales.items(), key=lambda par: -par[1][1])[:8]:
+        veces = f" ×{cantidad}" if cantidad > 1 else ""
+        partes.append(f"{nombre}{veces} {duracion * 1000:.1f} ms")
+    return ", ".join(partes) or "sin tramos internos"
+
+class Perfilador:
+    """Perfilador por muestreo: cada PERFIL_INTERVALO toma la pila de los hilos que atienden una ruta perfilada.
+
+    Las pilas se cuentan en formato plegado (`ruta;marco;marco;... cantidad`), que leen flamegraph.pl y speedscope.
+    """
+
+    def __init__(self, rutas, intervalo, archivo):
+        self.rutas = set(rutas)
+        self.intervalo = intervalo
+        self.archivo = archivo
+        self._lock = threading.Lock()
+        self._hilos = {}  # {ID del hilo: ruta que atiende}
+        self._pilas = collections.Counter()
+        self._hilo = None
+
+    def empezar(self, ruta):
+        with self._lock:
+            self._hilos[threading.get_ident()] = ruta
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self.ejecutar, daemon=True)
+                self._hilo.start()
+
+    def terminar(self):
+        with self._lock:
+            self._hilos.pop(threading.get_ident(), None)
+
+    def ejecutar(self):
+        proximo_volcado = time.monotonic() + PERFIL_VOLCADO
+        while True:
+            time.sleep(self.intervalo)
+            with self._lock:
+                hilos = dict(self._hilos)
+            if hilos:
+                marcos = sys._current_frames()
+                pilas = []
+                for ident, ruta in hilos.items():
+                    marco = marcos.get(ident)
+                    pila = []
+                    while marco is not None:
+                        codigo = marco.f_code
+                        pila.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+                        marco = marco.f_back
+                    if pila:
+                        pilas.append(";".join([ruta] + pila[::-1]))
+                with self._lock:
+                    self._pilas.update(pilas)
+            if self.archivo and time.monotonic() >= proximo_volcado:
+                proximo_volcado = time.monotonic() + PERFIL_VOLCADO
+                self.volcar()
+
+    def plegadas(self, reiniciar=False):
+        with self._lock:
+            pilas = self._pilas
+            if reiniciar:
+                self._pilas = collections.Counter()
+        return "".join(f"{pila} {cantidad}\n" for pila, cantidad in pilas.most_common())
+
+    def volcar(self):
+        try:
+            with open(self.archivo, "w", encoding="utf-8") as archivo:
+                archivo.write(self.plegadas())
+        except OSError as e:
+            print(f"⚠️ No se pudo volcar el perfil en {self.archivo}: {e}")
+
+perfilador = Perfilador(PERFIL_RUTAS, PERFIL_INTERVALO, PERFIL_ARCHIVO) if PERFIL_RUTAS else None
+
+def instrumentar(app, servicio):
+    """Abre una traza por solicitud, la exporta al terminar, registra las lentas y agrega la ruta /perfil."""
+    if not TRAZAS_ACTIVAS:
+        return
+
+    @app.before_request
+    def _iniciar_traza():
+        traza_id = request.headers.get("X-B3-TraceId", "").lower()
+        muestreada = request.headers.get("X-B3-Sampled")
+        if not ID_VALIDA.match(traza_id):
+            traza_id = secrets.token_hex(16)
+            muestreada = None
+        muestreada = muestreada == "1" if muestreada in ("0", "1") else random.random() < TRAZAS_MUESTREO
+        traza = Traza(traza_id, muestreada, servicio)
+        raiz = Tramo(traza, f"{request.method} {request.path}", request.headers.get("X-B3-SpanId"), "SERVER",
+                     {"http.method": request.method, "http.path": request.path})
+        g.tramo_raiz = raiz
+        _actual.set(raiz)
+        if perfilador and request.url_rule and request.url_rule.rule in perfilador.rutas:
+            perfilador.empezar(request.url_rule.rule)
+
+    @app.after_request
+    def _cerrar_traza(response):
+        raiz = g.get("tramo_raiz")
+        if raiz is not None:
+            raiz.etiquetas["http.status_code"] = response.status_code
+            response.headers["X-B3-TraceId"] = raiz.traza.id
+        return response
+
+    @app.teardown_request
+    def _exportar_traza(error=None):
+        raiz = g.pop("tramo_raiz", None)
+        _actual.set(None)
+        if perfilador:
+            perfilador.terminar()
+        if raiz is None:
+            return
+        if request.url_rule:
+            raiz.nombre = f"{request.method} {request.url_rule.rule}"
+        if error is not None:
+            raiz.etiquetas["error"] = type(error).__name__
+        raiz.terminar()
+        traza = raiz.traza
+        lenta = TRAZAS_LENTAS_MS > 0 and raiz.duracion * 1000 >= TRAZAS_LENTAS_MS
+        if lenta:
+            print(f"🐢 {raiz.nombre} tardó {raiz.duracion * 1000:.0f} ms (traza {traza.id}): {resumen(traza, raiz)}")
+        if exportador and (traza.muestreada or lenta):
+            if traza.omitidos:
+                raiz.etiquetas["tramos_omitidos"] = traza.omitidos
+            exportador.enviar([hijo.zipkin() for hijo in traza.tramos])
+
+    @app.route("/perfil", methods=["GET"])
+    def perfil():
+        """Pilas plegadas del perfilador por muestreo; con ?reiniciar=1 empieza a contar de cero."""
+        if perfilador is None:
+            return jsonify({"error": "El perfilador está desactivado (defina PERFIL_RUTAS)"}), 404
+        return Response(perfilador.plegadas(request.args.get("reiniciar") == "1"), mimetype="text/plain")